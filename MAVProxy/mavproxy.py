@@ -13,12 +13,10 @@ import glob
 import json
 import os
 import platform
-import select
 import serial
 import shlex
 import signal
 import socket
-import struct
 import sys
 import threading
 import time
@@ -37,7 +35,10 @@ from pymavlink import mavutil
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import rline
+from MAVProxy.modules.lib import mp_logbuffer
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_profiler
+from MAVProxy.modules.lib import mp_reactor
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.mavproxy_link import preferred_ports
@@ -160,6 +161,10 @@ class MPStatus(object):
                 f.write('%s:%s ' % (c, self.counters[c]))
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
+            if mpstate.logqueue:
+                f.write('Log: %s\n' % mpstate.logqueue.status())
+            if mpstate.logqueue_raw:
+                f.write('Raw log: %s\n' % mpstate.logqueue_raw.status())
             f.write(str(self.gps)+'\n')
         for m in sorted(self.msgs.keys()):
             if pattern is not None:
@@ -242,6 +247,7 @@ class MPState(object):
         self.aircraft_dir = None
         self.logqueue_raw = None
         self.logqueue = None
+        self.log_thread = None
         self.rl = None
         self.input_queue = None
         self.input_count = None
@@ -260,7 +266,7 @@ class MPState(object):
             MPSetting('shownoise', bool, True, 'Show non-MAVLink data'),
             MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0, 10000000), increment=1),
             MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
-            MPSetting('select_timeout', float, 0.01, 'select timeout'),
+            MPSetting('select_timeout', float, 0.01, 'main loop tick interval'),
 
             MPSetting('altreadout', int, 0, 'Altitude Readout',
                       range=(0, 100), increment=1, tab='Announcements'),
@@ -270,6 +276,8 @@ class MPState(object):
             MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
             MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0, 3), tab='Debug'),
             MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+            MPSetting('fsynclogs', str, 'never', 'fsync telemetry logs', choice=['never', 'periodic', 'always']),
+            MPSetting('fsynclogs_period', int, 10, 'fsync period for periodic fsynclogs', range=(1, 3600), increment=1),
             MPSetting('requireexit', bool, False, 'Require exit command'),
             MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
             MPSetting('wpterrainadjust', bool, True, 'Adjust alt of moved wp using terrain'),
@@ -300,6 +308,7 @@ class MPState(object):
             MPSetting('fwdpos', bool, False, 'Forward GLOBAL_POSITION_INT on all links'),
             MPSetting('checkdelay', bool, True, 'check for link delay'),
             MPSetting('param_ftp', bool, True, 'try ftp for parameter download'),
+            MPSetting('param_cache', bool, True, 'use cached parameters when they match the vehicle'),
             MPSetting('param_docs', bool, True, 'show help for parameters'),
 
             MPSetting('vehicle_name', str, '', 'Vehicle Name', tab='Vehicle'),
@@ -317,6 +326,7 @@ class MPState(object):
             "status"         : ["(VARIABLE)"],
             "module"    : ["list",
                            "load (AVAILMODULES)",
+                           "profile <start|stop|reset|show|dump>",
                            "<unload|reload> (LOADEDMODULES)"]
         }
 
@@ -343,6 +353,8 @@ class MPState(object):
         self.public_modules = {}
         self.functions = MAVFunctions()
         self.select_extra = {}
+        self.reactor = mp_reactor.MPReactor()
+        self.profiler = mp_profiler.ModuleProfiler()
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -388,6 +400,7 @@ class MPState(object):
                 module = m.init(mpstate, **kwargs)
                 if isinstance(module, mp_module.MPModule):
                     mpstate.modules.append((module, m))
+                    self.modules_changed()
                     if not quiet:
                         if kwargs:
                             print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -407,6 +420,12 @@ class MPState(object):
         print("Failed to load module: %s.%s" % (ex, help_traceback))
         return False
 
+    def modules_changed(self):
+        '''called when the list of loaded modules changes'''
+        link = self.module('link')
+        if link is not None:
+            link.invalidate_packet_dispatch()
+
     def unload_module(self, modname):
         '''unload a module'''
         for (m, pm) in mpstate.modules:
@@ -418,8 +437,10 @@ class MPState(object):
                     if t.is_alive():
                         print("unload on module %s did not complete" % m.name)
                         mpstate.modules.remove((m, pm))
+                        self.modules_changed()
                         return False
                 mpstate.modules.remove((m, pm))
+                self.modules_changed()
                 if modname in mpstate.public_modules:
                     del mpstate.public_modules[modname]
                 print("Unloaded module %s" % modname)
@@ -604,7 +625,7 @@ def get_exception_stacktrace(e):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|profile>"
     if len(args) < 1:
         print(usage)
         return
@@ -655,6 +676,38 @@ def cmd_module(args):
             return
         modname = os.path.basename(args[1])
         mpstate.unload_module(modname)
+    elif args[0] == "profile":
+        cmd_module_profile(args[1:])
+    else:
+        print(usage)
+
+
+def cmd_module_profile(args):
+    '''profile module CPU usage'''
+    usage = "usage: module profile <start|stop|reset|show [COUNT]|dump FILENAME>"
+    profiler = mpstate.profiler
+    if len(args) < 1:
+        print(usage)
+        return
+    if args[0] == "start":
+        profiler.start()
+        print("Module profiling started")
+    elif args[0] == "stop":
+        profiler.stop()
+        print("Module profiling stopped")
+    elif args[0] == "reset":
+        profiler.reset()
+    elif args[0] == "show":
+        count = 20
+        if len(args) > 1:
+            count = int(args[1])
+        print(profiler.report(count))
+    elif args[0] == "dump":
+        if len(args) < 2:
+            print("usage: module profile dump FILENAME")
+            return
+        profiler.dump_collapsed(args[1])
+        print("Wrote %s" % args[1])
     else:
         print(usage)
 
@@ -842,14 +895,34 @@ def process_master(m):
     if len(s) == 0:
         time.sleep(0.1)
         return
+    process_master_buffer(m, s)
+
+
+def process_link_worker(m):
+    '''process batches from a worker process reading master m'''
+    worker = m.link_worker
+    batches = worker.receive()
+    if batches is None:
+        mpstate.console.writeln("link %s worker stopped, reading in main process" % mp_module.MPModule.link_label(m))
+        worker.stop()
+        m.link_worker = None
+        mpstate.reactor.mark_dirty()
+        return
+    for (s, addr, msgs) in batches:
+        worker.update_address(m, addr)
+        process_master_buffer(m, s, msgs)
+
 
+def process_master_buffer(m, s, msgs=None):
+    '''process a buffer read from master m. When the link is read by
+    a worker process msgs holds the messages it has already parsed'''
     mpstate.status.bytecounters['MasterIn'][m.linknum].update(len(s))
 
     if (mpstate.settings.compdebug & 1) != 0:
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -864,7 +937,22 @@ def process_master(m):
 
     if m.first_byte and mavversion is None:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+    link = mpstate.module('link')
+    if link is not None:
+        link.forward_begin()
+    try:
+        if msgs is None:
+            msgs = m.mav.parse_buffer(s)
+        else:
+            # deliver as parse_buffer() would have
+            mav = m.mav
+            for msg in msgs:
+                mav.total_packets_received += 1
+                if mav.callback is not None:
+                    mav.callback(msg, *mav.callback_args, **mav.callback_kwargs)
+    finally:
+        if link is not None:
+            link.forward_end()
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -917,7 +1005,7 @@ def process_mavlink(slave):
             output.write(m.get_msgbuf())
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -941,16 +1029,30 @@ def mkdir_p(dir):
 
 def log_writer():
     '''log writing thread'''
+    wake = mpstate.logqueue.wake
     while not mpstate.status.exit:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
+        flushlogs = mpstate.settings.flushlogs
+        mpstate.logqueue.wake_always = flushlogs
+        mpstate.logqueue_raw.wake_always = flushlogs
+        # wait until a buffer is filling up, or at most 0.5s so
+        # data reaches disk in large batches
+        wake.wait(0.5)
+        wake.clear()
+        if mpstate.status.exit:
+            # the final write is done by the main thread on exit
+            break
+        write_telemetry_logs()
+
+
+def write_telemetry_logs(fsync=None):
+    '''write any queued log data'''
+    if fsync is None:
+        policy = mpstate.settings.fsynclogs
+        fsync = (policy == 'always' or
+                 (policy == 'periodic' and
+                  time.time() - mpstate.logqueue.last_fsync >= mpstate.settings.fsynclogs_period))
+    mpstate.logqueue_raw.write_pending(mpstate.logfile_raw, fsync)
+    mpstate.logqueue.write_pending(mpstate.logfile, fsync)
 
 
 # If state_basedir is NOT set then paths for logs and aircraft
@@ -1020,9 +1122,9 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         # use a separate thread for writing to the logfile to prevent
         # delays during disk writes (important as delays can be long if camera
         # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
+        mpstate.log_thread = threading.Thread(target=log_writer, name='log_writer')
+        mpstate.log_thread.daemon = True
+        mpstate.log_thread.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -1072,6 +1174,24 @@ def send_heartbeat(master):
         master.mav.heartbeat_send(MAV_GROUND, MAV_AUTOPILOT_NONE)
 
 
+def idle_task_due(m, now):
+    '''return True if module m's idle_task should run now'''
+    if getattr(type(m), 'idle_task', None) is mp_module.MPModule.idle_task:
+        # module doesn't have an idle task
+        return False
+    rate = getattr(m, 'idle_rate', None)
+    if rate is None or rate <= 0:
+        return True
+    if m.idle_wakeup:
+        m.idle_wakeup = False
+    elif now < m.idle_deadline:
+        return False
+    # schedule from the previous deadline so the average rate is kept,
+    # but don't try to catch up after a stall
+    m.idle_deadline = max(m.idle_deadline + 1.0 / rate, now)
+    return True
+
+
 def periodic_tasks():
     '''run periodic checks'''
     if mpstate.status.setup_mode:
@@ -1095,11 +1215,19 @@ def periodic_tasks():
 
     mpstate.status.update_bytecounters()
 
-    # call optional module idle tasks. These are called at several hundred Hz
+    # call optional module idle tasks. These are called on every main
+    # loop tick unless the module has asked for a lower rate
+    profiler = mpstate.profiler
+    now = time.monotonic()
     for (m, pm) in mpstate.modules:
-        if hasattr(m, 'idle_task'):
+        if idle_task_due(m, now):
             try:
-                m.idle_task()
+                if profiler.enabled:
+                    t0 = time.perf_counter_ns()
+                    m.idle_task()
+                    profiler.record(m.name, 'idle_task', None, time.perf_counter_ns() - t0)
+                else:
+                    m.idle_task()
             except Exception as msg:
                 if mpstate.settings.moddebug == 1:
                     print(msg)
@@ -1111,11 +1239,94 @@ def periodic_tasks():
             mpstate.unload_module(m.name)
 
 
+def process_select_extra(fd):
+    '''call a read function registered by a module in select_extra'''
+    try:
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd, None)
+        mpstate.reactor.mark_dirty()
+
+
+def link_fd(master):
+    '''fd to watch for a link. mavtcp reconnects on a new socket without
+    updating master.fd'''
+    if isinstance(master, mavutil.mavtcp) and master.port is not None:
+        return master.port.fileno()
+    return master.fd
+
+
+def reactor_handlers():
+    '''return the wanted fd -> (fn, arg, owner) map for the reactor'''
+    ret = {}
+    for master in mpstate.mav_master:
+        worker = getattr(master, 'link_worker', None)
+        if worker is not None:
+            ret[worker.fileno()] = (process_link_worker, master, worker)
+        elif link_fd(master) is not None and not master.portdead:
+            ret[link_fd(master)] = (process_master, master, master)
+    for m in mpstate.mav_outputs:
+        if m.fd is not None:
+            ret[m.fd] = (process_mavlink, m, m)
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        if m.fd is not None:
+            ret[m.fd] = (process_mavlink, m, m)
+    for fd in mpstate.select_extra:
+        if fd is not None and fd not in ret:
+            ret[fd] = (process_select_extra, fd, mpstate.select_extra[fd])
+    return ret
+
+
+def process_input_queue():
+    '''run queued command lines'''
+    while not mpstate.input_queue.empty():
+        line = mpstate.input_queue.get()
+        mpstate.input_count += 1
+        cmds = line.split(';')
+        if len(cmds) == 1 and cmds[0] == "":
+            mpstate.empty_input_count += 1
+        for c in cmds:
+            process_stdin(c)
+
+
+def main_tick():
+    '''work done on every main loop tick'''
+    global screensaver_cookie
+
+    # enable or disable screensaver:
+    if (mpstate.settings.inhibit_screensaver_when_armed and
+            screensaver_interface is not None):
+        if mpstate.status.armed and screensaver_cookie is None:
+            # now we can inhibit the screensaver
+            screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
+                                                               "Vehicle is armed")
+        elif not mpstate.status.armed and screensaver_cookie is not None:
+            # we can also restore it
+            screensaver_interface.UnInhibit(screensaver_cookie)
+            screensaver_cookie = None
+
+    process_input_queue()
+
+    # serial ports without a file descriptor (eg. on Windows) have to be polled
+    for master in mpstate.mav_master:
+        if master.fd is None:
+            try:
+                if master.port.inWaiting() > 0:
+                    process_master(master)
+            except serial.SerialException:
+                pass
+
+    periodic_tasks()
+
+
 def main_loop():
     '''main processing loop'''
 
-    global screensaver_cookie
-
     if not mpstate.status.setup_mode and not opts.nowait:
         for master in mpstate.mav_master:
             if master.linknum != 0:
@@ -1125,103 +1336,33 @@ def main_loop():
             master.wait_heartbeat(timeout=0.1)
         set_stream_rates()
 
+    reactor = mpstate.reactor
+    reactor.add_timer(lambda: max(mpstate.settings.select_timeout, 0.001), main_tick)
+    # links can reconnect or die underneath us, so periodically
+    # check that the registered descriptors are still correct
+    reactor.add_timer(0.5, reactor.mark_dirty)
+
     while True:
         if mpstate is None or mpstate.status.exit:
             return
 
-        # enable or disable screensaver:
-        if (mpstate.settings.inhibit_screensaver_when_armed and
-                screensaver_interface is not None):
-            if mpstate.status.armed and screensaver_cookie is None:
-                # now we can inhibit the screensaver
-                screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
-                                                                   "Vehicle is armed")
-            elif not mpstate.status.armed and screensaver_cookie is not None:
-                # we can also restore it
-                screensaver_interface.UnInhibit(screensaver_cookie)
-                screensaver_cookie = None
-
-        while not mpstate.input_queue.empty():
-            line = mpstate.input_queue.get()
-            mpstate.input_count += 1
-            cmds = line.split(';')
-            if len(cmds) == 1 and cmds[0] == "":
-                mpstate.empty_input_count += 1
-            for c in cmds:
-                process_stdin(c)
-
-        for master in mpstate.mav_master:
-            if master.fd is None:
-                try:
-                    if master.port.inWaiting() > 0:
-                        process_master(master)
-                except serial.SerialException:
-                    pass
-
-        periodic_tasks()
+        if reactor.dirty:
+            reactor.sync(reactor_handlers())
 
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            if m.fd is not None:
-                rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            if m.fd is not None:
-                rin.append(m.fd)
-        if rin == []:
-            time.sleep(0.0001)
-            continue
-
-        for fd in mpstate.select_extra:
-            if fd is not None:
-                rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
-
-        if mpstate is None:
-            return
+        ready = reactor.poll(max(mpstate.settings.select_timeout, 0.001))
 
-        for fd in rin:
+        for (fd, h) in ready:
             if mpstate is None:
                 return
-            for master in mpstate.mav_master:
-                if fd == master.fd:
-                    process_master(master)
-                    if mpstate is None:
-                        return
-                    continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                        return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                        return
-                    continue
+            # a handler may have removed a link or output
+            if reactor.handlers.get(fd, None) is not h:
+                continue
+            (fn, arg, owner) = h
+            fn(arg)
 
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+        if mpstate is None:
+            return
+        reactor.run_timers()
 
 
 def input_loop():
@@ -1338,6 +1479,8 @@ if __name__ == '__main__':
                       default=0, help='MAVLink target master component')
     parser.add_option("--logfile", dest="logfile", help="MAVLink master logfile",
                       default='mav.tlog')
+    parser.add_option("--log-buffer", dest="log_buffer", type='int', default=8,
+                      help="telemetry log buffer size in MBytes, data is dropped if it fills")
     parser.add_option("-a", "--append-log", dest="append_log", help="Append to log files",
                       action='store_true', default=False)
     parser.add_option("--quadcopter", dest="quadcopter", help="use quadcopter controls",
@@ -1421,8 +1564,9 @@ if __name__ == '__main__':
     # queues for logging
 
     if not opts.no_state:
-        mpstate.logqueue = multiproc.Queue()
-        mpstate.logqueue_raw = multiproc.Queue()
+        log_buffer_size = max(opts.log_buffer, 1) * 1024 * 1024
+        mpstate.logqueue = mp_logbuffer.LogBuffer(log_buffer_size)
+        mpstate.logqueue_raw = mp_logbuffer.LogBuffer(log_buffer_size, wake=mpstate.logqueue.wake)
     else:
         mpstate.logqueue = None
         mpstate.logqueue_raw = None
@@ -1633,4 +1777,15 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    if not opts.no_state and getattr(mpstate, 'logfile', None) is not None:
+        # stop the writer thread before the final write
+        if mpstate.log_thread is not None:
+            mpstate.status.exit = True
+            mpstate.logqueue.wake.set()
+            mpstate.log_thread.join(2.0)
+        try:
+            write_telemetry_logs(fsync=True)
+        except Exception:
+            pass
+
     sys.exit(1)
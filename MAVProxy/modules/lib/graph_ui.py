@@ -1,5 +1,6 @@
 from MAVProxy.modules.lib import grapher
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_columns
 
 import errno
 import socket
@@ -39,6 +40,8 @@ class Graph_UI(object):
         self.mg.set_linestyle(self.mestate.settings.linestyle)
         self.mg.set_show_flightmode(self.mestate.settings.show_flightmode)
         self.mg.set_legend(self.mestate.settings.legend)
+        # attach the column cache before copying so later graphs share it
+        mp_columns.column_store(self.mestate.mlog, persist=self.mestate.settings.graph_cache)
         self.mg.add_mav(copy.copy(self.mestate.mlog))
         for f in graphdef.expression.split():
             self.mg.add_field(f)
@@ -20,6 +20,8 @@ import matplotlib.pyplot as plt
 from pymavlink import mavutil
 import threading
 import numpy as np
+from MAVProxy.modules.lib import mp_columns
+from MAVProxy.modules.lib import multiproc
 
 MAVGRAPH_DEBUG = 'MAVGRAPH_DEBUG' in os.environ
 
@@ -67,6 +69,16 @@ def timestamp_to_days(timestamp, timeshift=0):
     sec_to_days = 1.0 / (60*60*24)
     return tday_base + (timestamp - tday_basetime) * sec_to_days
 
+def timestamps_to_days(timestamps, timeshift=0):
+    '''convert a numpy array of log timestamps to days'''
+    if len(timestamps) == 0:
+        return timestamps
+    timestamp_to_days(timestamps[0], timeshift)
+    if tday_base is None:
+        return np.zeros(len(timestamps))
+    sec_to_days = 1.0 / (60*60*24)
+    return tday_base + (timestamps - tday_basetime) * sec_to_days
+
 class MilliFormatter(matplotlib.dates.AutoDateFormatter):
     '''tick formatter that shows millisecond resolution'''
     def __init__(self, locator):
@@ -125,6 +137,19 @@ class MavGraph(object):
         else:
             self.text_types = frozenset([unicode, str])
         self.max_message_rate = 0
+        self.vectorize = True
+        self.jobs = 1
+        self.mav_open_args = {}
+
+    def set_vectorize(self, enable):
+        '''enable evaluating simple fields on cached numpy columns'''
+        self.vectorize = enable
+
+    def set_jobs(self, jobs, **open_args):
+        '''process logs in a pool of jobs processes. Logs added as
+        filenames are opened in the workers with open_args'''
+        self.jobs = jobs
+        self.mav_open_args = open_args
 
     def set_max_message_rate(self, rate_hz):
         '''set maximum rate we will graph any message'''
@@ -436,7 +461,7 @@ class MavGraph(object):
         '''add some data'''
         mtype = msg.get_type()
         for i in range(0, len(self.fields)):
-            if mtype not in self.field_types[i]:
+            if mtype not in self.field_types[i] or self.vector_done[i]:
                 continue
             f = self.fields[i]
             has_instance = False
@@ -543,16 +568,30 @@ class MavGraph(object):
         except Exception:
             pass
 
+        self.vector_done = [False] * self.num_fields
+        if self.vectorize:
+            self.process_columns(mlog, flightmode_selections)
+        msg_types = set()
+        for i in range(self.num_fields):
+            if self.vector_done[i]:
+                continue
+            msg_types = msg_types.union(self.field_types[i])
+            if isinstance(self.x[i], np.ndarray):
+                self.x[i] = self.x[i].tolist()
+                self.y[i] = self.y[i].tolist()
+        if len(msg_types) == 0:
+            return
+
         all_messages = {}
 
         while True:
-            msg = mlog.recv_match(type=self.msg_types)
+            msg = mlog.recv_match(type=msg_types)
             if msg is None:
                 break
             mtype = msg.get_type()
             if not mtype in all_messages or not isinstance(all_messages[mtype],dict):
                 all_messages[mtype] = msg
-            if mtype not in self.msg_types:
+            if mtype not in msg_types:
                 continue
             if self.condition:
                 if not mavutil.evaluate_condition(self.condition, all_messages):
@@ -567,6 +606,45 @@ class MavGraph(object):
                 elif (idx < len(flightmode_selections) and flightmode_selections[idx]):
                     self.add_data(tdays, msg, all_messages)
 
+    def process_columns(self, mlog, flightmode_selections):
+        '''evaluate simple fields on whole numpy columns of each message type'''
+        if self.condition or self.xaxis or self.max_message_rate > 0:
+            return
+        if True in flightmode_selections:
+            return
+        instance_types = set()
+        for itypes in self.instance_types:
+            instance_types = instance_types.union(itypes.keys())
+        exprs = {}
+        load_types = set()
+        for i in range(self.num_fields):
+            if self.field_types[i].intersection(instance_types):
+                continue
+            e = mp_columns.VectorExpression.parse(self.fields[i])
+            if e is None or len(e.types) != 1 or not e.types.issubset(self.field_types[i]):
+                continue
+            exprs[i] = e
+            load_types = load_types.union(self.field_types[i])
+        if len(exprs) == 0:
+            return
+        store = mp_columns.column_store(mlog)
+        store.load(mlog, load_types)
+        for (i, e) in exprs.items():
+            mtype = list(e.types)[0]
+            others = self.field_types[i].difference(e.types)
+            if any(store.count(t) > 0 for t in others):
+                # other message types would also produce points
+                continue
+            if store.count(mtype) == 0:
+                self.vector_done[i] = True
+                continue
+            r = e.evaluate(store)
+            if r is None:
+                continue
+            (t, v) = r
+            self.merge_series(i, timestamps_to_days(t, self.timeshift), v)
+            self.vector_done[i] = True
+
     def xlim_change_check(self, idx):
         '''handle xlim change requests from queue'''
         try:
@@ -625,10 +703,63 @@ class MavGraph(object):
 
         timeshift = self.timeshift
 
+        if self.jobs > 1 and len(self.mav_list) > 1 and all([isinstance(m, str) for m in self.mav_list]):
+            self.process_parallel(flightmode_selections)
+            return
+
         for fi in range(0, len(self.mav_list)):
-            mlog = self.mav_list[fi]
+            mlog = self.open_mav(self.mav_list[fi])
             self.process_mav(mlog, flightmode_selections)
 
+    def open_mav(self, mav):
+        '''return a log object for a mav_list entry, which may be a filename'''
+        if isinstance(mav, str):
+            return mavutil.mavlink_connection(mav, **self.mav_open_args)
+        return mav
+
+    def merge_series(self, i, x, y):
+        '''append series data for field i'''
+        if len(x) == 0:
+            return
+        if len(self.x[i]) == 0:
+            self.x[i] = x
+            self.y[i] = y
+        elif isinstance(x, np.ndarray) or isinstance(self.x[i], np.ndarray):
+            self.x[i] = np.concatenate((np.asarray(self.x[i]), np.asarray(x)))
+            self.y[i] = np.concatenate((np.asarray(self.y[i]), np.asarray(y)))
+        else:
+            self.x[i].extend(x)
+            self.y[i].extend(y)
+
+    def process_parallel(self, flightmode_selections):
+        '''process the logs in a pool of worker processes and merge the
+        series in log order'''
+        jobs = [(self, fi, flightmode_selections) for fi in range(len(self.mav_list))]
+        results = [None] * len(jobs)
+        done = 0
+        t0 = time.time()
+        pool = multiproc.Pool(min(self.jobs, len(jobs)))
+        try:
+            for r in pool.imap_unordered(process_mav_job, jobs):
+                fi = r['fi']
+                results[fi] = r
+                done += 1
+                points = 0
+                for x in r['x']:
+                    points += len(x)
+                print("Processed %s (%u/%u) %u points in %.1fs" % (
+                    self.mav_list[fi], done, len(jobs), points, r['time']))
+        finally:
+            pool.close()
+            pool.join()
+        for r in results:
+            for i in range(len(r['x'])):
+                self.merge_series(i, r['x'][i], r['y'][i])
+        # field settings as left by the last log, as in serial processing
+        for k in ['fields', 'num_fields', 'custom_labels', 'axes', 'first_only', 'simple_field']:
+            setattr(self, k, results[-1][k])
+        print("Processed %u logs in %.1fs" % (len(jobs), time.time() - t0))
+
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
         '''show graph'''
@@ -690,6 +821,17 @@ class MavGraph(object):
         else:
             plt.savefig(output, bbox_inches='tight', dpi=200)
 
+def process_mav_job(job):
+    '''process one log in a worker process, returning its series'''
+    (mg, fi, flightmode_selections) = job
+    t0 = time.time()
+    mlog = mg.open_mav(mg.mav_list[fi])
+    mg.process_mav(mlog, flightmode_selections)
+    ret = {'fi': fi, 'x': mg.x, 'y': mg.y, 'time': time.time() - t0}
+    for k in ['fields', 'num_fields', 'custom_labels', 'axes', 'first_only', 'simple_field']:
+        ret[k] = getattr(mg, k)
+    return ret
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
@@ -712,14 +854,22 @@ if __name__ == "__main__":
     parser.add_argument("--output", default=None, help="provide an output format")
     parser.add_argument("--timeshift", type=float, default=0, help="shift time on first graph in seconds")
     parser.add_argument("--grid", action='store_true', help="show a grid")
+    parser.add_argument("--jobs", type=int, default=1, help="number of logs to process in parallel")
     parser.add_argument("logs_fields", metavar="<LOG or FIELD>", nargs="+")
     args = parser.parse_args()
 
     mg = MavGraph()
+    mg.set_jobs(args.jobs, notimestamps=args.notimestamps,
+                zero_time_base=args.zero_time_base,
+                dialect=args.dialect)
 
     filenames = []
     for f in args.logs_fields:
         if os.path.exists(f):
+            if args.jobs > 1:
+                # opened by the worker processes
+                mg.add_mav(f)
+                continue
             mlog = mavutil.mavlink_connection(f, notimestamps=args.notimestamps,
                                               zero_time_base=args.zero_time_base,
                                               dialect=args.dialect)
@@ -32,6 +32,7 @@ except ImportError:
 class MissionItemProtocolModule(mp_module.MPModule):
     def __init__(self, mpstate, name, description, **args):
         super(MissionItemProtocolModule, self).__init__(mpstate, name, description, **args)
+        self.set_idle_rate(10)
         self.add_command(self.command_name(),
                          self.cmd_wp,
                          '%s management' % self.itemtype(),
@@ -0,0 +1,305 @@
+'''
+columnar message cache for graphing
+
+Each message type is read from the log once and stored as numpy
+arrays, one per numeric field plus the message timestamps. Simple
+field expressions such as "ATT.Roll" or "degrees(ATTITUDE.roll)*2"
+can then be evaluated on whole columns at once rather than one
+message at a time.
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import operator
+import os
+
+import numpy as np
+
+TIMESTAMP = '_timestamp'
+
+vector_functions = {
+    'abs': np.abs,
+    'fabs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'asin': np.arcsin,
+    'acos': np.arccos,
+    'atan': np.arctan,
+    'atan2': np.arctan2,
+    'degrees': np.degrees,
+    'radians': np.radians,
+}
+
+vector_constants = {
+    'pi': np.pi,
+    'e': np.e,
+}
+
+vector_binops = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+}
+
+vector_unaryops = {
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+}
+
+
+def log_filename(mlog):
+    '''return the filename of a log object, or None'''
+    filename = getattr(mlog, 'filename', None)
+    if filename is None:
+        fh = getattr(mlog, 'filehandle', None)
+        filename = getattr(fh, 'name', None)
+    if isinstance(filename, str) and os.path.isfile(filename):
+        return filename
+    return None
+
+
+def column_store(mlog, persist=None):
+    '''return the column store attached to a log, creating it if
+    needed. Copies of the log made afterwards share the store'''
+    store = getattr(mlog, 'column_store', None)
+    if store is None:
+        store = ColumnStore(log_filename(mlog))
+        mlog.column_store = store
+    if persist is not None:
+        store.persist = persist
+    return store
+
+
+class ColumnBuilder(object):
+    '''accumulate the numeric fields of one message type'''
+    def __init__(self, msg):
+        self.fields = []
+        for f in msg.get_fieldnames():
+            v = getattr(msg, f, None)
+            if isinstance(v, (int, float)):
+                self.fields.append(f)
+        self.getter = None
+        if len(self.fields) > 0:
+            self.getter = operator.attrgetter(*self.fields)
+        self.rows = []
+        self.timestamps = []
+
+    def add(self, msg):
+        self.timestamps.append(msg._timestamp)
+        if self.getter is not None:
+            self.rows.append(self.getter(msg))
+
+    def finish(self):
+        '''return dict of field name -> array'''
+        ret = {TIMESTAMP: np.array(self.timestamps, dtype=float)}
+        if len(self.fields) == 1:
+            self.rows = [(r,) for r in self.rows]
+        try:
+            data = np.array(self.rows, dtype=float).reshape(len(self.rows), len(self.fields))
+            for i in range(len(self.fields)):
+                ret[self.fields[i]] = data[:, i]
+            return ret
+        except (TypeError, ValueError):
+            pass
+        # a field changed type part way through the log, keep the
+        # columns which are numeric throughout
+        for i in range(len(self.fields)):
+            try:
+                ret[self.fields[i]] = np.array([r[i] for r in self.rows], dtype=float)
+            except (TypeError, ValueError):
+                pass
+        return ret
+
+
+class ColumnStore(object):
+    '''numpy columns for each message type of a log'''
+    def __init__(self, filename=None, persist=False):
+        self.filename = filename
+        self.persist = persist
+        # mtype -> dict of field name -> array
+        self.columns = {}
+
+    def cache_dir(self):
+        return self.filename + '.columns'
+
+    def load_cached(self, mtype):
+        '''try loading a message type saved by an earlier session'''
+        path = os.path.join(self.cache_dir(), mtype + '.npz')
+        try:
+            st = os.stat(self.filename)
+            with np.load(path) as npz:
+                if npz['_size'] != st.st_size or npz['_mtime'] != st.st_mtime:
+                    return None
+                return {k[4:]: npz[k] for k in npz.files if k.startswith('col_')}
+        except Exception:
+            return None
+
+    def save_cached(self, mtype, columns):
+        '''save the columns of a message type for later sessions'''
+        try:
+            st = os.stat(self.filename)
+            if not os.path.isdir(self.cache_dir()):
+                os.mkdir(self.cache_dir())
+            path = os.path.join(self.cache_dir(), mtype + '.npz')
+            arrays = {'col_' + k: v for (k, v) in columns.items()}
+            np.savez(path, _size=st.st_size, _mtime=st.st_mtime, **arrays)
+        except OSError as ex:
+            print("Failed to save columns for %s: %s" % (mtype, ex))
+
+    def load(self, mlog, types):
+        '''make sure all of types are in the store, reading any which
+        are missing in a single pass over the log'''
+        needed = set()
+        for mtype in types:
+            if mtype in self.columns:
+                continue
+            if self.persist and self.filename is not None:
+                cols = self.load_cached(mtype)
+                if cols is not None:
+                    self.columns[mtype] = cols
+                    continue
+            needed.add(mtype)
+        if len(needed) == 0:
+            return
+        builders = {}
+        mlog.rewind()
+        while True:
+            m = mlog.recv_match(type=needed)
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype not in needed:
+                continue
+            b = builders.get(mtype, None)
+            if b is None:
+                b = ColumnBuilder(m)
+                builders[mtype] = b
+            b.add(m)
+        mlog.rewind()
+        for mtype in needed:
+            if mtype in builders:
+                cols = builders[mtype].finish()
+            else:
+                cols = {TIMESTAMP: np.zeros(0)}
+            self.columns[mtype] = cols
+            if self.persist and self.filename is not None:
+                self.save_cached(mtype, cols)
+
+    def count(self, mtype):
+        '''number of messages of a type, which must have been loaded'''
+        return len(self.columns[mtype][TIMESTAMP])
+
+    def column(self, mtype, field):
+        '''return a column array, or None if not available'''
+        return self.columns.get(mtype, {}).get(field, None)
+
+
+class VectorExpression(object):
+    '''an expression which can be evaluated on message columns'''
+    def __init__(self, expression, tree, types):
+        self.expression = expression
+        self.tree = tree
+        self.types = types
+
+    @staticmethod
+    def parse(expression):
+        '''return a VectorExpression, or None if the expression uses
+        anything other than TYPE.field, numbers, arithmetic and
+        elementwise maths functions'''
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            return None
+        types = set()
+        if not VectorExpression.check(tree.body, types) or len(types) == 0:
+            return None
+        return VectorExpression(expression, tree.body, types)
+
+    @staticmethod
+    def check(node, types):
+        '''check node is supported, collecting message types'''
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+        if isinstance(node, ast.Name):
+            return node.id in vector_constants
+        if isinstance(node, ast.Attribute):
+            if not isinstance(node.value, ast.Name) or node.value.id in vector_constants:
+                return False
+            types.add(node.value.id)
+            return True
+        if isinstance(node, ast.BinOp):
+            return (type(node.op) in vector_binops and
+                    VectorExpression.check(node.left, types) and
+                    VectorExpression.check(node.right, types))
+        if isinstance(node, ast.UnaryOp):
+            return type(node.op) in vector_unaryops and VectorExpression.check(node.operand, types)
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in vector_functions:
+                return False
+            if len(node.keywords) != 0:
+                return False
+            nargs = 2 if node.func.id == 'atan2' else 1
+            if len(node.args) != nargs:
+                return False
+            for a in node.args:
+                if not VectorExpression.check(a, types):
+                    return False
+            return True
+        return False
+
+    def evaluate(self, store):
+        '''evaluate on a store holding a single message type. Returns
+        (timestamps, values) or None if a field is missing. Entries
+        where a per-message evaluation would have raised an error,
+        such as division by zero, are left out'''
+        mtype = list(self.types)[0]
+        timestamps = store.column(mtype, TIMESTAMP)
+        if timestamps is None:
+            return None
+        inputs = []
+        try:
+            with np.errstate(all='ignore'):
+                v = self.eval_node(self.tree, store, inputs)
+        except KeyError:
+            return None
+        v = np.broadcast_to(np.asarray(v, dtype=float), timestamps.shape)
+        keep = np.isfinite(v)
+        if not keep.all():
+            # keep non-finite results which came from non-finite inputs
+            inputs_finite = np.ones(timestamps.shape, dtype=bool)
+            for a in inputs:
+                inputs_finite &= np.isfinite(a)
+            keep |= ~inputs_finite
+            return (timestamps[keep], v[keep])
+        return (timestamps, v)
+
+    def eval_node(self, node, store, inputs):
+        if isinstance(node, ast.Constant):
+            return float(node.value)
+        if isinstance(node, ast.Name):
+            return vector_constants[node.id]
+        if isinstance(node, ast.Attribute):
+            a = store.column(node.value.id, node.attr)
+            if a is None:
+                raise KeyError(node.attr)
+            inputs.append(a)
+            return a
+        if isinstance(node, ast.BinOp):
+            return vector_binops[type(node.op)](self.eval_node(node.left, store, inputs),
+                                                self.eval_node(node.right, store, inputs))
+        if isinstance(node, ast.UnaryOp):
+            return vector_unaryops[type(node.op)](self.eval_node(node.operand, store, inputs))
+        args = [self.eval_node(a, store, inputs) for a in node.args]
+        return vector_functions[node.func.id](*args)
@@ -7,7 +7,11 @@ Created by Stephen Dade (stephen_dade@hotmail.com)
 
 import os
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import numpy
 
@@ -20,10 +24,19 @@ TERRAIN_SERVICES = {
     "SRTM3"      : ("terrain.ardupilot.org", "SRTM3")
 }
 
+# how often the loader retries a tile which is still downloading, and
+# how long it keeps trying
+TILE_RETRY_INTERVAL = 0.2
+TILE_LOAD_TIMEOUT = 120
+
 class ElevationModel():
-    '''Elevation Model. Only SRTM for now'''
+    '''Elevation Model. Only SRTM for now
+
+    SRTM tiles which aren't already in the cache are downloaded and
+    loaded by a background thread, so lookups never wait on them unless
+    given a timeout. At most max_tiles tiles are kept loaded.'''
 
-    def __init__(self, database='SRTM3', offline=0, debug=False, cachedir=None):
+    def __init__(self, database='SRTM3', offline=0, debug=False, cachedir=None, max_tiles=32):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
         tile exists'''
         if database is not None and database.lower() == 'srtm':
@@ -33,7 +46,16 @@ class ElevationModel():
         if self.database in ['SRTM1', 'SRTM3']:
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug, directory=self.database, cachedir=cachedir)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            # TileID -> tile, least recently used first
+            self.tileDict = OrderedDict()
+            self.max_tiles = max_tiles
+            # TileID -> (Future, time requested) for tiles being loaded
+            self.pending = {}
+            self.lock = threading.Lock()
+            # the downloader's file list and download state aren't thread safe
+            self.download_lock = threading.Lock()
+            self.loader_wakeup = threading.Event()
+            self.loader_thread = None
         elif self.database == 'geoscience':
             '''Use the Geoscience Australia database instead - watch for the correct database path'''
             from MAVProxy.modules.mavproxy_map import GAreader
@@ -43,33 +65,190 @@ class ElevationModel():
             print("Error: Bad terrain source " + str(database))
             self.database = None
 
+    def getTile(self, TileID, timeout=0):
+        '''return the SRTM tile for a (lat, lon) TileID, or None if it is
+        not available within timeout seconds'''
+        tile = self.tileDict.get(TileID, None)
+        if tile is not None:
+            with self.lock:
+                if TileID in self.tileDict:
+                    self.tileDict.move_to_end(TileID)
+            return tile
+        if self.downloader.hasLocalTile(TileID[0], TileID[1]):
+            # already in the cache, no need to go to the loader
+            tile = self.loadTile(TileID)
+            if tile != 0:
+                self.addTile(TileID, tile)
+                return tile
+        future = self.requestTile(TileID)
+        if timeout <= 0:
+            return None
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            return None
+
+    def loadTile(self, TileID):
+        '''load a tile from the downloader, returning 0 if it isn't available
+        yet. Only the file lookup holds download_lock, not the unzip'''
+        with self.download_lock:
+            tile = self.downloader.getTileFile(TileID[0], TileID[1])
+        if isinstance(tile, str):
+            tile = self.downloader.loadTileFile(tile, TileID[0], TileID[1])
+        return tile
+
+    def addTile(self, TileID, tile):
+        '''add a loaded tile, dropping the least recently used'''
+        with self.lock:
+            self.tileDict[TileID] = tile
+            self.tileDict.move_to_end(TileID)
+            while len(self.tileDict) > self.max_tiles:
+                self.tileDict.popitem(last=False)
+
+    def requestTile(self, TileID):
+        '''return a Future for a tile, which is loaded in the background.
+        The result is the tile, or None if it could not be loaded'''
+        with self.lock:
+            tile = self.tileDict.get(TileID, None)
+            if tile is not None:
+                future = Future()
+                future.set_result(tile)
+                return future
+            if TileID in self.pending:
+                return self.pending[TileID][0]
+            future = Future()
+            self.pending[TileID] = (future, time.time())
+            if self.loader_thread is None:
+                self.loader_thread = threading.Thread(target=self.loader, name='ElevationModel loader')
+                self.loader_thread.daemon = True
+                self.loader_thread.start()
+        self.loader_wakeup.set()
+        return future
+
+    def prefetch(self, latitude, longitude, radius=1):
+        '''start loading the tiles within radius tiles of a position'''
+        if self.database not in ['SRTM1', 'SRTM3']:
+            return
+        lat = numpy.floor(latitude)
+        lon = numpy.floor(longitude)
+        for dlat in range(-radius, radius+1):
+            for dlon in range(-radius, radius+1):
+                if abs(lat + dlat) > 89:
+                    continue
+                tlon = (lon + dlon + 180) % 360 - 180
+                TileID = (lat + dlat, tlon)
+                if TileID not in self.tileDict:
+                    self.requestTile(TileID)
+
+    def loader(self):
+        '''background thread loading the requested tiles'''
+        while True:
+            self.loader_wakeup.wait()
+            self.loader_wakeup.clear()
+            while True:
+                with self.lock:
+                    pending = list(self.pending.items())
+                if len(pending) == 0:
+                    break
+                for (TileID, (future, request_time)) in pending:
+                    tile = self.loadTile(TileID)
+                    if tile != 0:
+                        self.addTile(TileID, tile)
+                    elif time.time() - request_time < TILE_LOAD_TIMEOUT:
+                        continue
+                    else:
+                        tile = None
+                    with self.lock:
+                        self.pending.pop(TileID, None)
+                    future.set_result(tile)
+                self.loader_wakeup.wait(TILE_RETRY_INTERVAL)
+                self.loader_wakeup.clear()
+
+    def pendingTiles(self):
+        '''number of tiles waiting to be loaded'''
+        return len(self.pending)
+
     def GetElevation(self, latitude, longitude, timeout=0):
         '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
         if latitude is None or longitude is None:
             return None
         if self.database in ['SRTM1', 'SRTM3']:
             TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.getTile(TileID, timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         elif self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         else:
             return None
         return alt
 
+    def GetElevationAsync(self, latitude, longitude, callback=None):
+        '''Returns a Future for the altitude of a lat/long pair, with a result
+        of None if unknown. callback(alt) is called when it is known, from
+        the loader thread if the tile wasn't already loaded'''
+        result = Future()
+        if callback is not None:
+            result.add_done_callback(lambda f: callback(f.result()))
+        if self.database not in ['SRTM1', 'SRTM3'] or latitude is None or longitude is None:
+            result.set_result(self.GetElevation(latitude, longitude))
+            return result
+        TileID = (numpy.floor(latitude), numpy.floor(longitude))
+        tile = self.getTile(TileID)
+        if tile is not None:
+            result.set_result(tile.getAltitudeFromLatLon(latitude, longitude))
+            return result
+
+        def tile_loaded(future):
+            tile = future.result()
+            if tile is None:
+                result.set_result(None)
+            else:
+                result.set_result(tile.getAltitudeFromLatLon(latitude, longitude))
+        self.requestTile(TileID).add_done_callback(tile_loaded)
+        return result
+
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns an array of the altitudes (m ASL) of arrays of lat/long,
+        with NaN where the altitude is unknown'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        alts = numpy.full(numpy.broadcast(lats, lons).shape, numpy.nan)
+        (lats, lons) = numpy.broadcast_arrays(lats, lons)
+        if self.database not in ['SRTM1', 'SRTM3']:
+            for i in numpy.ndindex(alts.shape):
+                alt = self.GetElevation(lats[i], lons[i], timeout)
+                if alt is not None:
+                    alts[i] = alt
+            return alts
+        lats = lats.ravel()
+        lons = lons.ravel()
+        flat_alts = alts.reshape(-1)
+        valid = numpy.flatnonzero(numpy.isfinite(lats) & numpy.isfinite(lons))
+        tile_lat = numpy.floor(lats[valid])
+        tile_lon = numpy.floor(lons[valid])
+        # group the points by tile
+        order = numpy.lexsort((tile_lon, tile_lat))
+        valid = valid[order]
+        tile_lat = tile_lat[order]
+        tile_lon = tile_lon[order]
+        starts = numpy.flatnonzero(numpy.diff(tile_lat, prepend=numpy.nan) != 0)
+        starts = numpy.union1d(starts, numpy.flatnonzero(numpy.diff(tile_lon, prepend=numpy.nan) != 0))
+        ends = numpy.append(starts[1:], len(valid))
+        if timeout > 0:
+            # start all the tiles loading before waiting on any
+            for start in starts:
+                self.getTile((tile_lat[start], tile_lon[start]))
+        deadline = time.time() + timeout
+        for (start, end) in zip(starts, ends):
+            tile = self.getTile((tile_lat[start], tile_lon[start]), deadline - time.time())
+            if tile is None:
+                continue
+            idx = valid[start:end]
+            flat_alts[idx] = tile.getAltitudeArray(lats[idx], lons[idx])
+        return alts
+
 
 if __name__ == "__main__":
 
@@ -112,5 +291,11 @@ if __name__ == "__main__":
     t1 = time.time()+.000001
     print("Altitude at (%.6f, %.6f) is %u m. Pulled at %.1f FPS" % (lat, lon, alt, 1/(t1-t0)))
 
-
-
+    # a 100x100 grid around the start point in one call
+    (lats, lons) = numpy.meshgrid(numpy.linspace(args.lat-0.01, args.lat+0.01, 100),
+                                  numpy.linspace(args.lon-0.01, args.lon+0.01, 100))
+    t0 = time.time()
+    alts = EleModel.GetElevationArray(lats, lons, timeout=10)
+    t1 = time.time()+.000001
+    print("Grid of %u altitudes from %.1f m to %.1f m. Pulled at %.1f FPS" % (alts.size, numpy.nanmin(alts),
+                                                                          numpy.nanmax(alts), alts.size/(t1-t0)))
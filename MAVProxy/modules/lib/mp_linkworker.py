@@ -0,0 +1,132 @@
+'''
+read and parse a master link in a separate process
+
+The worker is forked with a copy of the link, reads the port and runs
+the MAVLink parser, then sends each batch of decoded messages to the
+main process over a pipe, so messages from one link stay in order.
+Unpickling a batch is much cheaper than parsing it, which moves most
+of the per-byte work for high rate links off the main thread. Writes
+to the link are still done by the main process on the shared port.
+
+Only serial and UDP links on Linux are supported, as the port has to
+be inherited by fork. If the worker dies the link falls back to being
+read by the main process.
+
+AP_FLAKE8_CLEAN
+'''
+
+import multiprocessing
+import os
+import pickle
+import platform
+import select
+import signal
+import time
+
+from pymavlink import mavutil
+
+
+class LinkWorker(object):
+    '''a child process reading and parsing one master link'''
+    def __init__(self, conn):
+        ctx = multiprocessing.get_context('fork')
+        (self.receiver, sender) = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=self.child_main, args=(conn, sender),
+                                   name='link_worker %s' % conn.address)
+        self.process.daemon = True
+        self.process.start()
+        sender.close()
+        self.batches = 0
+        self.messages = 0
+
+    @staticmethod
+    def unsupported_reason(conn):
+        '''return a string explaining why conn can't use a worker, or None'''
+        if platform.system() != 'Linux':
+            return "link workers are only supported on Linux"
+        if not isinstance(conn, (mavutil.mavserial, mavutil.mavudp)):
+            return "link workers only support serial and UDP links"
+        if conn.fd is None:
+            return "link has no file descriptor"
+        signing = getattr(conn.mav, 'signing', None)
+        if signing is not None and signing.secret_key is not None:
+            return "link workers don't support signing"
+        return None
+
+    @staticmethod
+    def child_main(conn, sender):
+        '''read and parse the link until the main process goes away'''
+        # don't run the signal handlers inherited from MAVProxy, the
+        # main process stops us with SIGTERM
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # messages are delivered to the callbacks by the main process
+        conn.mav.callback = None
+        conn.mav.send_callback = None
+        parent = os.getppid()
+        udp = isinstance(conn, mavutil.mavudp)
+        while os.getppid() == parent:
+            try:
+                (rin, win, xin) = select.select([conn.fd], [], [], 0.5)
+                if len(rin) == 0:
+                    continue
+                addr = None
+                if udp:
+                    (s, addr) = conn.port.recvfrom(mavutil.UDP_MAX_PACKET_LEN)
+                else:
+                    s = conn.recv(16*1024)
+                if len(s) == 0:
+                    time.sleep(0.1)
+                    continue
+                if conn.first_byte:
+                    conn.auto_mavlink_version(s)
+                msgs = conn.mav.parse_buffer(s)
+                sender.send_bytes(pickle.dumps((s, addr, msgs), pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                # the main process has gone, or a port failure. Stop
+                # and let the main process take over reading
+                break
+        sender.close()
+
+    def fileno(self):
+        return self.receiver.fileno()
+
+    def receive(self, max_batches=50):
+        '''return a list of (buffer, address, msgs) batches, or None if
+        the worker has stopped'''
+        ret = []
+        try:
+            while len(ret) < max_batches:
+                batch = pickle.loads(self.receiver.recv_bytes())
+                if batch[2] is not None:
+                    self.messages += len(batch[2])
+                ret.append(batch)
+                if not self.receiver.poll():
+                    break
+        except (EOFError, OSError):
+            if len(ret) == 0:
+                return None
+        self.batches += len(ret)
+        return ret
+
+    @staticmethod
+    def update_address(conn, addr):
+        '''apply the source address of a UDP packet read by the worker,
+        as mavudp.recv() would have done'''
+        if addr is None:
+            return
+        if conn.udp_server:
+            conn.clients.add(addr)
+            conn.clients_last_alive[addr] = time.time()
+        elif conn.broadcast:
+            conn.last_address = addr
+
+    def stop(self):
+        '''stop the worker process'''
+        try:
+            self.receiver.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=1)
@@ -0,0 +1,152 @@
+'''
+bounded ring buffer for telemetry logs
+
+Producers copy data straight into a preallocated bytearray and a
+writer thread drains it to disk in large batched writes. When the
+buffer is full new data is dropped and counted rather than growing
+memory without limit.
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import struct
+import threading
+import time
+
+
+class LogBuffer(object):
+    '''a fixed size ring buffer feeding a log file'''
+    def __init__(self, size, wake=None):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # head and tail are running byte counts, positions are modulo size
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+        # held while writing, so only one thread consumes the tail
+        self.write_lock = threading.Lock()
+        # the writer waits on this, it may be shared between buffers
+        if wake is None:
+            wake = threading.Event()
+        self.wake = wake
+        self.wake_level = size // 4
+        self.wake_always = False
+        self.put_count = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.written = 0
+        self.batches = 0
+        self.write_time = 0.0
+        self.write_time_max = 0.0
+        self.last_fsync = time.time()
+
+    def _copy_in(self, data, pos):
+        '''copy data into the ring at running position pos'''
+        n = len(data)
+        ofs = pos % self.size
+        first = min(n, self.size - ofs)
+        self.view[ofs:ofs+first] = data[:first]
+        if first < n:
+            self.view[0:n-first] = data[first:]
+        return pos + n
+
+    def _reserve(self, n):
+        '''reserve n bytes, returning start position or None if full'''
+        if self.head + n - self.tail > self.size:
+            self.dropped += 1
+            self.dropped_bytes += n
+            return None
+        pos = self.head
+        self.head += n
+        self.put_count += 1
+        return pos
+
+    def _queued(self):
+        if self.wake_always or self.head - self.tail >= self.wake_level:
+            self.wake.set()
+
+    def put(self, data):
+        '''queue a block of bytes'''
+        n = len(data)
+        with self.lock:
+            pos = self._reserve(n)
+            if pos is None:
+                return False
+            self._copy_in(data, pos)
+        self._queued()
+        return True
+
+    def put_timestamped(self, usec, msgbuf):
+        '''queue a tlog record of a big-endian usec timestamp and a
+        message buffer, without building a combined copy first'''
+        n = 8 + len(msgbuf)
+        with self.lock:
+            pos = self._reserve(n)
+            if pos is None:
+                return False
+            pos = self._copy_in(struct.pack('>Q', usec), pos)
+            self._copy_in(msgbuf, pos)
+        self._queued()
+        return True
+
+    def qsize(self):
+        '''bytes waiting to be written'''
+        return self.head - self.tail
+
+    def empty(self):
+        return self.head == self.tail
+
+    def write_pending(self, f, fsync=False):
+        '''write everything queued to f in at most two writes. Returns
+        number of bytes written'''
+        with self.write_lock:
+            return self._write_pending(f, fsync)
+
+    def _write_pending(self, f, fsync):
+        with self.lock:
+            head = self.head
+        n = head - self.tail
+        if n == 0:
+            if fsync:
+                self.fsync(f)
+            return 0
+        t0 = time.perf_counter()
+        ofs = self.tail % self.size
+        first = min(n, self.size - ofs)
+        # the region between tail and head is not touched by
+        # producers, so it can be written without holding the lock
+        f.write(self.view[ofs:ofs+first])
+        if first < n:
+            f.write(self.view[0:n-first])
+        f.flush()
+        if fsync:
+            self.fsync(f)
+        dt = time.perf_counter() - t0
+        with self.lock:
+            self.tail += n
+        self.written += n
+        self.batches += 1
+        self.write_time += dt
+        self.write_time_max = max(self.write_time_max, dt)
+        return n
+
+    def fsync(self, f):
+        try:
+            os.fsync(f.fileno())
+        except (OSError, ValueError):
+            pass
+        self.last_fsync = time.time()
+
+    def status(self):
+        '''return a one line status string'''
+        avg_ms = 0
+        if self.batches > 0:
+            avg_ms = 1000.0 * self.write_time / self.batches
+        return ("queued %u bytes (%.1f%%) written %u bytes in %u writes, dropped %u msgs (%u bytes), "
+                "write latency avg %.2fms max %.2fms" % (
+                    self.qsize(), 100.0 * self.qsize() / self.size,
+                    self.written, self.batches,
+                    self.dropped, self.dropped_bytes,
+                    avg_ms, 1000.0 * self.write_time_max))
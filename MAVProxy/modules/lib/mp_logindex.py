@@ -0,0 +1,319 @@
+'''
+persistent sidecar index for telemetry logs
+
+Opening a tlog needs a pass over the whole file to find the offset of
+every message. That pass is done once and saved next to the log as
+LOGFILE.idx along with the timestamp of each message, the flight mode
+spans and the parameters, so later loads of the same log only read the
+bytes of the message types that are asked for. The index is rebuilt if
+the log size or modification time changes.
+
+The index is a numpy .npz file loaded with allow_pickle=False, as logs
+are often shared along with their index files.
+
+AP_FLAKE8_CLEAN
+'''
+
+import bisect
+import json
+import os
+import struct
+from array import array
+
+import numpy as np
+from pymavlink import mavutil
+
+INDEX_VERSION = 2
+
+
+def index_filename(logfile):
+    '''name of the sidecar index for a log'''
+    return logfile + '.idx'
+
+
+def can_index(filename):
+    '''return True if filename is a log which mavlink_connection would
+    open as a tlog'''
+    if not os.path.isfile(filename):
+        return False
+    lower = filename.lower()
+    for suffix in ['.bin', '.px4log', '.log', '.csv', '.elf']:
+        if lower.endswith(suffix):
+            return False
+    return filename.find('/bin/') == -1
+
+
+def open_log(filename, progress_callback=None, use_index=True):
+    '''open a log for reading, using the sidecar index where possible'''
+    if can_index(filename):
+        return IndexedTlog(filename, progress_callback=progress_callback, use_index=use_index)
+    return mavutil.mavlink_connection(filename, notimestamps=False,
+                                      zero_time_base=False,
+                                      progress_callback=progress_callback)
+
+
+def to_array(typecode, a, dtype):
+    '''convert a numpy array loaded from an index to an array.array'''
+    ret = array(typecode)
+    ret.frombytes(np.ascontiguousarray(a, dtype=dtype).tobytes())
+    return ret
+
+
+class LogIndex(object):
+    '''per-type offsets and timestamps of a log, plus the state
+    gathered by the flight mode pass'''
+    def __init__(self, size=0, mtime=0):
+        self.size = size
+        self.mtime = mtime
+        # msgid -> array of file offsets and array of timestamps
+        self.offsets = {}
+        self.timestamps = {}
+        # instance names such as "BATTERY_STATUS[1]" seen in the log
+        self.instances = []
+        self.flightmodes = None
+        self.sysid = 0
+        self.mav_type = None
+        self.mav_autopilot = None
+        # (sysid, compid) -> {param name: value}
+        self.params = {}
+
+    def counts(self):
+        '''return dict of msgid -> number of messages'''
+        return {mtype: len(offsets) for (mtype, offsets) in self.offsets.items()}
+
+    def save(self, filename):
+        '''save the index, returning False if it could not be written'''
+        meta = {
+            'version': INDEX_VERSION,
+            'size': self.size,
+            'mtime': self.mtime,
+            'msgids': sorted(self.offsets.keys()),
+            'instances': self.instances,
+            'flightmodes': self.flightmodes,
+            'sysid': self.sysid,
+            'mav_type': self.mav_type,
+            'mav_autopilot': self.mav_autopilot,
+            'params': [[k[0], k[1], v] for (k, v) in self.params.items()],
+        }
+        arrays = {'meta': np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)}
+        for mtype in self.offsets:
+            arrays['o%u' % mtype] = np.frombuffer(self.offsets[mtype], dtype=np.int64)
+            arrays['t%u' % mtype] = np.frombuffer(self.timestamps[mtype], dtype=np.float64)
+        tmpname = filename + '.tmp'
+        try:
+            with open(tmpname, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmpname, filename)
+        except (OSError, TypeError, ValueError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return False
+        return True
+
+    @staticmethod
+    def load(filename, logfile):
+        '''load an index, returning None if it is missing, unreadable
+        or stale for logfile'''
+        try:
+            st = os.stat(logfile)
+            with np.load(filename, allow_pickle=False) as z:
+                meta = json.loads(z['meta'].tobytes().decode('utf-8'))
+                if meta['version'] != INDEX_VERSION:
+                    return None
+                if meta['size'] != st.st_size or meta['mtime'] != st.st_mtime:
+                    return None
+                idx = LogIndex(meta['size'], meta['mtime'])
+                for mtype in meta['msgids']:
+                    mtype = int(mtype)
+                    idx.offsets[mtype] = to_array('q', z['o%u' % mtype], np.int64)
+                    idx.timestamps[mtype] = to_array('d', z['t%u' % mtype], np.float64)
+                    if len(idx.offsets[mtype]) != len(idx.timestamps[mtype]) or len(idx.offsets[mtype]) == 0:
+                        return None
+            idx.instances = [str(i) for i in meta['instances']]
+            if meta['flightmodes'] is not None:
+                idx.flightmodes = [tuple(f) for f in meta['flightmodes']]
+            idx.sysid = meta['sysid']
+            idx.mav_type = meta['mav_type']
+            idx.mav_autopilot = meta['mav_autopilot']
+            idx.params = {(p[0], p[1]): dict(p[2]) for p in meta['params']}
+        except Exception:
+            return None
+        return idx
+
+
+class IndexedTlog(mavutil.mavmmaplog):
+    '''a memory mapped tlog using a sidecar index. recv_match() can be
+    limited to a time range with set_time_range()'''
+    def __init__(self, filename, progress_callback=None, use_index=True):
+        self.use_index = use_index
+        self.index = None
+        self.index_loaded = False
+        self.range_start = None
+        self.range_end = None
+        mavutil.mavmmaplog.__init__(self, filename, progress_callback=progress_callback)
+        if self.data_len == 0:
+            return
+        if self.index_loaded:
+            self.restore_state()
+            return
+        # run the flight mode pass now so it can be saved with the index
+        self.flightmode_list()
+        self.save_state()
+        if self.use_index:
+            self.index.save(index_filename(filename))
+
+    def init_arrays(self, progress_callback=None):
+        '''initialise arrays for fast recv_match(), from the index if
+        it is up to date'''
+        st = os.stat(self.filename)
+        if self.use_index:
+            idx = LogIndex.load(index_filename(self.filename), self.filename)
+            if idx is not None:
+                self.restore_arrays(idx)
+                self.index = idx
+                self.index_loaded = True
+                if progress_callback is not None:
+                    progress_callback(100)
+                return
+        mavutil.mavmmaplog.init_arrays(self, progress_callback)
+        idx = LogIndex(st.st_size, st.st_mtime)
+        unpack = struct.Struct('>Q').unpack_from
+        data_map = self.data_map
+        for (mtype, offsets) in self.offsets.items():
+            offsets = array('q', offsets)
+            self.offsets[mtype] = offsets
+            idx.offsets[mtype] = offsets
+            idx.timestamps[mtype] = array('d', [unpack(data_map, ofs)[0] * 1.0e-6 for ofs in offsets])
+        idx.instances = [k for k in self.messages.keys() if k.find('[') != -1]
+        self.index = idx
+
+    def restore_arrays(self, idx):
+        '''set up the state init_arrays() would have built from an index'''
+        self.offsets = idx.offsets
+        self.counts = idx.counts()
+        self._count = sum(self.counts.values())
+        self.name_to_id = {}
+        self.id_to_name = {}
+        self.instance_offsets = {}
+        self.instance_lengths = {}
+        self.type_nums = None
+        for (mtype, offsets) in idx.offsets.items():
+            if mtype not in mavutil.mavlink.mavlink_map:
+                continue
+            msgname = mavutil.mavlink.mavlink_map[mtype].msgname
+            self.name_to_id[msgname] = mtype
+            self.id_to_name[mtype] = msgname
+            # decode the first message of each type for tab completion
+            # and instance field handling
+            self.f.seek(offsets[0])
+            m = self.recv_msg()
+            if m is None:
+                continue
+            mavutil.add_message(self.messages, msgname, m)
+        for iname in idx.instances:
+            mname = iname[:iname.find('[')]
+            if mname in self.messages:
+                self.messages[iname] = self.messages[mname]
+        self.offset = 0
+        self._rewind()
+
+    def save_state(self):
+        '''record the state gathered by the flight mode pass'''
+        idx = self.index
+        idx.flightmodes = self._flightmodes
+        idx.sysid = self.sysid
+        if self.sysid in self.sysid_state:
+            idx.mav_type = self.mav_type
+            idx.mav_autopilot = self.sysid_state[self.sysid].mav_autopilot
+        idx.params = {k: dict(v.params) for (k, v) in self.param_state.items()}
+
+    def restore_state(self):
+        '''restore the flight mode pass state from the index'''
+        idx = self.index
+        self.sysid = idx.sysid
+        if self.sysid not in self.sysid_state:
+            self.sysid_state[self.sysid] = mavutil.mavfile_state()
+        if idx.mav_type is not None:
+            self.mav_type = idx.mav_type
+            self.sysid_state[self.sysid].mav_autopilot = idx.mav_autopilot
+        for (k, params) in idx.params.items():
+            if k not in self.param_state:
+                self.param_state[k] = mavutil.param_state()
+            self.param_state[k].params.update(params)
+        if idx.flightmodes is not None:
+            self._flightmodes = list(idx.flightmodes)
+
+    def rewind(self):
+        '''rewind to start of log, clearing any time range'''
+        self.range_start = None
+        self.range_end = None
+        mavutil.mavmmaplog.rewind(self)
+
+    def set_time_range(self, start_time=None, end_time=None):
+        '''limit the following recv_match() calls to messages between
+        start_time and end_time. Call after rewind()'''
+        self.range_start = start_time
+        self.range_end = end_time
+        self.type_nums = None
+
+    def type_count(self, mtype):
+        '''number of messages of the given type name'''
+        mid = self.name_to_id.get(mtype, None)
+        if mid is None:
+            return 0
+        return self.counts[mid]
+
+    def time_range(self, mtype):
+        '''return (first, last) timestamp for a message type name, or None'''
+        mid = self.name_to_id.get(mtype, None)
+        if mid is None or self.index is None:
+            return None
+        ts = self.index.timestamps[mid]
+        return (ts[0], ts[-1])
+
+    def index_range(self, mtype):
+        '''return the (first, end) message numbers of mtype within the
+        time range'''
+        ts = self.index.timestamps[mtype]
+        i0 = 0
+        i1 = len(ts)
+        if self.range_start is not None:
+            i0 = bisect.bisect_left(ts, self.range_start)
+        if self.range_end is not None:
+            i1 = bisect.bisect_right(ts, self.range_end)
+        return (i0, i1)
+
+    def skip_to_type(self, type):
+        '''skip fwd to next msg matching given type set'''
+        if self.data_map is None:
+            return
+        if self.type_nums is None:
+            # always add some key msg types so we can track flightmode, params etc
+            type = type.copy()
+            type.update(set(['HEARTBEAT', 'PARAM_VALUE']))
+            self.indexes = []
+            self.end_indexes = []
+            self.type_nums = []
+            for t in type:
+                if t not in self.name_to_id:
+                    continue
+                mtype = self.name_to_id[t]
+                (i0, i1) = self.index_range(mtype)
+                self.type_nums.append(mtype)
+                self.indexes.append(i0)
+                self.end_indexes.append(i1)
+        smallest_index = -1
+        smallest_offset = self.data_len
+        for i in range(len(self.type_nums)):
+            if self.indexes[i] >= self.end_indexes[i]:
+                continue
+            ofs = self.offsets[self.type_nums[i]][self.indexes[i]]
+            if ofs < smallest_offset:
+                smallest_offset = ofs
+                smallest_index = i
+        if smallest_index >= 0:
+            self.indexes[smallest_index] += 1
+        self.offset = smallest_offset
+        self.f.seek(smallest_offset)
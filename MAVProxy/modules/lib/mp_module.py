@@ -20,6 +20,14 @@ class MPModule(object):
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
         self.named_float_seq = 0
+        # message types and source sysids wanted by mavlink_packet,
+        # None means all. See subscribe_mavlink()
+        self.mavlink_packet_types = None
+        self.mavlink_packet_sysids = None
+        # idle_task scheduling, see set_idle_rate()
+        self.idle_rate = None
+        self.idle_deadline = 0
+        self.idle_wakeup = False
 
         if description is None:
             self.description = name + " handling"
@@ -143,6 +151,30 @@ class MPModule(object):
     def param_set(self, name, value, retries=3):
         self.mpstate.functions.param_set(name, value, retries)
 
+    def subscribe_mavlink(self, msg_types, sysids=None):
+        '''only pass messages of the given types to mavlink_packet. If
+        sysids is given then only messages from those systems are
+        passed, replacing the usual target system/multi_vehicle check'''
+        self.mavlink_packet_types = set(msg_types)
+        if sysids is None:
+            self.mavlink_packet_sysids = None
+        else:
+            self.mavlink_packet_sysids = set(sysids)
+        link = self.mpstate.module('link')
+        if link is not None:
+            link.invalidate_packet_dispatch()
+
+    def set_idle_rate(self, rate):
+        '''ask for idle_task to be called at rate Hz instead of on every
+        main loop tick. None restores calling on every tick'''
+        self.idle_rate = rate
+        self.idle_deadline = 0
+
+    def wake_idle(self):
+        '''ask for idle_task to be called on the next main loop tick,
+        for modules using set_idle_rate() that have new work'''
+        self.idle_wakeup = True
+
     def add_command(self, name, callback, description, completions=None):
         self.mpstate.command_map[name] = (callback, description)
         if completions is not None:
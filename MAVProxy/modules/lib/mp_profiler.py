@@ -0,0 +1,94 @@
+'''
+per-module CPU profiler
+
+Accumulates call counts and total/max time for each module's
+mavlink_packet (per message type) and idle_task calls, so the module
+eating the main thread can be found under load.
+
+AP_FLAKE8_CLEAN
+'''
+
+import time
+
+
+class ModuleProfiler(object):
+    '''accumulate module call timings'''
+    def __init__(self):
+        self.enabled = False
+        self.start_ns = 0
+        self.elapsed_ns = 0
+        # (module, hook, mtype) -> [count, total_ns, max_ns]
+        self.stats = {}
+
+    def start(self):
+        if not self.enabled:
+            self.enabled = True
+            self.start_ns = time.perf_counter_ns()
+
+    def stop(self):
+        if self.enabled:
+            self.enabled = False
+            self.elapsed_ns += time.perf_counter_ns() - self.start_ns
+
+    def reset(self):
+        self.stats = {}
+        self.elapsed_ns = 0
+        self.start_ns = time.perf_counter_ns()
+
+    def record(self, modname, hook, mtype, dt_ns):
+        '''record one call taking dt_ns'''
+        key = (modname, hook, mtype)
+        s = self.stats.get(key, None)
+        if s is None:
+            self.stats[key] = [1, dt_ns, dt_ns]
+            return
+        s[0] += 1
+        s[1] += dt_ns
+        if dt_ns > s[2]:
+            s[2] = dt_ns
+
+    def wall_time_ns(self):
+        '''profiled wall clock time'''
+        if self.enabled:
+            return self.elapsed_ns + time.perf_counter_ns() - self.start_ns
+        return self.elapsed_ns
+
+    def module_totals(self):
+        '''return list of (modname, count, total_ns, max_ns) sorted by total time'''
+        totals = {}
+        for ((modname, hook, mtype), (count, total, tmax)) in self.stats.items():
+            t = totals.setdefault(modname, [0, 0, 0])
+            t[0] += count
+            t[1] += total
+            t[2] = max(t[2], tmax)
+        ret = [(k, v[0], v[1], v[2]) for (k, v) in totals.items()]
+        return sorted(ret, key=lambda x: x[2], reverse=True)
+
+    def report(self, count=20):
+        '''return a report of the top modules and calls as a string'''
+        wall_ns = max(self.wall_time_ns(), 1)
+        lines = []
+        lines.append("Profiled %.1fs (%s)" % (wall_ns * 1.0e-9, "running" if self.enabled else "stopped"))
+        lines.append("%-16s %10s %10s %6s %10s" % ("Module", "Calls", "Total(ms)", "CPU%", "Max(us)"))
+        for (modname, calls, total, tmax) in self.module_totals()[:count]:
+            lines.append("%-16s %10u %10.1f %6.2f %10.1f" % (
+                modname, calls, total * 1.0e-6, 100.0 * total / wall_ns, tmax * 1.0e-3))
+        lines.append("")
+        lines.append("%-16s %-14s %-24s %10s %10s %10s %10s" % (
+            "Module", "Hook", "Type", "Calls", "Total(ms)", "Avg(us)", "Max(us)"))
+        entries = sorted(self.stats.items(), key=lambda x: x[1][1], reverse=True)
+        for ((modname, hook, mtype), (calls, total, tmax)) in entries[:count]:
+            lines.append("%-16s %-14s %-24s %10u %10.1f %10.1f %10.1f" % (
+                modname, hook, mtype or '-', calls, total * 1.0e-6,
+                total * 1.0e-3 / calls, tmax * 1.0e-3))
+        return "\n".join(lines)
+
+    def dump_collapsed(self, filename):
+        '''write stats in the collapsed stack format used by
+        flamegraph.pl and speedscope, weighted in microseconds'''
+        with open(filename, 'w') as f:
+            for ((modname, hook, mtype), (calls, total, tmax)) in sorted(self.stats.items()):
+                stack = ["main_loop", hook, modname]
+                if mtype is not None:
+                    stack.append(mtype)
+                f.write("%s %u\n" % (";".join(stack), total // 1000))
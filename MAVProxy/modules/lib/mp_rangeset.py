@@ -0,0 +1,115 @@
+'''
+a set of integers stored as sorted, non-overlapping ranges
+
+Used to track which byte ranges of a file transfer have been received
+or are still missing. Ranges are half open, [start, end).
+
+AP_FLAKE8_CLEAN
+'''
+
+import bisect
+
+
+class RangeSet(object):
+    '''sorted, non-overlapping [start, end) ranges. Touching ranges are
+    merged'''
+    def __init__(self, ranges=None):
+        self.starts = []
+        self.ends = []
+        if ranges is not None:
+            for (start, end) in ranges:
+                self.add(start, end)
+
+    def __len__(self):
+        '''number of separate ranges'''
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def total(self):
+        '''number of integers in the set'''
+        return sum(self.ends) - sum(self.starts)
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+
+    def first(self):
+        '''return the first (start, end) range, or None if empty'''
+        if len(self.starts) == 0:
+            return None
+        return (self.starts[0], self.ends[0])
+
+    def add(self, start, end):
+        '''add the range [start, end)'''
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def remove(self, start, end):
+        '''remove the range [start, end), returning how many integers
+        were removed'''
+        if end <= start:
+            return 0
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        if i >= j:
+            return 0
+        removed = 0
+        for k in range(i, j):
+            removed += min(self.ends[k], end) - max(self.starts[k], start)
+        starts = []
+        ends = []
+        if self.starts[i] < start:
+            starts.append(self.starts[i])
+            ends.append(start)
+        if self.ends[j-1] > end:
+            starts.append(end)
+            ends.append(self.ends[j-1])
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+        return removed
+
+    def overlaps(self, start, end):
+        '''return True if any of [start, end) is in the set'''
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def contains(self, start, end):
+        '''return True if all of [start, end) is in the set'''
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] <= start and self.ends[i] >= end
+
+    def difference(self, other):
+        '''iterate over the (start, end) pieces of this set which are not
+        in other, in order'''
+        for (start, end) in self:
+            i = bisect.bisect_right(other.ends, start)
+            while start < end:
+                if i >= len(other.starts) or other.starts[i] >= end:
+                    yield (start, end)
+                    break
+                if other.starts[i] > start:
+                    yield (start, other.starts[i])
+                start = max(start, other.ends[i])
+                i += 1
+
+    def chunks(self, size, exclude=None):
+        '''iterate over (offset, length) pieces of at most size, skipping
+        anything in the exclude set'''
+        if exclude is None:
+            ranges = iter(self)
+        else:
+            ranges = self.difference(exclude)
+        for (start, end) in ranges:
+            while start < end:
+                length = min(size, end - start)
+                yield (start, length)
+                start += length
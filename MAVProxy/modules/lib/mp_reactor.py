@@ -0,0 +1,139 @@
+'''
+event driven I/O reactor for the MAVProxy main loop
+
+File descriptors are registered with a selectors based poller only
+when the set of links, outputs or extra descriptors changes, and ready
+descriptors are dispatched with a single dictionary lookup. Periodic
+work is run from timers rather than on every pass of the loop.
+
+AP_FLAKE8_CLEAN
+'''
+
+import heapq
+import os
+import selectors
+import time
+
+
+def fd_identity(fd):
+    '''return what fd refers to, so a closed and reopened fd with the same
+    number can be told apart. None if fd is not open, or can't be
+    checked, as for sockets on Windows'''
+    try:
+        st = os.fstat(fd)
+    except (OSError, ValueError, TypeError):
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class MPReactor(object):
+    '''map file descriptors to read handlers and run periodic timers'''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # fd -> (fn, arg, owner)
+        self.handlers = {}
+        # fd -> fd_identity() when registered
+        self.identities = {}
+        self.timers = []
+        self.timer_seq = 0
+        self.dirty = True
+
+    def mark_dirty(self):
+        '''note that the set of file descriptors may have changed'''
+        self.dirty = True
+
+    def sync(self, wanted):
+        '''make the registered descriptors match wanted, a dict of
+        fd -> (fn, arg, owner). Only differences touch the poller. The
+        kernel drops a closed fd from the poller, so an fd which now refers
+        to a different file is registered again. Where the identity of
+        an fd can't be checked only the owner is compared'''
+        self.dirty = False
+        for fd in list(self.handlers.keys()):
+            h = wanted.get(fd, None)
+            if h is not None and h[2] is self.handlers[fd][2]:
+                registered = self.identities.get(fd, None)
+                if registered is None or registered == fd_identity(fd):
+                    continue
+            self.unregister(fd)
+        for fd in wanted:
+            if fd in self.handlers:
+                continue
+            self.register(fd, wanted[fd][0], wanted[fd][1], wanted[fd][2])
+
+    def register(self, fd, fn, arg, owner=None):
+        '''call fn(arg) when fd becomes readable'''
+        try:
+            self.selector.register(fd, selectors.EVENT_READ)
+        except (KeyError, ValueError, OSError):
+            # stale registration from a closed and reused fd
+            self.unregister(fd)
+            try:
+                self.selector.register(fd, selectors.EVENT_READ)
+            except (KeyError, ValueError, OSError):
+                return False
+        self.handlers[fd] = (fn, arg, owner)
+        self.identities[fd] = fd_identity(fd)
+        return True
+
+    def unregister(self, fd):
+        '''stop watching fd'''
+        self.handlers.pop(fd, None)
+        self.identities.pop(fd, None)
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def fd_count(self):
+        '''number of registered file descriptors'''
+        return len(self.handlers)
+
+    def add_timer(self, period, fn):
+        '''call fn() every period seconds. period may be a callable
+        returning the period, allowing it to follow a setting'''
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic(), self.timer_seq, period, fn))
+
+    def next_timeout(self, max_timeout):
+        '''time until the next timer is due, capped at max_timeout'''
+        if len(self.timers) == 0:
+            return max_timeout
+        dt = self.timers[0][0] - time.monotonic()
+        return max(0, min(dt, max_timeout))
+
+    def run_timers(self):
+        '''run all timers which are due'''
+        now = time.monotonic()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            (deadline, seq, period, fn) = heapq.heappop(self.timers)
+            interval = period() if callable(period) else period
+            # don't try to catch up on missed ticks
+            heapq.heappush(self.timers, (max(deadline + interval, now), seq, period, fn))
+            fn()
+
+    def poll(self, max_timeout):
+        '''wait for readable descriptors or the next timer. Returns a
+        list of (fd, (fn, arg, owner)) for the ready descriptors'''
+        timeout = self.next_timeout(max_timeout)
+        if len(self.handlers) == 0:
+            time.sleep(timeout)
+            return []
+        try:
+            events = self.selector.select(timeout)
+        except (OSError, ValueError):
+            # a registered fd has gone bad; force a resync
+            self.dirty = True
+            return []
+        ret = []
+        for (key, mask) in events:
+            h = self.handlers.get(key.fd, None)
+            if h is not None:
+                ret.append((key.fd, h))
+        return ret
+
+    def close(self):
+        '''release the poller'''
+        self.handlers = {}
+        self.identities = {}
+        self.selector.close()
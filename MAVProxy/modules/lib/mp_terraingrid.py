@@ -0,0 +1,155 @@
+'''
+terrain grid blocks for answering TERRAIN_REQUEST
+
+A vehicle asks for terrain as a grid of 28x32 points, 28 north and 32
+east, at grid_spacing meters starting from the south west corner given
+in the request. The grid is sent as 56 TERRAIN_DATA blocks of 4x4
+points. Whole grids are computed here in one pass over numpy arrays
+and kept in a cache keyed by (lat, lon, spacing).
+
+AP_FLAKE8_CLEAN
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+
+# points in a grid, north and east
+GRID_ROWS = 28
+GRID_COLUMNS = 32
+
+# distance in grid points between the corners of neighbouring grids,
+# as used by AP_Terrain. Neighbouring grids overlap by 4 points
+GRID_SPACING_NORTH = 24
+GRID_SPACING_EAST = 28
+
+# ArduPilot Location scaling, meters per 1e-7 degree of latitude
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+
+
+def gps_offset_array(lat, lon, east, north):
+    '''mp_util.gps_offset() for arrays of positions and offsets'''
+    lat1 = np.clip(np.radians(lat), -np.pi/2+1.0e-15, np.pi/2-1.0e-15)
+    lon1 = np.radians(lon)
+    tc = np.radians(-np.degrees(np.arctan2(east, north)))
+    d = np.sqrt(np.square(east) + np.square(north)) / mp_util.radius_of_earth
+    lat2 = np.clip(lat1 + d * np.cos(tc), -np.pi/2 + 1.0e-15, np.pi/2 - 1.0e-15)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dphi = np.log(np.tan(lat2/2+np.pi/4)/np.tan(lat1/2+np.pi/4))
+        q = np.where(np.abs(lat2-lat1) < 1.0e-15, np.cos(lat1), (lat2-lat1)/dphi)
+    dlon = -d*np.sin(tc)/q
+    lon2 = np.fmod(lon1+dlon+np.pi, 2*np.pi)-np.pi
+    return (np.degrees(lat2), np.degrees(lon2))
+
+
+def grid_points(lat, lon, spacing):
+    '''return (lats, lons) arrays of shape (GRID_ROWS, GRID_COLUMNS) for
+    a grid with its south west corner at lat/lon. Each 4x4 block is
+    offset from its own corner, matching the points sent per block'''
+    block = np.arange(GRID_ROWS * GRID_COLUMNS // 16)
+    (block_lat, block_lon) = gps_offset_array(np.full(block.shape, float(lat)), np.full(block.shape, float(lon)),
+                                              (block % 8) * spacing * 4.0, (block // 8) * spacing * 4.0)
+    (north, east) = np.meshgrid(np.arange(GRID_ROWS), np.arange(GRID_COLUMNS), indexing='ij')
+    idx = (north // 4) * 8 + east // 4
+    return gps_offset_array(block_lat[idx], block_lon[idx], (east % 4) * float(spacing), (north % 4) * float(spacing))
+
+
+def block_data(heights, bit):
+    '''return the 16 heights of a TERRAIN_DATA block from a grid'''
+    north = (bit // 8) * 4
+    east = (bit % 8) * 4
+    return heights[north:north+4, east:east+4].ravel()
+
+
+def grid_origin(lat, lon, spacing):
+    '''return the (lat, lon) in 1e7 degrees of the south west corner of
+    the grid AP_Terrain uses for a position'''
+    ref_lat = int(np.floor(lat)) * 10000000
+    ref_lon = int(np.floor(lon)) * 10000000
+    lat_e7 = int(lat * 1.0e7)
+    lon_e7 = int(lon * 1.0e7)
+    scale = max(np.cos(np.radians((ref_lat + lat_e7) * 0.5e-7)), 0.01)
+    north = (lat_e7 - ref_lat) * LOCATION_SCALING_FACTOR
+    east = (lon_e7 - ref_lon) * LOCATION_SCALING_FACTOR * scale
+    grid_north = int(north / spacing) // GRID_SPACING_NORTH * GRID_SPACING_NORTH * float(spacing)
+    grid_east = int(east / spacing) // GRID_SPACING_EAST * GRID_SPACING_EAST * float(spacing)
+    dlat = int(grid_north / LOCATION_SCALING_FACTOR)
+    scale = max(np.cos(np.radians((ref_lat + dlat * 0.5) * 1.0e-7)), 0.01)
+    dlon = int((grid_east / LOCATION_SCALING_FACTOR) / scale)
+    return (ref_lat + dlat, ref_lon + dlon)
+
+
+def path_grids(paths, spacing):
+    '''return the list of grid corners AP_Terrain would use along a list
+    of paths of (lat, lon), including the grids either side'''
+    step = spacing * 4.0
+    size_north = GRID_SPACING_NORTH * spacing
+    size_east = GRID_SPACING_EAST * spacing
+    ret = []
+    seen = set()
+    for path in paths:
+        points = []
+        for i in range(len(path)):
+            points.append(path[i])
+            if i + 1 == len(path):
+                break
+            (lat1, lon1) = path[i]
+            (lat2, lon2) = path[i+1]
+            n = int(mp_util.gps_distance(lat1, lon1, lat2, lon2) / step)
+            for j in range(1, n+1):
+                points.append((lat1 + (lat2-lat1) * j / (n+1), lon1 + (lon2-lon1) * j / (n+1)))
+        for (lat, lon) in points:
+            for dn in [-1, 0, 1]:
+                for de in [-1, 0, 1]:
+                    (lat2, lon2) = mp_util.gps_offset(lat, lon, de * size_east, dn * size_north)
+                    origin = grid_origin(lat2, lon2, spacing)
+                    if origin not in seen:
+                        seen.add(origin)
+                        ret.append(origin)
+    return ret
+
+
+class TerrainGridCache(object):
+    '''heights of whole grids, in least recently used order'''
+    def __init__(self, elevation_model, max_grids=500):
+        self.elevation_model = elevation_model
+        self.max_grids = max_grids
+        self.grids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, lat, lon, spacing):
+        '''return the heights of the grid with its corner at lat/lon in
+        1e7 degrees, with NaN where terrain is not yet available'''
+        key = (lat, lon, spacing)
+        heights = self.grids.get(key, None)
+        if heights is not None:
+            self.grids.move_to_end(key)
+            if not np.isnan(heights).any():
+                self.hits += 1
+                return heights
+            # fill in points from tiles which have arrived since
+            missing = np.isnan(heights)
+            (lats, lons) = grid_points(lat * 1.0e-7, lon * 1.0e-7, spacing)
+            heights[missing] = self.elevation_model.GetElevationArray(lats[missing], lons[missing])
+            return heights
+        self.misses += 1
+        (lats, lons) = grid_points(lat * 1.0e-7, lon * 1.0e-7, spacing)
+        heights = self.elevation_model.GetElevationArray(lats, lons)
+        self.grids[key] = heights
+        while len(self.grids) > self.max_grids:
+            self.grids.popitem(last=False)
+        return heights
+
+    def complete(self, lat, lon, spacing):
+        '''return True if a grid is cached with all its heights'''
+        heights = self.grids.get((lat, lon, spacing), None)
+        return heights is not None and not np.isnan(heights).any()
+
+    def clear(self):
+        self.grids.clear()
+
+    def status(self):
+        return "grids cached: %u hits: %u misses: %u" % (len(self.grids), self.hits, self.misses)
@@ -65,8 +65,8 @@ import platform, os, sys
 # As of Python 3.8 the default start method for macOS is spawn and billiard is not required.
 if ((platform.system() == 'Darwin' or os.environ.get('USE_BILLIARD',None) is not None)
     and sys.version_info < (3, 8)):
-    from billiard import Process, forking_enable, freeze_support, Pipe, Semaphore, Event, Lock
+    from billiard import Process, forking_enable, freeze_support, Pipe, Semaphore, Event, Lock, Pool
     forking_enable(False)
     Queue = PipeQueue
 else:
-    from multiprocessing import Process, freeze_support, Pipe, Semaphore, Event, Lock, Queue
+    from multiprocessing import Process, freeze_support, Pipe, Semaphore, Event, Lock, Queue, Pool
@@ -0,0 +1,183 @@
+'''
+on-disk cache of vehicle parameters
+
+Parameters are stored by index for each vehicle so that on reconnect a
+small sample of parameters can be fetched and compared against the cache
+instead of downloading the full set.
+
+AP_FLAKE8_CLEAN
+'''
+
+import fnmatch
+import json
+import os
+import struct
+
+from MAVProxy.modules.lib import mp_util
+
+# parameters which the vehicle changes itself, at boot, while running or
+# when calibrating, so can't be used to validate the cache. They are
+# fetched from the vehicle after the cache is used
+VOLATILE_PARAMS = [
+    # ArduPilot statistics and boot time state
+    'STAT_*',
+    'BARO*_GND_PRESS',
+    'BARO*_DEVID',
+    # learnt or calibrated sensor offsets and detected sensor ids
+    'INS_GYR*OFFS_*',
+    'INS_ACC*OFFS_*',
+    'INS_ACC*SCAL_*',
+    'INS_GYR*_ID',
+    'INS_ACC*_ID',
+    'INS_TCAL*',
+    'COMPASS_OFS*',
+    'COMPASS_DIA*',
+    'COMPASS_ODI*',
+    'COMPASS_MOT*',
+    'COMPASS_SCALE*',
+    'COMPASS_DEV_ID*',
+    'COMPASS_PRIO*',
+    'AHRS_TRIM_*',
+    # PX4 flight time and calibration
+    'LND_FLIGHT_T_*',
+    'CAL_*',
+]
+
+
+def is_volatile(name):
+    '''return True if a parameter is expected to change by itself'''
+    for p in VOLATILE_PARAMS:
+        if fnmatch.fnmatch(name, p):
+            return True
+    return False
+
+
+def same_value(v1, v2):
+    '''compare two parameter values as sent over MAVLink'''
+    try:
+        return struct.pack('<f', v1) == struct.pack('<f', v2)
+    except (struct.error, TypeError):
+        return v1 == v2
+
+
+def autopilot_identity(m):
+    '''return a string identifying a board and firmware from an
+    AUTOPILOT_VERSION message'''
+    uid = m.uid
+    uid2 = getattr(m, 'uid2', None)
+    if uid == 0 and uid2 is not None and any(uid2):
+        uid = bytes(uid2).hex()
+    else:
+        uid = "%016x" % uid
+    return "%08x_%08x_%s" % (m.board_version, m.flight_sw_version, uid)
+
+
+class ParamCache(object):
+    '''parameters of one vehicle, by index'''
+    def __init__(self, sysid, identity=None):
+        self.sysid = sysid
+        self.identity = identity
+        self.names = []
+        self.values = []
+        self.index = {}
+        # MAV_PARAM_TYPE of parameters which need it for param set
+        self.types = {}
+        self.dirty = False
+
+    def filename(self):
+        '''path of the cache file'''
+        fname = 'params_%u_%u' % self.sysid
+        if self.identity is not None:
+            fname += '_' + self.identity
+        return os.path.join(mp_util.dot_mavproxy('paramcache'), fname + '.json')
+
+    def count(self):
+        return len(self.names)
+
+    def load(self):
+        '''load the cache file, returning True if there is a usable cache'''
+        try:
+            with open(self.filename(), 'r') as f:
+                d = json.load(f)
+            names = [str(p[0]) for p in d['params']]
+            values = [p[1] for p in d['params']]
+            types = {str(k): int(v) for (k, v) in d.get('types', {}).items()}
+        except (IOError, OSError, ValueError, KeyError, IndexError, TypeError):
+            return False
+        if len(names) != d.get('count', -1) or len(names) == 0:
+            return False
+        self.names = names
+        self.values = values
+        self.index = {name: i for (i, name) in enumerate(names)}
+        self.types = types
+        self.dirty = False
+        return True
+
+    def save(self):
+        '''save the cache file'''
+        if len(self.names) == 0:
+            return
+        filename = self.filename()
+        mp_util.mkdir_p(os.path.dirname(filename))
+        d = {
+            'sysid': list(self.sysid),
+            'identity': self.identity,
+            'count': len(self.names),
+            'params': [[n, v] for (n, v) in zip(self.names, self.values)],
+            'types': self.types,
+        }
+        tmpname = filename + '.tmp'
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(d, f)
+            os.replace(tmpname, filename)
+        except (IOError, OSError) as ex:
+            print("Failed to save parameter cache %s: %s" % (filename, ex))
+            return
+        self.dirty = False
+
+    def set_all(self, names, values, types):
+        '''replace the cache with a full parameter set, in index order'''
+        self.names = list(names)
+        self.values = list(values)
+        self.index = {name: i for (i, name) in enumerate(self.names)}
+        self.types = dict(types)
+        self.dirty = True
+
+    def update(self, name, value):
+        '''update the value of a cached parameter'''
+        i = self.index.get(name, None)
+        if i is None or same_value(self.values[i], value):
+            return
+        self.values[i] = value
+        if not is_volatile(name):
+            self.dirty = True
+
+    def sample(self, n):
+        '''return up to n evenly spaced indexes of non-volatile parameters,
+        always including the last of them'''
+        indexes = [i for (i, name) in enumerate(self.names) if not is_volatile(name)]
+        if len(indexes) <= n:
+            return indexes
+        step = len(indexes) / float(n)
+        ret = set(indexes[int(i * step)] for i in range(n - 1))
+        ret.add(indexes[-1])
+        return sorted(ret)
+
+    def check(self, index, name, value, count):
+        '''check a parameter received from the vehicle against the cache'''
+        if count != len(self.names) or index < 0 or index >= len(self.names):
+            return False
+        return self.names[index] == name and same_value(self.values[index], value)
+
+    def volatile(self):
+        '''return indexes of volatile parameters'''
+        return [i for (i, name) in enumerate(self.names) if is_volatile(name)]
+
+    def changed(self, names, values):
+        '''return the names of parameters in a full set from the vehicle
+        which differ from the cache, or None if the list of parameters
+        is different'''
+        if list(names) != self.names:
+            return None
+        return [n for (n, v, cv) in zip(names, values, self.values) if not same_value(v, cv)]
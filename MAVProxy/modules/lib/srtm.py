@@ -18,9 +18,10 @@ import re
 import pickle
 import os.path
 import os
+import threading
 import zipfile
-import array
 import math
+import numpy
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -258,6 +259,15 @@ class SRTMDownloader():
         """Get a SRTM tile object. This function can return either an SRTM1 or
             SRTM3 object depending on what is available, however currently it
             only returns SRTM3 objects."""
+        tile = self.getTileFile(lat, lon)
+        if isinstance(tile, str):
+            return self.loadTileFile(tile, lat, lon)
+        return tile
+
+    def getTileFile(self, lat, lon):
+        """Find the file of a SRTM tile, starting its download if needed.
+            Returns the path of the zip, an ocean tile, or 0 if the tile
+            isn't available yet. Unlike getTile() this never unzips."""
         global childFileListDownload
         global filelistDownloadActive
         mypid = os.getpid()
@@ -299,13 +309,31 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
+        return os.path.join(self.cachedir, filename)
+
+    def loadTileFile(self, f, lat, lon):
+        """Load a tile from a file returned by getTileFile(), returning 0 if
+            it is invalid."""
         # TODO: Currently we create a new tile object each time.
         # Caching is required for improved performance.
         try:
-            return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
+            return SRTMTile(f, int(lat), int(lon))
         except InvalidTileError:
             return 0
 
+    def hasLocalTile(self, lat, lon):
+        """Return True if getTile() can return a tile without downloading
+            anything."""
+        try:
+            continent, filename = self.filelist[(int(lat), int(lon))]
+        except KeyError:
+            # a full filelist without the tile means ocean
+            return len(self.filelist) > self.min_filelist_len
+        mypid = os.getpid()
+        if mypid in childTileDownload and childTileDownload[mypid].is_alive():
+            return False
+        return os.path.exists(os.path.join(self.cachedir, filename))
+
     def downloadTile(self, continent, filename):
         #Use HTTP
         mp_util.child_close_fds()
@@ -327,6 +355,20 @@ class SRTMDownloader():
             pass
 
 
+# Currently only SRTM1/3 is supported
+TILE_SIZES = (1201, 3601)
+
+# the samples of unzipped tiles are cached as little endian int16
+RAW_DTYPE = numpy.dtype('<i2')
+
+
+def raw_cache_filename(f):
+    """Name of the uncompressed cache of a .hgt.zip tile"""
+    if f.endswith('.zip'):
+        f = f[:-4]
+    return f + '.raw'
+
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -334,8 +376,17 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The first time a tile is used it is unzipped to a raw file next
+        to the zip, and later loads memory map that file instead.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        rawname = raw_cache_filename(f)
+        self.data = self.loadRaw(rawname, f)
+        if self.data is not None:
+            return
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
@@ -345,15 +396,44 @@ class SRTMTile:
             raise InvalidTileError(lat, lon)
         data = zipf.read(names[0])
         self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
+        if self.size not in TILE_SIZES or len(data) != self.size * self.size * 2:
             raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        # hgt files are big endian
+        self.data = numpy.frombuffer(data, dtype='>i2').astype(RAW_DTYPE)
+        if self.saveRaw(rawname):
+            self.data = self.loadRaw(rawname, f)
+
+    def loadRaw(self, rawname, zipname):
+        """Memory map the raw cache of a tile, returning None if it is
+            missing, the wrong size or older than the zip."""
+        try:
+            rawsize = os.path.getsize(rawname)
+            if os.path.getmtime(rawname) < os.path.getmtime(zipname):
+                return None
+        except OSError:
+            return None
+        for size in TILE_SIZES:
+            if rawsize == size * size * RAW_DTYPE.itemsize:
+                self.size = size
+                try:
+                    return numpy.memmap(rawname, dtype=RAW_DTYPE, mode='r')
+                except (OSError, ValueError):
+                    return None
+        return None
+
+    def saveRaw(self, rawname):
+        """Write the raw cache of a tile, returning False on failure."""
+        tmpname = rawname + '.tmp%u_%u' % (os.getpid(), threading.get_ident())
+        try:
+            self.data.tofile(tmpname)
+            os.replace(tmpname, rawname)
+        except OSError:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return False
+        return True
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -395,7 +475,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -430,6 +510,40 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of arrays of lat/lon, all within this tile,
+            with the same interpolation as getAltitudeFromLatLon.
+        """
+        lat = numpy.asarray(lats, dtype=float) - self.lat
+        lon = numpy.asarray(lons, dtype=float) - self.lon
+        if lat.size == 0:
+            return numpy.zeros(lat.shape)
+        if lat.min() < 0.0 or lat.max() >= 1.0 or lon.min() < 0.0 or lon.max() >= 1.0:
+            bad = numpy.flatnonzero((lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0))[0]
+            raise WrongTileError(self.lat, self.lon, self.lat+lat.flat[bad], self.lon+lon.flat[bad])
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(int)
+        y_int = y.astype(int)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        # offset of (x_int, y_int), the row above is at lower offsets
+        offset = x_int + self.size * (self.size - y_int - 1)
+        value00 = self._pixelArray(offset)
+        value10 = self._pixelArray(offset + 1)
+        value01 = self._pixelArray(offset - self.size)
+        value11 = self._pixelArray(offset - self.size + 1)
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
+    def _pixelArray(self, offsets):
+        """Pixel values at an array of offsets, handling voids as
+            getPixelValue does."""
+        values = self.data[offsets].astype(float)
+        values[values == -32768] = -1
+        return values
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -439,6 +553,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
@@ -106,6 +106,8 @@ class ADSBModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support", public = True)
+        self.subscribe_mavlink(['ADSB_VEHICLE'])
+        self.set_idle_rate(10)
         self.threat_vehicles = {}
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
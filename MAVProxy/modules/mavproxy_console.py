@@ -29,6 +29,7 @@ class DisplayItem:
 class ConsoleModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(ConsoleModule, self).__init__(mpstate, "console", "GUI console", public=True, multi_vehicle=True)
+        self.set_idle_rate(2)
         self.in_air = False
         self.start_time = 0.0
         self.total_time = 0.0
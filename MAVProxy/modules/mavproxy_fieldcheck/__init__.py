@@ -516,6 +516,7 @@ class FieldCheckModule(mp_module.MPModule):
                                                "FieldCheck",
                                                "FieldCheck Checks",
                                                public=True)
+        self.set_idle_rate(2)
 
         self.fields = [
             FieldCMAC(),
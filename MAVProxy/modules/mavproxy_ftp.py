@@ -5,6 +5,7 @@ import io
 import time, os, sys
 import struct
 import random
+import itertools
 from pymavlink import mavutil
 
 try:
@@ -16,6 +17,7 @@ except ImportError:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.mp_rangeset import RangeSet
 
 # opcodes
 OP_None = 0
@@ -37,6 +39,10 @@ OP_BurstReadFile = 15
 OP_Ack = 128
 OP_Nack = 129
 
+# limits on the gap read retry timeout
+MIN_RTO = 0.1
+MAX_RTO = 5.0
+
 # error codes
 ERR_None = 0
 ERR_Fail = 1
@@ -94,49 +100,41 @@ class WriteQueue:
         self.size = size
         self.last_send = 0
 
-class FTPModule(mp_module.MPModule):
-    def __init__(self, mpstate):
-        super(FTPModule, self).__init__(mpstate, "ftp", public=True)
-        self.add_command('ftp', self.cmd_ftp, "file transfer",
-                         ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
-                          "set (FTPSETTING)",
-                          "put (FILENAME) (FILENAME)"])
-        self.ftp_settings = mp_settings.MPSettings(
-            [('debug', int, 0),
-             ('pkt_loss_tx', int, 0),
-             ('pkt_loss_rx', int, 0),
-             ('max_backlog', int, 5),
-             ('burst_read_size', int, 80),
-             ('write_size', int, 80),
-             ('write_qsize', int, 5),
-             ('retry_time', float, 0.5)])
-        self.add_completion_function('(FTPSETTING)',
-                                     self.ftp_settings.completion)
-        self.seq = 0
-        self.session = 0
-        self.network = 0
+class FTPTransfer:
+    '''state of one get or put, using its own FTP session'''
+    def __init__(self, module, kind, remote_name, target_system, target_component):
+        self.module = module
+        self.ftp_settings = module.ftp_settings
+        self.kind = kind
+        self.remote_name = remote_name
+        self.target_system = target_system
+        self.target_component = target_component
+        self.session = None
         self.last_op = None
+        self.last_op_time = time.time()
         self.fh = None
         self.filename = None
         self.callback = None
         self.callback_progress = None
         self.put_callback = None
         self.put_callback_progress = None
-        self.total_size = 0
-        self.read_gaps = []
-        self.read_gap_times = {}
-        self.last_gap_send = 0
+        # byte ranges not yet received
+        self.read_gaps = RangeSet()
+        # gap reads in flight, offset -> (length, send_time, retry)
+        self.read_requests = {}
+        self.read_outstanding = RangeSet()
+        self.read_requested = RangeSet()
         self.read_retries = 0
         self.read_total = 0
         self.duplicates = 0
-        self.last_read = None
         self.last_burst_read = None
+        # offset of a burst read held back by the rate limit
+        self.burst_wait = None
         self.op_start = None
-        self.dir_offset = 0
-        self.last_op_time = time.time()
+        self.open_retries = 0
         self.rtt = 0.5
         self.reached_eof = False
-        self.backlog = 0
+        self.reset_read_window()
         self.burst_size = self.ftp_settings.burst_read_size
         self.write_list = None
         self.write_block_size = 0
@@ -147,62 +145,30 @@ class FTPModule(mp_module.MPModule):
         self.write_recv_idx = -1
         self.write_pending = 0
         self.write_last_send = None
-        self.warned_component = False
-
-    def cmd_ftp(self, args):
-        '''FTP operations'''
-        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc>"
-        if len(args) < 1:
-            print(usage)
-            return
-        if args[0] == 'list':
-            self.cmd_list(args[1:])
-        elif args[0] == "set":
-            self.ftp_settings.command(args[1:])
-        elif args[0] == 'get':
-            self.cmd_get(args[1:])
-        elif args[0] == 'put':
-            self.cmd_put(args[1:])
-        elif args[0] == 'rm':
-            self.cmd_rm(args[1:])
-        elif args[0] == 'rmdir':
-            self.cmd_rmdir(args[1:])
-        elif args[0] == 'rename':
-            self.cmd_rename(args[1:])
-        elif args[0] == 'mkdir':
-            self.cmd_mkdir(args[1:])
-        elif args[0] == 'crc':
-            self.cmd_crc(args[1:])
-        elif args[0] == 'status':
-            self.cmd_status()
-        elif args[0] == 'cancel':
-            self.cmd_cancel()
-        else:
-            print(usage)
 
     def send(self, op):
-        '''send a request'''
-        op.seq = self.seq
-        payload = op.pack()
-        plen = len(payload)
-        if plen < MAX_Payload + HDR_Len:
-            payload.extend(bytearray([0]*((HDR_Len+MAX_Payload)-plen)))
-        if self.master is None:
-            print("FTP: Can't send request, no master...")
-            return
-        self.master.mav.file_transfer_protocol_send(self.network, self.target_system, self.target_component, payload)
-        self.seq = (self.seq + 1) % 256
+        '''send a request in this session'''
+        op.session = self.session
+        self.module.send(op, self)
         self.last_op = op
-        now = time.time()
-        if self.ftp_settings.debug > 1:
-            print("> %s dt=%.2f" % (op, now - self.last_op_time))
         self.last_op_time = time.time()
 
-    def terminate_session(self):
-        '''terminate current session'''
-        self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
+    def start(self):
+        '''open the file on the vehicle'''
+        self.op_start = time.time()
+        self.open_retries = 0
+        enc_fname = bytearray(self.remote_name if self.kind == 'get' else self.filename, 'ascii')
+        if self.kind == 'get':
+            opcode = OP_OpenFileRO
+        else:
+            opcode = OP_CreateFile
+        self.send(FTP_OP(self.module.seq, self.session, opcode, len(enc_fname), 0, 0, 0, enc_fname))
+
+    def terminate(self):
+        '''end the session, telling the caller if the transfer failed'''
+        if self.session is not None:
+            self.send(FTP_OP(self.module.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
         self.fh = None
-        self.filename = None
         self.write_list = None
         if self.callback is not None:
             # tell caller that the transfer failed
@@ -215,99 +181,38 @@ class FTPModule(mp_module.MPModule):
         if self.put_callback_progress is not None:
             self.put_callback_progress(None)
             self.put_callback_progress = None
-        self.read_gaps = []
-        self.read_total = 0
-        self.read_gap_times = {}
-        self.last_read = None
-        self.last_burst_read = None
-        self.session = (self.session + 1) % 256
-        self.reached_eof = False
-        self.backlog = 0
-        self.duplicates = 0
+        self.module.transfer_done(self)
         if self.ftp_settings.debug > 0:
-            print("Terminated session")
+            print("Terminated session %s" % self.session)
 
-    def cmd_list(self, args):
-        '''list files'''
-        if len(args) > 0:
-            dname = args[0]
-        else:
-            dname = '/'
-        print("Listing %s" % dname)
-        enc_dname = bytearray(dname, 'ascii')
-        self.total_size = 0
-        self.dir_offset = 0
-        op = FTP_OP(self.seq, self.session, OP_ListDirectory, len(enc_dname), 0, 0, self.dir_offset, enc_dname)
-        self.send(op)
+    def handle_reply(self, op, m, dt):
+        '''handle a reply in this session'''
+        if self.last_op is not None and op.req_opcode == self.last_op.opcode and op.seq == (self.last_op.seq + 1) % 256:
+            self.rtt = max(min(self.rtt, dt), 0.01)
+        if op.req_opcode == OP_OpenFileRO:
+            self.handle_open_RO_reply(op, m)
+        elif op.req_opcode == OP_BurstReadFile:
+            self.handle_burst_read(op, m)
+        elif op.req_opcode == OP_ReadFile:
+            self.handle_reply_read(op, m)
+        elif op.req_opcode == OP_CreateFile:
+            self.handle_create_file_reply(op, m)
+        elif op.req_opcode == OP_WriteFile:
+            self.handle_write_reply(op, m)
 
-    def handle_list_reply(self, op, m):
-        '''handle OP_ListDirectory reply'''
-        if op.opcode == OP_Ack:
-            dentries = sorted(op.payload.split(b'\x00'))
-            #print(dentries)
-            for d in dentries:
-                if len(d) == 0:
-                    continue
-                self.dir_offset += 1
-                try:
-                    if sys.version_info.major >= 3:
-                        d = str(d, 'ascii')
-                    else:
-                        d = str(d)
-                except Exception:
-                    continue
-                if d[0] == 'D':
-                    print(" D %s" % d[1:])
-                elif d[0] == 'F':
-                    (name, size) = d[1:].split('\t')
-                    size = int(size)
-                    self.total_size += size
-                    print("   %s\t%u" % (name, size))
-                else:
-                    print(d)
-            # ask for more
-            more = self.last_op
-            more.offset = self.dir_offset
-            self.send(more)
-        elif op.opcode == OP_Nack and len(op.payload) == 1 and op.payload[0] == ERR_EndOfFile:
-            print("Total size %.2f kByte" % (self.total_size / 1024.0))
-            self.total_size = 0
-        else:
-            print('LIST: %s' % op)
-
-    def cmd_get(self, args, callback=None, callback_progress=None):
-        '''get file'''
-        if len(args) == 0:
-            print("Usage: get FILENAME <LOCALNAME>")
-            return
-        self.terminate_session()
-        fname = args[0]
-        if len(args) > 1:
-            self.filename = args[1]
-        else:
-            self.filename = os.path.basename(fname)
-        if callback is None or self.ftp_settings.debug > 1:
-            print("Getting %s as %s" % (fname, self.filename))
-        self.op_start = time.time()
-        self.callback = callback
-        self.callback_progress = callback_progress
-        self.read_retries = 0
-        self.duplicates = 0
-        self.reached_eof = False
-        self.burst_size = self.ftp_settings.burst_read_size
-        if self.burst_size < 1:
-            self.burst_size = 239
-        elif self.burst_size > 239:
-            self.burst_size = 239
-        enc_fname = bytearray(fname, 'ascii')
-        self.open_retries = 0
-        op = FTP_OP(self.seq, self.session, OP_OpenFileRO, len(enc_fname), 0, 0, 0, enc_fname)
-        self.send(op)
+    def no_sessions(self, op):
+        '''return True if the vehicle refused to open another session, in
+        which case the transfer has been queued again'''
+        if op.opcode != OP_Nack or len(op.payload) == 0:
+            return False
+        if op.payload[0] not in [ERR_NoSessionsAvailable, ERR_InvalidSession]:
+            return False
+        return self.module.requeue(self)
 
     def handle_open_RO_reply(self, op, m):
         '''handle OP_OpenFileRO reply'''
         if op.opcode == OP_Ack:
-            if self.filename is None:
+            if self.filename is None or self.fh is not None:
                 return
             try:
                 if self.callback is not None or self.filename == '-':
@@ -316,15 +221,17 @@ class FTPModule(mp_module.MPModule):
                     self.fh = open(self.filename, 'wb')
             except Exception as ex:
                 print("Failed to open %s: %s" % (self.filename, ex))
-                self.terminate_session()
+                self.terminate()
                 return
-            read = FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, 0, None)
+            read = FTP_OP(self.module.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, 0, None)
             self.last_burst_read = time.time()
             self.send(read)
+        elif self.no_sessions(op):
+            return
         else:
             if self.callback is None or self.ftp_settings.debug > 0:
                 print("ftp open failed")
-            self.terminate_session()
+            self.terminate()
 
     def check_read_finished(self):
         '''check if download has completed'''
@@ -344,18 +251,45 @@ class FTPModule(mp_module.MPModule):
                     print(self.fh.read().decode('utf-8'))
             else:
                 print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (ofs, self.filename, dt, rate))
-            self.terminate_session()
+            self.terminate()
             return True
         return False
 
-    def write_payload(self, op):
-        '''write payload from a read op'''
+    def write_payload(self, op, size=None):
+        '''write payload from a read op. size is the number of bytes not
+        already received'''
         self.fh.seek(op.offset)
         self.fh.write(op.payload)
-        self.read_total += len(op.payload)
+        if size is None:
+            size = len(op.payload)
+        self.read_total += size
+        self.module.use_allowance(len(op.payload))
         if self.callback_progress is not None:
             self.callback_progress(self.fh, self.read_total)
-    
+
+    def fill_gap(self, op):
+        '''write a reply for an earlier part of the file, returning False
+        if all of it has already been received'''
+        end = op.offset + len(op.payload)
+        if not self.read_gaps.overlaps(op.offset, end):
+            return False
+        ofs = self.fh.tell()
+        self.write_payload(op, self.read_gaps.remove(op.offset, end))
+        self.fh.seek(max(ofs, end))
+        if self.ftp_settings.debug > 0:
+            print("FTP: filled gap at %u len %u, %u gaps eof=%s" % (op.offset, len(op.payload),
+                                                                     len(self.read_gaps), self.reached_eof))
+        return True
+
+    def send_burst_read(self, offset):
+        '''ask for a burst of data, unless over the rate limit'''
+        if not self.module.can_send():
+            self.burst_wait = offset
+            return
+        self.burst_wait = None
+        self.last_burst_read = time.time()
+        self.send(FTP_OP(self.module.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, offset, None))
+
     def handle_burst_read(self, op, m):
         '''handle OP_BurstReadFile reply'''
         if self.ftp_settings.pkt_loss_tx > 0:
@@ -364,9 +298,6 @@ class FTPModule(mp_module.MPModule):
                     print("FTP: dropping TX")
                 return
         if self.fh is None or self.filename is None:
-            if op.session != self.session:
-                # old session
-                return
             print("FTP Unexpected burst read reply")
             print(op)
             return
@@ -380,35 +311,17 @@ class FTPModule(mp_module.MPModule):
         if op.opcode == OP_Ack and self.fh is not None:
             ofs = self.fh.tell()
             if op.offset < ofs:
-                # writing an earlier portion, possibly remove a gap
-                gap = (op.offset, len(op.payload))
-                if gap in self.read_gaps:
-                    self.read_gaps.remove(gap)
-                    self.read_gap_times.pop(gap)
-                    if self.ftp_settings.debug > 0:
-                        print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
-                else:
+                # writing an earlier portion, possibly filling a gap
+                if not self.fill_gap(op):
                     if self.ftp_settings.debug > 0:
                         print("FTP: dup read reply at %u of len %u ofs=%u" % (op.offset, op.size, self.fh.tell()))
                     self.duplicates += 1
                     return
-                self.write_payload(op)
-                self.fh.seek(ofs)
                 if self.check_read_finished():
                     return
             elif op.offset > ofs:
                 # we have a gap
-                gap = (ofs, op.offset-ofs)
-                max_read = self.burst_size
-                while True:
-                    if gap[1] <= max_read:
-                        self.read_gaps.append(gap)
-                        self.read_gap_times[gap] = 0
-                        break
-                    g = (gap[0], max_read)
-                    self.read_gaps.append(g)
-                    self.read_gap_times[g] = 0
-                    gap = (gap[0] + max_read, gap[1] - max_read)
+                self.read_gaps.add(ofs, op.offset)
                 self.write_payload(op)
             else:
                 self.write_payload(op)
@@ -423,11 +336,9 @@ class FTPModule(mp_module.MPModule):
                         return
                     self.check_read_send()
                     return
-                more = self.last_op
-                more.offset = op.offset + op.size
                 if self.ftp_settings.debug > 0:
-                    print("FTP: burst continue at %u %u" % (more.offset, self.fh.tell()))
-                self.send(more)
+                    print("FTP: burst continue at %u %u" % (op.offset + op.size, self.fh.tell()))
+                self.send_burst_read(op.offset + op.size)
         elif op.opcode == OP_Nack:
             ecode = op.payload[0]
             if self.ftp_settings.debug > 0:
@@ -441,6 +352,7 @@ class FTPModule(mp_module.MPModule):
                 if not self.reached_eof and self.ftp_settings.debug > 0:
                     print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
                 self.reached_eof = True
+                self.burst_wait = None
                 if self.check_read_finished():
                     return
                 self.check_read_send()
@@ -456,83 +368,24 @@ class FTPModule(mp_module.MPModule):
                 print("FTP Unexpected read reply")
                 print(op)
             return
-        if self.backlog > 0:
-            self.backlog -= 1
+        length = self.gap_read_reply(op.offset)
         if op.opcode == OP_Ack and self.fh is not None:
-            gap = (op.offset, op.size)
-            if gap in self.read_gaps:
-                self.read_gaps.remove(gap)
-                self.read_gap_times.pop(gap)
-                ofs = self.fh.tell()
-                self.write_payload(op)
-                self.fh.seek(ofs)
-                if self.ftp_settings.debug > 0:
-                    print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
+            if length is not None and op.size < length:
+                print("FTP: file size changed to %u" % (op.offset+op.size))
+                self.terminate()
+                return
+            if self.fill_gap(op):
                 if self.check_read_finished():
                     return
-            elif op.size < self.burst_size:
-                print("FTP: file size changed to %u" % op.offset+op.size)
-                self.terminate_session()
             else:
                 self.duplicates += 1
                 if self.ftp_settings.debug > 0:
-                    print("FTP: no gap read", gap, len(self.read_gaps))
+                    print("FTP: no gap read at %u len %u, %u gaps" % (op.offset, op.size, len(self.read_gaps)))
         elif op.opcode == OP_Nack:
             print("Read failed with %u gaps" % len(self.read_gaps), str(op))
-            self.terminate_session()
-        self.check_read_send()
-            
-    def cmd_put(self, args, fh=None, callback=None, progress_callback=None):
-        '''put file'''
-        if len(args) == 0:
-            print("Usage: put FILENAME <REMOTENAME>")
-            return
-        if self.write_list is not None:
-            print("put already in progress")
+            self.terminate()
             return
-        fname = args[0]
-        self.fh = fh
-        if self.fh is None:
-            try:
-                self.fh = open(fname, 'rb')
-            except Exception as ex:
-                print("Failed to open %s: %s" % (fname, ex))
-                return
-        if len(args) > 1:
-            self.filename = args[1]
-        else:
-            self.filename = os.path.basename(fname)
-        if self.filename.endswith("/"):
-            self.filename += os.path.basename(fname)
-        if callback is None:
-            print("Putting %s as %s" % (fname, self.filename))
-        self.fh.seek(0,2)
-        file_size = self.fh.tell()
-        self.fh.seek(0)
-
-        # setup write list
-        self.write_block_size = self.ftp_settings.write_size
-        self.write_file_size = file_size
-
-        write_blockcount = file_size // self.write_block_size
-        if file_size % self.write_block_size != 0:
-            write_blockcount += 1
-
-        self.write_list = set(range(write_blockcount))
-        self.write_acks = 0
-        self.write_total = write_blockcount
-        self.write_idx = 0
-        self.write_recv_idx = -1
-        self.write_pending = 0
-        self.write_last_send = None
-
-        self.put_callback = callback
-        self.put_callback_progress = progress_callback
-        self.read_retries = 0
-        self.op_start = time.time()
-        enc_fname = bytearray(self.filename, 'ascii')
-        op = FTP_OP(self.seq, self.session, OP_CreateFile, len(enc_fname), 0, 0, 0, enc_fname)
-        self.send(op)
+        self.check_read_send()
 
     def put_finished(self, flen):
         '''finish a put'''
@@ -544,24 +397,26 @@ class FTPModule(mp_module.MPModule):
             self.put_callback = None
         else:
             print("Sent file of length ", flen)
-        
+
     def handle_create_file_reply(self, op, m):
         '''handle OP_CreateFile reply'''
         if self.fh is None:
-            self.terminate_session()
+            self.terminate()
             return
         if op.opcode == OP_Ack:
             self.send_more_writes()
+        elif self.no_sessions(op):
+            return
         else:
             print("Create failed")
-            self.terminate_session()
+            self.terminate()
 
     def send_more_writes(self):
         '''send some more writes'''
         if len(self.write_list) == 0:
             # all done
             self.put_finished(self.write_file_size)
-            self.terminate_session()
+            self.terminate()
             return
 
         now = time.time()
@@ -572,6 +427,8 @@ class FTPModule(mp_module.MPModule):
 
         n = min(self.ftp_settings.write_qsize-self.write_pending, len(self.write_list))
         for i in range(n):
+            if not self.module.can_send():
+                break
             # send in round-robin, skipping any that have been acked
             idx = self.write_idx
             while idx not in self.write_list:
@@ -579,8 +436,9 @@ class FTPModule(mp_module.MPModule):
             ofs = idx * self.write_block_size
             self.fh.seek(ofs)
             data = self.fh.read(self.write_block_size)
-            write = FTP_OP(self.seq, self.session, OP_WriteFile, len(data), 0, 0, ofs, bytearray(data))
+            write = FTP_OP(self.module.seq, self.session, OP_WriteFile, len(data), 0, 0, ofs, bytearray(data))
             self.send(write)
+            self.module.use_allowance(len(data))
             self.write_idx = (idx + 1) % self.write_total
             self.write_pending += 1
             self.write_last_send = now
@@ -588,11 +446,11 @@ class FTPModule(mp_module.MPModule):
     def handle_write_reply(self, op, m):
         '''handle OP_WriteFile reply'''
         if self.fh is None:
-            self.terminate_session()
+            self.terminate()
             return
         if op.opcode != OP_Ack:
             print("Write failed")
-            self.terminate_session()
+            self.terminate()
             return
 
         # assume the FTP server processes the blocks sequentially. This means
@@ -609,6 +467,446 @@ class FTPModule(mp_module.MPModule):
             self.put_callback_progress(self.write_acks/float(self.write_total))
         self.send_more_writes()
 
+    def reset_read_window(self):
+        '''reset gap read timing and window for a new transfer'''
+        self.read_requests = {}
+        self.read_outstanding.clear()
+        self.read_requested.clear()
+        self.srtt = None
+        self.rttvar = 0
+        self.rto = min(max(self.ftp_settings.retry_time, MIN_RTO), MAX_RTO)
+        self.cwnd = float(max(self.ftp_settings.max_backlog, 1))
+        self.ssthresh = float(max(self.ftp_settings.max_window, 1))
+        self.last_window_cut = 0
+
+    def update_rtt(self, sample):
+        '''update the retry timeout from a gap read round trip time'''
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample * 0.5
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def gap_read_reply(self, offset):
+        '''a reply to a gap read has arrived, returning the length asked
+        for, or None if the read had already timed out'''
+        req = self.read_requests.pop(offset, None)
+        if req is None:
+            return None
+        (length, send_time, retry) = req
+        self.read_outstanding.remove(offset, offset+length)
+        if not retry:
+            # only time first sends, a reply to a resend is ambiguous
+            self.update_rtt(time.time() - send_time)
+        # grow the window, quickly up to the threshold then slowly
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, float(max(self.ftp_settings.max_window, 1)))
+        return length
+
+    def check_read_timeouts(self, now):
+        '''expire gap reads with no reply, shrinking the window'''
+        for offset in list(self.read_requests.keys()):
+            (length, send_time, retry) = self.read_requests[offset]
+            if now - send_time < self.rto:
+                continue
+            self.read_requests.pop(offset)
+            self.read_outstanding.remove(offset, offset+length)
+            self.read_retries += 1
+            if send_time > self.last_window_cut:
+                # halve the window once for each window of losses
+                self.ssthresh = max(self.cwnd * 0.5, 2.0)
+                self.cwnd = max(self.cwnd * 0.5, 2.0)
+                self.last_window_cut = now
+                if self.ftp_settings.debug > 0:
+                    print("FTP: gap read lost at %u, window %.1f timeout %.2f" % (offset, self.cwnd, self.rto))
+
+    def send_gap_read(self, offset, length):
+        '''send a read for part of a gap'''
+        if self.ftp_settings.debug > 0:
+            print("Gap read of %u at %u rem=%u outstanding=%u" % (length, offset, len(self.read_gaps), len(self.read_requests)))
+        read = FTP_OP(self.module.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
+        self.send(read)
+        retry = self.read_requested.overlaps(offset, offset+length)
+        self.read_requests[offset] = (length, time.time(), retry)
+        self.read_outstanding.add(offset, offset+length)
+        self.read_requested.add(offset, offset+length)
+
+    def check_read_send(self):
+        '''send gap reads, lowest offset first, while the window allows'''
+        if len(self.read_gaps) == 0:
+            return
+        self.check_read_timeouts(time.time())
+        if not self.module.can_send():
+            return
+        count = int(self.cwnd) - len(self.read_requests)
+        if count <= 0:
+            return
+        reads = list(itertools.islice(self.read_gaps.chunks(self.burst_size, self.read_outstanding), count))
+        for (offset, length) in reads:
+            self.send_gap_read(offset, length)
+
+    def idle_task(self, now):
+        '''check for file gaps and lost requests'''
+        # see if we lost an open reply
+        if self.fh is None and self.kind == 'get' and now - self.op_start > 1.0:
+            self.op_start = now
+            self.open_retries += 1
+            if self.open_retries > 2:
+                # fail the get
+                self.terminate()
+                return
+            if self.ftp_settings.debug > 0:
+                print("FTP: retry open")
+            self.send(self.last_op)
+            return
+
+        if self.fh is None:
+            return
+
+        if self.burst_wait is not None:
+            self.send_burst_read(self.burst_wait)
+
+        # see if burst read has stalled. Other sessions with the vehicle
+        # share the link, so allow longer between packets
+        stall_time = max(self.ftp_settings.retry_time * self.module.active_sessions(self.target_system), self.rto)
+        if (self.kind == 'get' and not self.reached_eof and self.burst_wait is None and
+                self.last_burst_read is not None and now - self.last_burst_read > stall_time):
+            dt = now - self.last_burst_read
+            if self.ftp_settings.debug > 0:
+                print("Retry read at %u rtt=%.2f dt=%.2f" % (self.fh.tell(), self.rtt, dt))
+            self.send_burst_read(self.fh.tell())
+            self.read_retries += 1
+
+        # see if we can fill gaps
+        self.check_read_send()
+
+        if self.write_list is not None:
+            self.send_more_writes()
+
+    def status(self):
+        '''return a status string'''
+        if self.kind == 'get':
+            desc = "get %s as %s" % (self.remote_name, self.filename)
+        else:
+            desc = "put %s as %s" % (self.remote_name, self.filename)
+        if self.session is None:
+            return "queued: %s sysid %u" % (desc, self.target_system)
+        if self.fh is None:
+            return "session %u: %s opening" % (self.session, desc)
+        dt = max(time.time() - self.op_start, 0.001)
+        if self.kind == 'put':
+            return "session %u: %s %u/%u blocks %.1f kByte/sec" % (
+                self.session, desc, self.write_acks, self.write_total,
+                (self.write_acks * self.write_block_size / dt) / 1024.0)
+        ofs = self.fh.tell()
+        ret = "session %u: %s at offset %u with %u gaps (%u bytes) %u retries %.1f kByte/sec" % (
+            self.session, desc, ofs, len(self.read_gaps), self.read_gaps.total(), self.read_retries,
+            (self.read_total / dt) / 1024.0)
+        if len(self.read_gaps) > 0 or len(self.read_requests) > 0:
+            srtt = self.srtt if self.srtt is not None else 0
+            ret += "\n  gap reads: %u outstanding window %.1f srtt %.2fs timeout %.2fs" % (
+                len(self.read_requests), self.cwnd, srtt, self.rto)
+        return ret
+
+
+# requests which belong to a transfer session
+TRANSFER_OPCODES = set([OP_OpenFileRO, OP_BurstReadFile, OP_ReadFile, OP_CreateFile, OP_WriteFile, OP_TerminateSession])
+
+class FTPModule(mp_module.MPModule):
+    def __init__(self, mpstate):
+        super(FTPModule, self).__init__(mpstate, "ftp", public=True)
+        self.add_command('ftp', self.cmd_ftp, "file transfer",
+                         ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
+                          "set (FTPSETTING)",
+                          "put (FILENAME) (FILENAME)"])
+        self.ftp_settings = mp_settings.MPSettings(
+            [('debug', int, 0),
+             ('pkt_loss_tx', int, 0),
+             ('pkt_loss_rx', int, 0),
+             ('max_backlog', int, 5),
+             ('max_window', int, 32),
+             ('max_sessions', int, 2),
+             ('max_rate', float, 0),
+             ('burst_read_size', int, 80),
+             ('write_size', int, 80),
+             ('write_qsize', int, 5),
+             ('retry_time', float, 0.5)])
+        self.add_completion_function('(FTPSETTING)',
+                                     self.ftp_settings.completion)
+        self.seq = 0
+        # session used for list, crc and other single requests. Transfers
+        # use sessions 1 to 255
+        self.session = 0
+        self.network = 0
+        self.last_op = None
+        self.last_op_time = time.time()
+        self.total_size = 0
+        self.dir_offset = 0
+        self.crc_name = None
+        self.crc_start = None
+        # active transfers by session id, and transfers waiting to start
+        self.sessions = {}
+        self.queue = []
+        self.next_session = 1
+        self.next_idle = 0
+        # sessions a vehicle has accepted at once, learnt from refusals
+        self.session_limit = {}
+        # bytes which may be transferred before the rate limit applies
+        self.allowance = 0
+        self.last_allowance_time = time.time()
+        self.warned_component = False
+
+    def cmd_ftp(self, args):
+        '''FTP operations'''
+        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc|cancel|status>"
+        if len(args) < 1:
+            print(usage)
+            return
+        if args[0] == 'list':
+            self.cmd_list(args[1:])
+        elif args[0] == "set":
+            self.ftp_settings.command(args[1:])
+        elif args[0] == 'get':
+            self.cmd_get(args[1:])
+        elif args[0] == 'put':
+            self.cmd_put(args[1:])
+        elif args[0] == 'rm':
+            self.cmd_rm(args[1:])
+        elif args[0] == 'rmdir':
+            self.cmd_rmdir(args[1:])
+        elif args[0] == 'rename':
+            self.cmd_rename(args[1:])
+        elif args[0] == 'mkdir':
+            self.cmd_mkdir(args[1:])
+        elif args[0] == 'crc':
+            self.cmd_crc(args[1:])
+        elif args[0] == 'status':
+            self.cmd_status()
+        elif args[0] == 'cancel':
+            self.cmd_cancel(args[1:])
+        else:
+            print(usage)
+
+    def send(self, op, transfer=None):
+        '''send a request'''
+        op.seq = self.seq
+        payload = op.pack()
+        plen = len(payload)
+        if plen < MAX_Payload + HDR_Len:
+            payload.extend(bytearray([0]*((HDR_Len+MAX_Payload)-plen)))
+        if self.master is None:
+            print("FTP: Can't send request, no master...")
+            return
+        if transfer is None or transfer.target_system == self.target_system:
+            self.master.mav.file_transfer_protocol_send(self.network, self.target_system, self.target_component, payload)
+        else:
+            # a transfer with a vehicle other than the current target
+            (sysid, compid) = (transfer.target_system, transfer.target_component)
+            self.mpstate.foreach_mav(sysid, compid,
+                                     lambda mav: mav.file_transfer_protocol_send(self.network, sysid, compid, payload))
+        self.seq = (self.seq + 1) % 256
+        if transfer is None:
+            self.last_op = op
+        now = time.time()
+        if self.ftp_settings.debug > 1:
+            print("> %s dt=%.2f" % (op, now - self.last_op_time))
+        self.last_op_time = time.time()
+
+    def can_send(self):
+        '''return True if the rate limit allows another data request'''
+        return self.ftp_settings.max_rate <= 0 or self.allowance > 0
+
+    def use_allowance(self, nbytes):
+        '''count bytes against the rate limit'''
+        if self.ftp_settings.max_rate > 0:
+            self.allowance -= nbytes
+
+    def update_allowance(self, now):
+        '''refill the rate limit allowance, allowing up to half a second
+        of data to be requested at once'''
+        dt = now - self.last_allowance_time
+        self.last_allowance_time = now
+        rate = self.ftp_settings.max_rate * 1024
+        if rate <= 0:
+            self.allowance = 0
+            return
+        self.allowance = min(self.allowance + rate * dt, rate * 0.5)
+
+    def allocate_session(self):
+        '''return an unused session id'''
+        for i in range(255):
+            session = self.next_session
+            self.next_session = self.next_session % 255 + 1
+            if session not in self.sessions:
+                return session
+        return None
+
+    def active_sessions(self, target_system):
+        '''number of transfers in progress with a vehicle'''
+        return len([t for t in self.sessions.values() if t.target_system == target_system])
+
+    def queue_transfer(self, transfer):
+        '''add a transfer to the queue, starting it if a session is free'''
+        self.queue.append(transfer)
+        self.start_queued()
+
+    def start_queued(self):
+        '''start queued transfers while the vehicles have sessions free'''
+        for transfer in list(self.queue):
+            limit = max(min(self.session_limit.get(transfer.target_system, 255), self.ftp_settings.max_sessions), 1)
+            if self.active_sessions(transfer.target_system) >= limit:
+                continue
+            session = self.allocate_session()
+            if session is None:
+                return
+            self.queue.remove(transfer)
+            transfer.session = session
+            self.sessions[session] = transfer
+            if self.ftp_settings.debug > 0:
+                print("FTP: starting session %u: %s" % (session, transfer.status()))
+            transfer.start()
+
+    def requeue(self, transfer):
+        '''put a transfer back on the queue after the vehicle refused a
+        session, returning False if no other session is open'''
+        active = self.active_sessions(transfer.target_system)
+        if active <= 1:
+            return False
+        self.session_limit[transfer.target_system] = active - 1
+        self.sessions.pop(transfer.session, None)
+        transfer.session = None
+        self.queue.insert(0, transfer)
+        if self.ftp_settings.debug > 0:
+            print("FTP: sysid %u limited to %u sessions" % (transfer.target_system, active - 1))
+        return True
+
+    def transfer_done(self, transfer):
+        '''remove a finished or failed transfer'''
+        if transfer.session is not None and self.sessions.get(transfer.session, None) is transfer:
+            self.sessions.pop(transfer.session)
+        if transfer in self.queue:
+            self.queue.remove(transfer)
+        self.start_queued()
+
+    def cmd_list(self, args):
+        '''list files'''
+        if len(args) > 0:
+            dname = args[0]
+        else:
+            dname = '/'
+        print("Listing %s" % dname)
+        enc_dname = bytearray(dname, 'ascii')
+        self.total_size = 0
+        self.dir_offset = 0
+        op = FTP_OP(self.seq, self.session, OP_ListDirectory, len(enc_dname), 0, 0, self.dir_offset, enc_dname)
+        self.send(op)
+
+    def handle_list_reply(self, op, m):
+        '''handle OP_ListDirectory reply'''
+        if op.opcode == OP_Ack:
+            dentries = sorted(op.payload.split(b'\x00'))
+            #print(dentries)
+            for d in dentries:
+                if len(d) == 0:
+                    continue
+                self.dir_offset += 1
+                try:
+                    if sys.version_info.major >= 3:
+                        d = str(d, 'ascii')
+                    else:
+                        d = str(d)
+                except Exception:
+                    continue
+                if d[0] == 'D':
+                    print(" D %s" % d[1:])
+                elif d[0] == 'F':
+                    (name, size) = d[1:].split('\t')
+                    size = int(size)
+                    self.total_size += size
+                    print("   %s\t%u" % (name, size))
+                else:
+                    print(d)
+            # ask for more
+            more = self.last_op
+            more.offset = self.dir_offset
+            self.send(more)
+        elif op.opcode == OP_Nack and len(op.payload) == 1 and op.payload[0] == ERR_EndOfFile:
+            print("Total size %.2f kByte" % (self.total_size / 1024.0))
+            self.total_size = 0
+        else:
+            print('LIST: %s' % op)
+
+    def cmd_get(self, args, callback=None, callback_progress=None):
+        '''get file. The transfer is queued if the vehicle has no session
+        free, and the transfer is returned'''
+        if len(args) == 0:
+            print("Usage: get FILENAME <LOCALNAME>")
+            return
+        fname = args[0]
+        transfer = FTPTransfer(self, 'get', fname, self.target_system, self.target_component)
+        if len(args) > 1:
+            transfer.filename = args[1]
+        else:
+            transfer.filename = os.path.basename(fname)
+        if callback is None or self.ftp_settings.debug > 1:
+            print("Getting %s as %s" % (fname, transfer.filename))
+        transfer.callback = callback
+        transfer.callback_progress = callback_progress
+        if transfer.burst_size < 1:
+            transfer.burst_size = 239
+        elif transfer.burst_size > 239:
+            transfer.burst_size = 239
+        self.queue_transfer(transfer)
+        return transfer
+
+    def cmd_put(self, args, fh=None, callback=None, progress_callback=None):
+        '''put file. The transfer is queued if the vehicle has no session
+        free, and the transfer is returned'''
+        if len(args) == 0:
+            print("Usage: put FILENAME <REMOTENAME>")
+            return
+        fname = args[0]
+        transfer = FTPTransfer(self, 'put', fname, self.target_system, self.target_component)
+        transfer.fh = fh
+        if transfer.fh is None:
+            try:
+                transfer.fh = open(fname, 'rb')
+            except Exception as ex:
+                print("Failed to open %s: %s" % (fname, ex))
+                return
+        if len(args) > 1:
+            transfer.filename = args[1]
+        else:
+            transfer.filename = os.path.basename(fname)
+        if transfer.filename.endswith("/"):
+            transfer.filename += os.path.basename(fname)
+        if callback is None:
+            print("Putting %s as %s" % (fname, transfer.filename))
+        transfer.fh.seek(0,2)
+        file_size = transfer.fh.tell()
+        transfer.fh.seek(0)
+
+        # setup write list
+        transfer.write_block_size = self.ftp_settings.write_size
+        transfer.write_file_size = file_size
+
+        write_blockcount = file_size // transfer.write_block_size
+        if file_size % transfer.write_block_size != 0:
+            write_blockcount += 1
+
+        transfer.write_list = set(range(write_blockcount))
+        transfer.write_total = write_blockcount
+
+        transfer.put_callback = callback
+        transfer.put_callback_progress = progress_callback
+        self.queue_transfer(transfer)
+        return transfer
+
     def cmd_rm(self, args):
         '''remove file'''
         if len(args) == 0:
@@ -677,8 +975,8 @@ class FTPModule(mp_module.MPModule):
             print("Usage: crc NAME")
             return
         name = args[0]
-        self.filename = name
-        self.op_start = time.time()
+        self.crc_name = name
+        self.crc_start = time.time()
         print("Getting CRC for %s" % name)
         enc_name = bytearray(name, 'ascii')
         op = FTP_OP(self.seq, self.session, OP_CalcFileCRC32, len(enc_name), 0, 0, 0, bytearray(enc_name))
@@ -689,23 +987,36 @@ class FTPModule(mp_module.MPModule):
         if op.opcode == OP_Ack and op.size == 4:
             crc, = struct.unpack("<I", op.payload)
             now = time.time()
-            print("crc: %s 0x%08x in %.1fs" % (self.filename, crc, now - self.op_start))
+            print("crc: %s 0x%08x in %.1fs" % (self.crc_name, crc, now - self.crc_start))
         else:
             print("crc failed %s" % op)
 
-    def cmd_cancel(self):
-        '''cancel any pending op'''
-        self.terminate_session()
+    def cmd_cancel(self, args):
+        '''cancel transfers, all of them or by session id'''
+        transfers = list(self.sessions.values()) + list(self.queue)
+        if len(args) > 0:
+            try:
+                session = int(args[0])
+            except ValueError:
+                print("Usage: ftp cancel <SESSION>")
+                return
+            transfers = [t for t in transfers if t.session == session]
+            if len(transfers) == 0:
+                print("No session %u" % session)
+        for transfer in transfers:
+            transfer.terminate()
 
     def cmd_status(self):
         '''show status'''
-        if self.fh is None:
+        if len(self.sessions) == 0 and len(self.queue) == 0:
             print("No transfer in progress")
-        else:
-            ofs = self.fh.tell()
-            dt = time.time() - self.op_start
-            rate = (ofs / dt) / 1024.0
-            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec" % (ofs, len(self.read_gaps), self.read_retries, rate))
+            return
+        for session in sorted(self.sessions.keys()):
+            print(self.sessions[session].status())
+        for transfer in self.queue:
+            print(transfer.status())
+        if self.ftp_settings.max_rate > 0:
+            print("Rate limit %.1f kByte/sec" % self.ftp_settings.max_rate)
 
     def op_parse(self, m):
         '''parse a FILE_TRANSFER_PROTOCOL msg'''
@@ -737,116 +1048,42 @@ class FTPModule(mp_module.MPModule):
                         print("FTP: dropping packet RX")
                     return
 
-            if op.req_opcode == self.last_op.opcode and op.seq == (self.last_op.seq + 1) % 256:
-                self.rtt = max(min(self.rtt, dt), 0.01)
-            if op.req_opcode == OP_ListDirectory:
+            if op.req_opcode in TRANSFER_OPCODES:
+                transfer = self.sessions.get(op.session, None)
+                if transfer is None or m.get_srcSystem() != transfer.target_system:
+                    # old session
+                    if self.ftp_settings.debug > 0 and op.req_opcode != OP_TerminateSession:
+                        print("FTP: reply for unknown session %s" % op)
+                    return
+                transfer.handle_reply(op, m, now - transfer.last_op_time)
+            elif op.req_opcode == OP_ListDirectory:
                 self.handle_list_reply(op, m)
-            elif op.req_opcode == OP_OpenFileRO:
-                self.handle_open_RO_reply(op, m)
-            elif op.req_opcode == OP_BurstReadFile:
-                self.handle_burst_read(op, m)
-            elif op.req_opcode == OP_TerminateSession:
-                pass
-            elif op.req_opcode == OP_CreateFile:
-                self.handle_create_file_reply(op, m)
-            elif op.req_opcode == OP_WriteFile:
-                self.handle_write_reply(op, m)
             elif op.req_opcode in [OP_RemoveFile, OP_RemoveDirectory]:
                 self.handle_remove_reply(op, m)
             elif op.req_opcode == OP_Rename:
                 self.handle_rename_reply(op, m)
             elif op.req_opcode == OP_CreateDirectory:
                 self.handle_mkdir_reply(op, m)
-            elif op.req_opcode == OP_ReadFile:
-                self.handle_reply_read(op, m)
             elif op.req_opcode == OP_CalcFileCRC32:
                 self.handle_crc_reply(op, m)
             else:
                 print('FTP Unknown %s' % str(op))
 
-    def send_gap_read(self, g):
-        '''send a read for a gap'''
-        (offset, length) = g
-        if self.ftp_settings.debug > 0:
-            print("Gap read of %u at %u rem=%u blog=%u" % (length, offset, len(self.read_gaps), self.backlog))
-        read = FTP_OP(self.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
-        self.send(read)
-        self.read_gaps.remove(g)
-        self.read_gaps.append(g)
-        self.last_gap_send = time.time()
-        self.read_gap_times[g] = self.last_gap_send
-        self.backlog += 1
-
-    def check_read_send(self):
-        '''see if we should send another gap read'''
-        if len(self.read_gaps) == 0:
-            return
-        g = self.read_gaps[0]
-        now = time.time()
-        dt = now - self.read_gap_times[g]
-        if not self.reached_eof:
-            # send gap reads once
-            for g in self.read_gap_times.keys():
-                if self.read_gap_times[g] == 0:
-                    self.send_gap_read(g)
-            return
-        if self.read_gap_times[g] > 0 and dt > self.ftp_settings.retry_time:
-            if self.backlog > 0:
-                self.backlog -= 1
-            self.read_gap_times[g] = 0
-
-        if self.read_gap_times[g] != 0:
-            # still pending
-            return
-        if not self.reached_eof and self.backlog >= self.ftp_settings.max_backlog:
-            # don't fill queue too far until we have got past the burst
-            return
-        if now - self.last_gap_send < 0.05:
-            # don't send too fast
-            return
-        self.send_gap_read(g)
-
     def idle_task(self):
         '''check for file gaps and lost requests'''
         now = time.time()
-
-        # see if we lost an open reply
-        if self.op_start is not None and now - self.op_start > 1.0 and self.last_op.opcode == OP_OpenFileRO:
-            self.op_start = now
-            self.open_retries += 1
-            if self.open_retries > 2:
-                # fail the get
-                self.op_start = None
-                self.terminate_session()
-                return
-            if self.ftp_settings.debug > 0:
-                print("FTP: retry open")
-            send_op = self.last_op
-            self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
-            self.session = (self.session + 1) % 256
-            send_op.session = self.session
-            self.send(send_op)
-
-        if len(self.read_gaps) == 0 and self.last_burst_read is None and self.write_list is None:
+        self.update_allowance(now)
+        self.start_queued()
+        if len(self.sessions) == 0:
             return
 
-        if self.fh is None:
-            return
-
-        # see if burst read has stalled
-        if not self.reached_eof and self.last_burst_read is not None and now - self.last_burst_read > self.ftp_settings.retry_time:
-            dt = now - self.last_burst_read
-            self.last_burst_read = now
-            if self.ftp_settings.debug > 0:
-                print("Retry read at %u rtt=%.2f dt=%.2f" % (self.fh.tell(), self.rtt, dt))
-            self.send(FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, self.fh.tell(), None))
-            self.read_retries += 1
-
-        # see if we can fill gaps
-        self.check_read_send()
-
-        if self.write_list is not None:
-            self.send_more_writes()
+        # take turns at being first to use the rate allowance
+        transfers = list(self.sessions.values())
+        self.next_idle = (self.next_idle + 1) % len(transfers)
+        transfers = transfers[self.next_idle:] + transfers[:self.next_idle]
+        for transfer in transfers:
+            if transfer.session in self.sessions:
+                transfer.idle_task(now)
 
 def init(mpstate):
     '''initialise module'''
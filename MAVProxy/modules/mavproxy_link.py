@@ -16,7 +16,6 @@ import fnmatch
 import json
 import math
 import os
-import struct
 import sys
 import time
 import traceback
@@ -28,6 +27,7 @@ else:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib.mp_linkworker import LinkWorker
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuCallTextDialog
@@ -55,6 +55,10 @@ activityPackets = frozenset([
 ])
 radioStatusPackets = frozenset(['RADIO', 'RADIO_STATUS'])
 
+# largest write made when coalescing forwarded messages, kept below a
+# typical ethernet MTU so UDP outputs are not fragmented
+forwardMaxWrite = 1400
+
 preferred_ports = [
     '*FTDI*',
     "*Arduino_Mega_2560*",
@@ -78,11 +82,13 @@ class LinkModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(LinkModule, self).__init__(mpstate, "link", "link control", public=True, multi_vehicle=True)
+        self.set_idle_rate(20)
         self.add_command('link', self.cmd_link, "link control",
                          ["<list|ports|resetstats>",
                           'add (SERIALPORT)',
                           'attributes (LINK) (ATTRIBUTES)',
                           'remove (LINKS)',
+                          'worker (LINK) <on|off>',
                           'dataratelogging (DLSTATE)',
                           'hl (HLSTATE)'])
         self.add_command('vehicle', self.cmd_vehicle, "vehicle control")
@@ -104,6 +110,15 @@ class LinkModule(mp_module.MPModule):
         self.old_streamrate = 0
         self.old_streamrate2 = 0
 
+        # messages waiting to be forwarded to outputs, and (message,
+        # modules) waiting to be passed to modules, None when not
+        # batching. See forward_begin()
+        self.forward_buffers = None
+        self.dispatch_pending = None
+
+        # message type -> list of modules whose mavlink_packet wants it
+        self.packet_dispatch = {}
+
         # a list of TimeSync requests which are listening for and
         # sending TIMESYNC messages at the moment:
         self.outstanding_timesyncs = []
@@ -248,8 +263,13 @@ class LinkModule(mp_module.MPModule):
             self.reset_link_stats()
         elif args[0] == "ping":
             self.cmd_ping(args[1:])
+        elif args[0] == "worker":
+            if len(args) != 3 or args[2] not in ["on", "off"]:
+                print("Usage: link worker LINK <on|off>")
+                return
+            self.cmd_link_worker(args[1:])
         else:
-            print("usage: link <list|add|remove|attributes|hl|dataratelogging|resetstats>")
+            print("usage: link <list|add|remove|attributes|hl|dataratelogging|resetstats|worker>")
 
     def cmd_dl(self, args):
         '''Toggle datarate logging'''
@@ -364,10 +384,13 @@ class LinkModule(mp_module.MPModule):
         print("%u links" % len(self.mpstate.mav_master))
         for i in range(len(self.mpstate.mav_master)):
             conn = self.mpstate.mav_master[i]
+            worker = ""
+            if getattr(conn, 'link_worker', None) is not None:
+                worker = " (worker)"
             if hasattr(conn, 'label'):
-                print("%u (%s): %s" % (i, conn.label, conn.address))
+                print("%u (%s): %s%s" % (i, conn.label, conn.address, worker))
             else:
-                print("%u: %s" % (i, conn.address))
+                print("%u: %s%s" % (i, conn.address, worker))
 
     def parse_link_attributes(self, some_json):
         '''return a dict based on some_json (empty if json invalid)'''
@@ -449,10 +472,13 @@ class LinkModule(mp_module.MPModule):
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         self.mpstate.vehicle_link_map[conn.linknum] = set(())
+        self.mpstate.reactor.mark_dirty()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
             pass
+        if getattr(conn, 'worker', False):
+            self.link_worker(conn, True)
         return True
 
     def cmd_link_add(self, args):
@@ -469,6 +495,8 @@ class LinkModule(mp_module.MPModule):
         conn = self.mpstate.mav_master[i]
         atts = self.parse_link_attributes(attributes)
         self.apply_link_attributes(conn, atts)
+        if 'worker' in atts:
+            self.link_worker(conn, atts['worker'])
 
     def cmd_link_attributes(self, args):
         '''change optional link attributes'''
@@ -483,6 +511,35 @@ class LinkModule(mp_module.MPModule):
         label = args[1]
         self.link_attributes(link, '{"label":"%s"}' % label)
 
+    def link_worker(self, conn, enable):
+        '''start or stop reading and parsing conn in a worker process'''
+        label = self.link_label(conn)
+        worker = getattr(conn, 'link_worker', None)
+        if not enable:
+            if worker is not None:
+                worker.stop()
+                conn.link_worker = None
+                self.mpstate.reactor.mark_dirty()
+                print("Link %s reading in main process" % label)
+            return
+        if worker is not None:
+            return
+        reason = LinkWorker.unsupported_reason(conn)
+        if reason is not None:
+            print("Link %s: %s" % (label, reason))
+            return
+        conn.link_worker = LinkWorker(conn)
+        self.mpstate.reactor.mark_dirty()
+        print("Link %s reading in worker process" % label)
+
+    def cmd_link_worker(self, args):
+        '''enable or disable a link worker process'''
+        i = self.find_link(args[0])
+        if i is None:
+            print("Connection (%s) not found" % (args[0],))
+            return
+        self.link_worker(self.mpstate.mav_master[i], args[1] == "on")
+
     def cmd_link_ports(self):
         '''show available ports'''
         ports = mavutil.auto_detect_serial(preferred_list=preferred_ports)
@@ -510,6 +567,7 @@ class LinkModule(mp_module.MPModule):
             return
         conn = self.mpstate.mav_master[i]
         print("Removing link %s" % conn.address)
+        self.link_worker(conn, False)
         try:
             try:
                 mp_util.child_fd_list_remove(conn.port.fileno())
@@ -520,6 +578,7 @@ class LinkModule(mp_module.MPModule):
             print(msg)
             pass
         self.mpstate.mav_master.pop(i)
+        self.mpstate.reactor.mark_dirty()
         self.status.counters['MasterIn'].pop(i)
         self.status.bytecounters['MasterIn'].pop(i)
         del self.mpstate.vehicle_link_map[conn.linknum]
@@ -566,7 +625,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -985,9 +1044,87 @@ class LinkModule(mp_module.MPModule):
         for ot in self.outstanding_timesyncs:
             ot.handle_TIMESYNC(m, master)
 
-    def mavlink_packet(self, msg):
-        '''handle an incoming mavlink packet'''
-        pass
+    def forward_begin(self):
+        '''start collecting messages for the outputs, so all the
+        messages from one read of a link go out in as few writes as
+        possible. Passing the messages to modules waits until they
+        have been forwarded, so module processing doesn't delay them.
+
+        Modules then see each message after master_callback() has
+        processed the whole read, so link state such as the vehicle
+        mode may already reflect later messages. Which modules get a
+        message is still decided by the state when it arrived'''
+        self.forward_buffers = []
+        self.dispatch_pending = []
+
+    def forward_end(self):
+        '''send messages collected since forward_begin(), then pass
+        them to modules'''
+        bufs = self.forward_buffers
+        pending = self.dispatch_pending
+        self.forward_buffers = None
+        self.dispatch_pending = None
+        if bufs:
+            self.forward_write(bufs)
+        if pending:
+            for (m, mods, target_sysid, from_primary) in pending:
+                self.dispatch_packet(m, mods, target_sysid, from_primary)
+
+    def forward_write(self, bufs):
+        '''write a list of message buffers to all outputs'''
+        chunks = None
+        for r in self.mpstate.mav_outputs:
+            if getattr(r, 'ws', None) is not None:
+                from wsproto.connection import ConnectionState
+                if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
+                    continue
+                # websocket clients expect one message per frame
+                for b in bufs:
+                    r.write(b)
+                continue
+            if chunks is None:
+                chunks = self.coalesce_buffers(bufs)
+            for c in chunks:
+                r.write(c)
+
+    @staticmethod
+    def coalesce_buffers(bufs):
+        '''join message buffers into as few chunks as possible while
+        keeping each chunk no larger than forwardMaxWrite'''
+        if len(bufs) == 1:
+            return bufs
+        chunks = []
+        cur = []
+        curlen = 0
+        for b in bufs:
+            if cur and curlen + len(b) > forwardMaxWrite:
+                chunks.append(b''.join(cur))
+                cur = []
+                curlen = 0
+            cur.append(b)
+            curlen += len(b)
+        if cur:
+            chunks.append(b''.join(cur))
+        return chunks
+
+    def invalidate_packet_dispatch(self):
+        '''forget the module dispatch table, called when modules are
+        loaded or unloaded or change their subscriptions'''
+        self.packet_dispatch = {}
+
+    def packet_dispatch_for(self, mtype):
+        '''return (and cache) the list of modules to pass mtype to'''
+        mods = []
+        for (mod, pm) in self.mpstate.modules:
+            if getattr(type(mod), 'mavlink_packet', None) is mp_module.MPModule.mavlink_packet:
+                # module doesn't handle packets
+                continue
+            types = getattr(mod, 'mavlink_packet_types', None)
+            if types is not None and mtype not in types:
+                continue
+            mods.append(mod)
+        self.packet_dispatch[mtype] = mods
+        return mods
 
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
@@ -1032,7 +1169,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -1074,23 +1211,45 @@ class LinkModule(mp_module.MPModule):
             # would lead a conflict in stream rate setting between mavproxy and the other
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
-                if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        if hasattr(r, 'ws') and r.ws is not None:
-                            from wsproto.connection import ConnectionState
-                            if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
-                                continue
-                        r.write(m.get_msgbuf())
-
-            sysid = m.get_srcSystem()
-            target_sysid = self.target_system
+                if mtype not in self.no_fwd_types and self.mpstate.mav_outputs:
+                    if self.forward_buffers is not None:
+                        self.forward_buffers.append(m.get_msgbuf())
+                    else:
+                        self.forward_write([m.get_msgbuf()])
 
-            # pass to modules
-            for (mod, pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
+            mods = self.packet_dispatch.get(mtype, None)
+            if mods is None:
+                mods = self.packet_dispatch_for(mtype)
+            if len(mods) == 0:
+                return
+            if self.dispatch_pending is not None:
+                self.dispatch_pending.append((m, mods, self.target_system,
+                                              self.message_is_from_primary_vehicle(m)))
+            else:
+                self.dispatch_packet(m, mods)
+
+    def dispatch_packet(self, m, mods, target_sysid=None, from_primary=None):
+        '''pass mavlink message m to the modules which want it. The
+        target system and whether m is from the primary vehicle are
+        those when m arrived, if given'''
+        mtype = m.get_type()
+        sysid = m.get_srcSystem()
+        if target_sysid is None:
+            target_sysid = self.target_system
+        if from_primary is None:
+            from_primary = self.message_is_from_primary_vehicle(m)
+        profiler = self.mpstate.profiler
+
+        # pass to modules
+        for mod in mods:
+            sysids = mod.mavlink_packet_sysids
+            if sysids is not None:
+                # module has asked for specific systems
+                if sysid not in sysids:
                     continue
+            else:
                 # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
-                if not self.message_is_from_primary_vehicle(m) and not mod.multi_vehicle and mtype == 'HEARTBEAT':
+                if not from_primary and not mod.multi_vehicle and mtype == 'HEARTBEAT':
                     continue
                 # sysid 51/'3' is used by SiK radio for the injected RADIO/RADIO_STATUS mavlink frames.
                 # In order to be able to pass these to e.g. the graph module, which is not multi-vehicle,
@@ -1101,22 +1260,27 @@ class LinkModule(mp_module.MPModule):
                         # only pass packets not from our target to modules that
                         # have marked themselves as being multi-vehicle capable
                         continue
-                try:
+            try:
+                if profiler.enabled:
+                    t0 = time.perf_counter_ns()
+                    mod.mavlink_packet(m)
+                    profiler.record(mod.name, 'mavlink_packet', mtype, time.perf_counter_ns() - t0)
+                else:
                     mod.mavlink_packet(m)
-                except Exception as msg:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    if self.mpstate.settings.moddebug > 3:
-                        traceback.print_exception(
-                            exc_type,
-                            exc_value,
-                            exc_traceback,
-                            file=sys.stdout
-                        )
-                    elif self.mpstate.settings.moddebug > 1:
-                        traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                                  limit=2, file=sys.stdout)
-                    elif self.mpstate.settings.moddebug == 1:
-                        print(msg)
+            except Exception as msg:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                if self.mpstate.settings.moddebug > 3:
+                    traceback.print_exception(
+                        exc_type,
+                        exc_value,
+                        exc_traceback,
+                        file=sys.stdout
+                    )
+                elif self.mpstate.settings.moddebug > 1:
+                    traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                              limit=2, file=sys.stdout)
+                elif self.mpstate.settings.moddebug == 1:
+                    print(msg)
 
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
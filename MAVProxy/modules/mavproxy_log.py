@@ -1,170 +1,455 @@
 '''
 log command handling
 
+Logs are downloaded in 90 byte blocks. The blocks received so far are
+kept in a bitmap which is saved next to the partial file, so a
+download which is cancelled or interrupted resumes where it left off
+when the same log is downloaded again.
+
 AP_FLAKE8_CLEAN
 '''
 
 import os
+import struct
 import time
 
+import numpy as np
+from pymavlink import mavutil
+
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
 
+# bytes of log data per LOG_DATA message
+BLOCK_SIZE = 90
 
-class LogModule(mp_module.MPModule):
-    def __init__(self, mpstate):
-        super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
-        self.reset()
+# header of the saved bitmap of received blocks
+BITMAP_MAGIC = b'MPLB'
+BITMAP_HEADER = '<4sIII'
 
-    def reset(self):
-        self.download_set = set()
-        self.download_file = None
-        self.download_lognum = None
-        self.download_filename = None
-        self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
+# time with no data before asking again
+DATA_TIMEOUT = 0.7
+
+# how often the bitmap is saved while downloading
+SAVE_INTERVAL = 5.0
+
+# each request asks for about this many seconds of data
+REQUEST_TIME = 1.0
+MIN_REQUEST_BLOCKS = 16
+
+# time to wait for the log list when downloading from several vehicles
+LIST_TIMEOUT = 3.0
+LIST_TRIES = 3
+
+
+def bitmap_filename(filename):
+    '''name of the file holding the received blocks of a partial download'''
+    return filename + '.blocks'
+
+
+class LogDownload(object):
+    '''download of one log. Only one LOG_REQUEST_DATA is served by the
+    vehicle at a time, so requests are sent one after another, each
+    sized to take about REQUEST_TIME at the measured rate'''
+    def __init__(self, vehicle, log_num, filename, entry):
+        self.vehicle = vehicle
+        self.log_num = log_num
+        self.filename = filename
+        self.entry = entry
+        self.received = np.zeros(1024, dtype=bool)
+        self.received_count = 0
+        self.received_bytes = 0
+        # end of the data seen so far, and end of the log once known
+        self.highest = 0
+        self.eof = None
+        self.file = None
+        self.file_ofs = 0
+        self.start_time = time.time()
+        self.last_data = time.time()
+        self.last_save = time.time()
         self.retries = 0
+        self.resumed_bytes = 0
+        # current request as (offset, end), end None when open ended
+        self.request = None
+        # throughput estimate in bytes/second
+        self.rate = None
+        self.rate_start = time.time()
+        self.rate_bytes = 0
+        # share of the bandwidth budget in bytes/second, None for no
+        # limit. The next request waits until request_due
+        self.rate_limit = None
+        self.request_due = 0
+        self.waiting = False
+
+    def start(self):
+        '''open the file, resuming a partial download if possible'''
+        if self.load_bitmap():
+            self.file = open(self.filename, 'r+b')
+            self.resumed_bytes = self.received_bytes
+            print("Resuming log %u as %s with %u bytes already downloaded" % (
+                self.log_num, self.filename, self.received_bytes))
+            if self.finished():
+                return
+        else:
+            print("Downloading log %u as %s" % (self.log_num, self.filename))
+            self.file = open(self.filename, 'wb')
+        self.send_request()
+
+    def expected_size(self):
+        '''size of the log, or zero if not known'''
+        if self.eof is not None:
+            return self.eof
+        if self.entry is not None:
+            return self.entry.size
+        return 0
+
+    def bitmap_header(self):
+        size = 0
+        time_utc = 0
+        if self.entry is not None:
+            size = self.entry.size
+            time_utc = self.entry.time_utc
+        return struct.pack(BITMAP_HEADER, BITMAP_MAGIC, self.log_num, size, time_utc)
+
+    def load_bitmap(self):
+        '''load the received blocks of an earlier partial download of the
+        same log, returning True if there was one'''
+        bfile = bitmap_filename(self.filename)
+        if not os.path.exists(bfile) or not os.path.exists(self.filename):
+            return False
+        try:
+            with open(bfile, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return False
+        hlen = struct.calcsize(BITMAP_HEADER)
+        if len(data) < hlen:
+            return False
+        (magic, log_num, size, time_utc) = struct.unpack(BITMAP_HEADER, data[:hlen])
+        if magic != BITMAP_MAGIC or log_num != self.log_num:
+            return False
+        if self.entry is None:
+            # the log number may now be a different log
+            print("Log %u not listed, not resuming. Use log list to allow resuming" % self.log_num)
+            return False
+        if size != self.entry.size or time_utc != self.entry.time_utc:
+            print("Log %u has changed, not resuming" % self.log_num)
+            return False
+        received = np.unpackbits(np.frombuffer(data[hlen:], dtype=np.uint8), bitorder='little').astype(bool)
+        file_blocks = (os.path.getsize(self.filename) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        received = received[:file_blocks]
+        if len(received) == 0:
+            return False
+        self.received = received.copy()
+        self.received_count = int(np.count_nonzero(received))
+        self.received_bytes = self.received_count * BLOCK_SIZE
+        self.highest = len(received) * BLOCK_SIZE
+        if self.received[-1]:
+            # the last block may be short
+            self.received_bytes -= self.highest - os.path.getsize(self.filename)
+            self.highest = os.path.getsize(self.filename)
+        if self.highest >= self.entry.size:
+            self.eof = self.entry.size
+        return True
+
+    def save_bitmap(self):
+        '''save the received blocks so the download can be resumed'''
+        if self.file is None:
+            return
+        self.file.flush()
+        nblocks = (self.highest + BLOCK_SIZE - 1) // BLOCK_SIZE
+        bfile = bitmap_filename(self.filename)
+        tmp = bfile + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.bitmap_header())
+            f.write(np.packbits(self.received[:nblocks], bitorder='little').tobytes())
+        os.replace(tmp, bfile)
+        self.last_save = time.time()
+
+    def close(self, keep_partial=True):
+        '''stop downloading, saving the received blocks'''
+        if self.file is None:
+            return
+        if keep_partial:
+            self.save_bitmap()
+        self.file.close()
+        self.file = None
+
+    def missing(self):
+        '''return arrays of the start and end of the missing block ranges
+        below the highest block seen'''
+        nblocks = (self.highest + BLOCK_SIZE - 1) // BLOCK_SIZE
+        if self.eof is not None:
+            nblocks = (self.eof + BLOCK_SIZE - 1) // BLOCK_SIZE
+        received = self.received[:nblocks]
+        if len(received) < nblocks:
+            received = np.concatenate((received, np.zeros(nblocks - len(received), dtype=bool)))
+        edges = np.diff(np.concatenate(([1], received, [1])).astype(np.int8))
+        return (np.flatnonzero(edges == -1), np.flatnonzero(edges == 1))
+
+    def missing_count(self):
+        (starts, ends) = self.missing()
+        return int(np.sum(ends - starts))
+
+    def finished(self):
+        if self.eof is None:
+            return False
+        return self.received_count >= (self.eof + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def request_blocks(self):
+        '''blocks to ask for in one request'''
+        rate = self.rate
+        if self.rate_limit is not None and (rate is None or rate > self.rate_limit):
+            rate = self.rate_limit
+        if rate is None:
+            return MIN_REQUEST_BLOCKS
+        return max(int(rate * REQUEST_TIME / BLOCK_SIZE), MIN_REQUEST_BLOCKS)
+
+    def send_request(self):
+        '''ask for the first missing data. A request spans as many missing
+        ranges as fit in one request, as resending a few blocks costs less
+        than a round trip per range'''
+        (starts, ends) = self.missing()
+        if len(starts) == 0:
+            # nothing missing below what we have seen, ask for the rest
+            ofs = self.highest
+            end = None
+        else:
+            first = int(starts[0])
+            limit = first + self.request_blocks()
+            last = min(int(ends[0]), limit)
+            for (s, e) in zip(starts[1:], ends[1:]):
+                if s >= limit:
+                    break
+                last = min(int(e), limit)
+            ofs = first * BLOCK_SIZE
+            end = last * BLOCK_SIZE
+            if self.eof is None and last * BLOCK_SIZE >= self.highest:
+                # reaches what we have not seen yet
+                end = None
+        if end is None and self.rate_limit is not None:
+            end = ofs + self.request_blocks() * BLOCK_SIZE
+        self.request = (ofs, end)
+        self.waiting = False
+        if end is None:
+            count = 0xFFFFFFFF
+        else:
+            count = end - ofs
+            if self.rate_limit is not None:
+                self.request_due = time.time() + count / self.rate_limit
+        mav = self.vehicle.mav()
+        if mav is None:
+            return
+        mav.log_request_data_send(
+            self.vehicle.sysid,
+            self.vehicle.compid,
+            self.log_num,
+            ofs,
+            count
+        )
+
+    def update_rate(self, count):
+        '''update the throughput estimate'''
+        now = time.time()
+        self.rate_bytes += count
+        dt = now - self.rate_start
+        if dt < 1.0:
+            return
+        rate = self.rate_bytes / dt
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.5 * self.rate + 0.5 * rate
+        self.rate_start = now
+        self.rate_bytes = 0
+
+    def handle_log_data(self, m):
+        '''handle LOG_DATA for this download, returning True when the
+        download is complete'''
+        if m.id != self.log_num or self.file is None:
+            return False
+        self.last_data = time.time()
+        self.update_rate(m.count)
+        if m.count != 0:
+            if m.ofs != self.file_ofs:
+                self.file.seek(m.ofs)
+            self.file.write(bytearray(m.data[:m.count]))
+            self.file_ofs = m.ofs + m.count
+            block = m.ofs // BLOCK_SIZE
+            if block >= len(self.received):
+                grow = max(block + 1, 2 * len(self.received)) - len(self.received)
+                self.received = np.concatenate((self.received, np.zeros(grow, dtype=bool)))
+            if not self.received[block]:
+                self.received[block] = True
+                self.received_count += 1
+                self.received_bytes += m.count
+            self.highest = max(self.highest, m.ofs + m.count)
+        if m.count < BLOCK_SIZE:
+            self.eof = m.ofs + m.count
+        if self.finished():
+            return True
+        if self.request is not None:
+            (ofs, end) = self.request
+            if m.ofs >= ofs and ((end is not None and m.ofs + m.count >= end) or m.count < BLOCK_SIZE):
+                # this request is done, go on to the next unless it
+                # came in faster than the budget allows
+                if self.rate_limit is not None and time.time() < self.request_due:
+                    self.waiting = True
+                else:
+                    self.send_request()
+        return False
+
+    def idle_task(self):
+        '''ask again if data has stopped arriving'''
+        now = time.time()
+        if self.waiting:
+            if now >= self.request_due:
+                self.last_data = now
+                self.send_request()
+        elif now - self.last_data > DATA_TIMEOUT:
+            self.last_data = now
+            self.retries += 1
+            self.send_request()
+        if now - self.last_save > SAVE_INTERVAL:
+            self.save_bitmap()
+
+    def status(self):
+        '''return a status string'''
+        dt = max(time.time() - self.start_time, 0.001)
+        speed = (self.received_bytes - self.resumed_bytes) / (1000.0 * dt)
+        size = self.expected_size()
+        if size == 0:
+            pct = 0
+        else:
+            pct = min(100.0 * self.received_bytes / size, 100)
+        return (
+            f"Downloading {self.filename} - " +
+            f"{self.received_bytes}/{size} bytes " +
+            f"{pct:.1f}% {speed:.1f} kbyte/s " +
+            f"({self.retries} retries {self.missing_count()} missing)"
+        )
+
+
+class LogVehicle(object):
+    '''log list and downloads of one vehicle'''
+    def __init__(self, module, sysid, compid):
+        self.module = module
+        self.sysid = sysid
+        self.compid = compid
         self.entries = {}
+        self.num_logs = None
+        self.download = None
         self.download_queue = []
-        self.last_status = time.time()
+        # set by log download all --sysid, to download every log once
+        # the list has arrived
+        self.download_all = False
+        self.list_time = None
+        self.list_tries = 0
+        self.verbose = True
+        self.name_by_sysid = False
+        self.downloaded = 0
 
-    def mavlink_packet(self, m):
-        '''handle an incoming mavlink packet'''
-        if m.get_type() == 'LOG_ENTRY':
-            self.handle_log_entry(m)
-        elif m.get_type() == 'LOG_DATA':
-            self.handle_log_data(m)
+    def mav(self):
+        '''the link to talk to this vehicle on'''
+        master = self.module.mpstate.master(self.sysid)
+        if master is None:
+            return None
+        return master.mav
+
+    def request_list(self):
+        mav = self.mav()
+        if mav is None:
+            return
+        self.list_time = time.time()
+        self.list_tries += 1
+        mav.log_request_list_send(
+            self.sysid,
+            self.compid,
+            0,
+            0xffff
+        )
 
     def handle_log_entry(self, m):
         '''handling incoming log entry'''
-        if m.time_utc == 0:
-            tstring = ''
-        else:
-            tstring = time.ctime(m.time_utc)
         if m.num_logs == 0:
-            print("No logs")
+            if self.verbose:
+                print("No logs")
+            self.num_logs = 0
+            if self.download_all:
+                print("sysid %u: no logs" % self.sysid)
+                self.download_all = False
+                self.batch_check_done()
             return
         self.entries[m.id] = m
-        print("Log %u  numLogs %u lastLog %u size %u %s" % (m.id, m.num_logs, m.last_log_num, m.size, tstring))
+        self.num_logs = m.num_logs
+        if self.verbose:
+            if m.time_utc == 0:
+                tstring = ''
+            else:
+                tstring = time.ctime(m.time_utc)
+            print("Log %u  numLogs %u lastLog %u size %u %s" % (m.id, m.num_logs, m.last_log_num, m.size, tstring))
+        if self.download_all and len(self.entries) >= self.num_logs:
+            self.start_download_all()
+
+    def start_download_all(self):
+        '''download every log in the list'''
+        self.download_all = False
+        print("sysid %u: downloading %u logs" % (self.sysid, len(self.entries)))
+        self.log_download_all()
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download is None:
             return
-        # lose some data
-        # import random
-        # if random.uniform(0,1) < 0.05:
-        #    print('dropping ', str(m))
-        #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
-            status = (
-                f"Finished downloading {self.download_filename} " +
-                f"({size} bytes {dt:0.1f} seconds, " +
-                f"{speed:.1f} kbyte/sec " +
-                f"{self.retries} retries)"
-            )
-            self.console.set_status('LogDownload', status, row=4)
-            print(status)
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-            self.master.mav.log_request_end_send(
-                self.target_system,
-                self.target_component
-            )
-            if len(self.download_queue):
-                self.log_download_next()
-        self.update_status()
+        if self.download.handle_log_data(m):
+            self.download_finished()
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
-            return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(
-                self.target_system,
-                self.target_component,
-                self.download_lognum,
-                (1 + highest) * 90,
-                0xffffffff
+    def download_finished(self):
+        '''finish the current download and start the next'''
+        download = self.download
+        download.close(keep_partial=False)
+        bfile = bitmap_filename(download.filename)
+        if os.path.exists(bfile):
+            os.unlink(bfile)
+        dt = time.time() - download.start_time
+        size = os.path.getsize(download.filename)
+        speed = (download.received_bytes - download.resumed_bytes) / (1000.0 * dt)
+        status = (
+            f"Finished downloading {download.filename} " +
+            f"({size} bytes {dt:0.1f} seconds, " +
+            f"{speed:.1f} kbyte/sec " +
+            f"{download.retries} retries)"
+        )
+        self.module.console.set_status('LogDownload', status, row=4)
+        print(status)
+        self.download = None
+        self.downloaded += 1
+        mav = self.mav()
+        if mav is not None:
+            mav.log_request_end_send(
+                self.sysid,
+                self.compid
             )
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(
-                    self.target_system,
-                    self.target_component,
-                    self.download_lognum,
-                    start * 90,
-                    (end + 1 - start) * 90
-                )
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
+        if len(self.download_queue):
+            self.log_download_next()
+        self.batch_check_done()
 
-    def log_status(self, console=False):
-        '''show download status'''
-        if self.download_filename is None:
-            print("No download")
+    def batch_check_done(self):
+        '''go back to normal log naming and output once a log download
+        all --sysid has nothing left to do'''
+        if not self.name_by_sysid or self.busy():
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        file_size = os.path.getsize(self.download_filename)
-        if m is None:
-            size = 0
-            pct = 0
-        elif m.size == 0:
-            size = 0
-            pct = 100
-        else:
-            size = m.size
-            pct = (100.0*file_size)/size
-        highest = 0
-        if len(self.download_set):
-            highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        status = (
-            f"Downloading {self.download_filename} - " +
-            f"{os.path.getsize(self.download_filename)}/{size} bytes " +
-            f"{pct:.1f}% {speed:.1f} kbyte/s " +
-            f"({self.retries} retries {len(diff)} missing)"
-        )
-        if console:
-            self.console.set_status('LogDownload', status, row=4)
-        else:
-            print(status)
+        print("sysid %u: downloaded %u logs" % (self.sysid, self.downloaded))
+        self.name_by_sysid = False
+        self.verbose = True
 
     def log_download_next(self):
         if len(self.download_queue) == 0:
+            self.batch_check_done()
             return
         latest = self.download_queue.pop()
         filename = self.default_log_filename(latest)
-        if os.path.isfile(filename) and os.path.getsize(filename) == self.entries.get(latest).to_dict()["size"]:
+        if (os.path.isfile(filename) and not os.path.exists(bitmap_filename(filename)) and
+                os.path.getsize(filename) == self.entries.get(latest).to_dict()["size"]):
             print("Skipping existing %s" % (filename))
             self.log_download_next()
         else:
@@ -191,45 +476,192 @@ class LogModule(mp_module.MPModule):
         self.log_download_next()
 
     def log_download(self, log_num, filename):
-        '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
-        self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(
-            self.target_system,
-            self.target_component,
-            log_num,
-            0,
-            0xFFFFFFFF
-        )
-        self.download_filename = filename
-        self.download_set = set()
-        self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
-        self.retries = 0
+        '''download a log file, resuming a partial download'''
+        if self.download is not None:
+            self.download.close()
+        self.download = LogDownload(self, log_num, filename, self.entries.get(log_num, None))
+        self.module.update_budget()
+        self.download.start()
+        if self.download.finished():
+            self.download_finished()
 
     def default_log_filename(self, log_num):
+        if self.name_by_sysid:
+            return "log%u_sysid%u.bin" % (log_num, self.sysid)
         return "log%u.bin" % log_num
 
+    def cancel(self):
+        '''stop downloading, keeping what has been received'''
+        if self.download is not None:
+            self.download.close()
+            print("Stopped downloading %s, download it again to resume" % self.download.filename)
+        self.download = None
+        self.download_queue = []
+        self.download_all = False
+        self.batch_check_done()
+
+    def busy(self):
+        return self.download is not None or len(self.download_queue) > 0 or self.download_all
+
+    def status(self):
+        '''return a status string'''
+        if self.download is not None:
+            status = self.download.status()
+        elif self.download_all:
+            status = "listing logs (%u of %s)" % (len(self.entries), self.num_logs)
+        else:
+            status = "idle"
+        if self.name_by_sysid:
+            status = "sysid %u: %s, %u queued %u done" % (self.sysid, status, len(self.download_queue), self.downloaded)
+        return status
+
+    def idle_task(self):
+        '''ask again for lost log list or data'''
+        if self.download_all and self.list_time is not None and time.time() - self.list_time > LIST_TIMEOUT:
+            if self.list_tries >= LIST_TRIES or self.mav() is None:
+                if len(self.entries) > 0:
+                    self.start_download_all()
+                else:
+                    print("sysid %u: no log list" % self.sysid)
+                    self.download_all = False
+                    self.batch_check_done()
+            else:
+                self.request_list()
+        if self.download is not None:
+            self.download.idle_task()
+
+
+class LogModule(mp_module.MPModule):
+    def __init__(self, mpstate):
+        super(LogModule, self).__init__(mpstate, "log", "log transfer")
+        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>',
+                                                                    'set (LOGSETTING)'])
+        self.log_settings = mp_settings.MPSettings([('max_rate', float, 0)])
+        self.add_completion_function('(LOGSETTING)', self.log_settings.completion)
+        self.reset()
+
+    def reset(self):
+        # LogVehicle for each sysid
+        self.vehicles = {}
+        self.last_status = time.time()
+
+    def vehicle(self, sysid=None, compid=None):
+        '''return the LogVehicle for a sysid, by default the current target'''
+        if sysid is None:
+            sysid = self.target_system
+            compid = self.target_component
+        if sysid not in self.vehicles:
+            if compid is None:
+                compid = mavutil.mavlink.MAV_COMP_ID_AUTOPILOT1
+            self.vehicles[sysid] = LogVehicle(self, sysid, compid)
+        return self.vehicles[sysid]
+
+    def mavlink_packet(self, m):
+        '''handle an incoming mavlink packet'''
+        mtype = m.get_type()
+        if mtype not in ['LOG_ENTRY', 'LOG_DATA']:
+            return
+        vehicle = self.vehicles.get(m.get_srcSystem(), None)
+        if vehicle is None:
+            if m.get_srcSystem() != self.target_system:
+                return
+            vehicle = self.vehicle()
+        if mtype == 'LOG_ENTRY':
+            vehicle.handle_log_entry(m)
+        elif mtype == 'LOG_DATA':
+            vehicle.handle_log_data(m)
+            self.update_status()
+
+    def update_budget(self):
+        '''share the bandwidth budget between the downloads'''
+        downloads = [v.download for v in self.vehicles.values() if v.download is not None]
+        for download in downloads:
+            if self.log_settings.max_rate > 0:
+                download.rate_limit = self.log_settings.max_rate * 1000.0 / len(downloads)
+            else:
+                download.rate_limit = None
+
+    def log_status(self, console=False):
+        '''show download status'''
+        vehicles = [v for v in self.vehicles.values() if v.busy()]
+        if len(vehicles) == 0:
+            if not console:
+                print("No download")
+            return
+        if console:
+            if len(vehicles) == 1:
+                status = vehicles[0].status()
+            else:
+                downloads = [v.download for v in vehicles if v.download is not None]
+                received = sum([d.received_bytes for d in downloads])
+                size = sum([d.expected_size() for d in downloads])
+                status = "Downloading logs from %u vehicles - %u/%u bytes" % (len(vehicles), received, size)
+            self.console.set_status('LogDownload', status, row=4)
+            return
+        for v in sorted(vehicles, key=lambda v: v.sysid):
+            print(v.status())
+        if self.log_settings.max_rate > 0:
+            print("Budget %.1f kbyte/s" % self.log_settings.max_rate)
+
+    def vehicles_matching(self, pattern):
+        '''return the LogVehicles of the autopilots seen on any link whose
+        sysid matches a pattern'''
+        import fnmatch
+        ret = []
+        seen = set()
+        for vehicles in self.mpstate.vehicle_link_map.values():
+            for (sysid, compid) in vehicles:
+                if compid != mavutil.mavlink.MAV_COMP_ID_AUTOPILOT1 or sysid in seen:
+                    continue
+                if fnmatch.fnmatch(str(sysid), pattern):
+                    seen.add(sysid)
+                    ret.append(self.vehicle(sysid, compid))
+        return sorted(ret, key=lambda v: v.sysid)
+
+    def log_download_sysid(self, pattern):
+        '''download all logs from each matching vehicle at once'''
+        vehicles = self.vehicles_matching(pattern)
+        if len(vehicles) == 0:
+            print("No vehicles matching sysid %s" % pattern)
+            return
+        for v in vehicles:
+            if v.busy():
+                print("sysid %u: already downloading" % v.sysid)
+                continue
+            v.name_by_sysid = True
+            v.verbose = False
+            v.download_all = True
+            v.downloaded = 0
+            v.entries = {}
+            v.num_logs = None
+            v.list_tries = 0
+            v.request_list()
+        print("Downloading logs from sysid %s" % ' '.join([str(v.sysid) for v in vehicles]))
+
+    def log_cancel(self):
+        '''stop downloading, keeping what has been received'''
+        for v in self.vehicles.values():
+            v.cancel()
+        self.reset()
+
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|set>"
         if len(args) < 1:
             print(usage)
             return
 
+        vehicle = self.vehicle()
         if args[0] == "status":
             self.log_status()
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
-            self.master.mav.log_request_list_send(
-                self.target_system,
-                self.target_component,
-                0,
-                0xffff
-            )
+            vehicle.verbose = True
+            vehicle.request_list()
+
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
+            self.update_budget()
 
         elif args[0] == "erase":
             self.master.mav.log_erase_send(
@@ -244,57 +676,67 @@ class LogModule(mp_module.MPModule):
             )
 
         elif args[0] == "cancel":
-            if self.download_file is not None:
-                self.download_file.close()
-            self.reset()
+            self.log_cancel()
 
         elif args[0] == "download":
             if len(args) < 2:
-                print("usage: log download all | log download <lognumber> <filename> | log download from <lognumber>|log download range FIRST LAST") # noqa:E501
+                print("usage: log download all [--sysid PATTERN] | log download <lognumber> <filename> | log download from <lognumber>|log download range FIRST LAST") # noqa:E501
                 return
             if args[1] == 'all':
-                self.log_download_all()
+                if len(args) > 3 and args[2] == '--sysid':
+                    self.log_download_sysid(args[3])
+                    return
+                vehicle.log_download_all()
                 return
             if args[1] == 'from':
                 if len(args) < 2:
                     args[2] == 0
-                self.log_download_from(int(args[2]))
+                vehicle.log_download_from(int(args[2]))
                 return
             if args[1] == 'range':
                 if len(args) < 2:
                     print("Usage: log download range FIRST LAST")
                     return
-                self.log_download_range(int(args[2]), int(args[3]))
+                vehicle.log_download_range(int(args[2]), int(args[3]))
                 return
             if args[1] == 'latest':
-                if len(self.entries.keys()) == 0:
+                if len(vehicle.entries.keys()) == 0:
                     print("Please use log list first")
                     return
-                log_num = sorted(self.entries, key=lambda id: self.entries[id].time_utc)[-1]
+                log_num = sorted(vehicle.entries, key=lambda id: vehicle.entries[id].time_utc)[-1]
             else:
                 log_num = int(args[1])
             if len(args) > 2:
                 filename = args[2]
             else:
-                filename = self.default_log_filename(log_num)
-            self.log_download(log_num, filename)
+                filename = vehicle.default_log_filename(log_num)
+            vehicle.log_download(log_num, filename)
         else:
             print(usage)
 
     def update_status(self):
         '''update log download status in console'''
         now = time.time()
-        if self.download_file is not None and now - self.last_status > 0.5:
+        if now - self.last_status > 0.5:
             self.last_status = now
             self.log_status(True)
 
     def idle_task(self):
         '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        if len(self.vehicles) == 0:
+            return
+        self.update_budget()
+        for v in list(self.vehicles.values()):
+            v.idle_task()
         self.update_status()
 
+    def unload(self):
+        '''keep partial downloads so they can be resumed'''
+        for v in self.vehicles.values():
+            if v.download is not None:
+                v.download.close()
+        super(LogModule, self).unload()
+
 
 def init(mpstate):
     '''initialise module'''
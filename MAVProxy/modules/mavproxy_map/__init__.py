@@ -30,6 +30,8 @@ class MapModule(mp_module.MPModule):
         self.fence_change_time = 0
         self.rally_change_time = 0
         self.terrain_contour_ids = []
+        self.terrain_contours = None
+        self.terrain_contours_hidden = False
         self.have_simstate = False
         self.have_vehicle = {}
         self.move_wp = -1
@@ -78,6 +80,14 @@ class MapModule(mp_module.MPModule):
         service = 'MicrosoftHyb'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        tile_store = os.environ.get('MAP_TILE_STORE', 'dir')
+        self.tile_service = service
+        self.tile_store = tile_store
+        # tile cache seeding, with its own tile downloader
+        self.seeder = None
+        self.seed_mt = None
+        # seeders whose estimate has not been shown yet
+        self.seed_estimates = []
         from MAVProxy.modules.mavproxy_map import mp_slipmap
         title = "Map"
         if self.instance > 1:
@@ -86,7 +96,8 @@ class MapModule(mp_module.MPModule):
         terrain_module = self.module('terrain')
         if terrain_module is not None:
             elevation = terrain_module.ElevationModel.database
-        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title)
+        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title,
+                                        tile_store=tile_store)
         if self.instance == 1:
             self.mpstate.map = self.map
             mpstate.map_functions = {'draw_lines' : self.draw_lines}
@@ -100,7 +111,9 @@ class MapModule(mp_module.MPModule):
                                                                 'follow',
                                                                 'menu',
                                                                 'marker',
-                                                                'clear'])
+                                                                'clear',
+                                                                'seed',
+                                                                'cache'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -354,9 +367,107 @@ class MapModule(mp_module.MPModule):
             self.cmd_set_roi(args)
         elif args[0] == "setposition":
             self.cmd_set_position(args)
+        elif args[0] == "seed":
+            self.cmd_map_seed(args[1:])
+        elif args[0] == "cache":
+            if len(args) > 1 and args[1] not in ["reset"]:
+                print("Usage: map cache [reset]")
+                return
+            self.map.add_object(mp_slipmap.SlipTileCacheStatus(reset=(len(args) > 1)))
         else:
             print("usage: map <icon|set>")
 
+    def cmd_map_seed(self, args):
+        '''download map tiles for offline use'''
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        from MAVProxy.modules.mavproxy_map import mp_tileseed
+        usage = '''
+Usage: map seed [estimate] bbox <lat1> <lon1> <lat2> <lon2> <minzoom> <maxzoom>
+Usage: map seed [estimate] <mission|fence> <buffer> <minzoom> <maxzoom>
+Usage: map seed <status|stop>
+        '''
+        if len(args) == 0:
+            print(usage)
+            return
+        if args[0] == "status":
+            if self.seeder is None:
+                print("No map seed running")
+            else:
+                print(self.seeder.status())
+                print(self.seed_mt.download_status())
+            return
+        if args[0] == "stop":
+            if self.seeder is not None:
+                self.seeder.stop()
+                print("Stopped map seed: %s" % self.seeder.status())
+                if self.seeder in self.seed_estimates:
+                    self.seed_estimates.remove(self.seeder)
+                self.seeder = None
+            return
+        estimate_only = False
+        if args[0] == "estimate":
+            estimate_only = True
+            args = args[1:]
+        if len(args) == 7 and args[0] == "bbox":
+            area = mp_tileseed.SeedArea()
+            area.add_bbox(float(args[1]), float(args[2]), float(args[3]), float(args[4]))
+            zooms = args[5:7]
+        elif len(args) == 4 and args[0] in ["mission", "fence"]:
+            area = mp_tileseed.SeedArea(buffer=float(args[1]))
+            if args[0] == "mission":
+                self.seed_area_mission(area)
+            else:
+                self.seed_area_fence(area)
+            zooms = args[2:4]
+        else:
+            print(usage)
+            return
+        if area.empty():
+            print("No %s loaded" % args[0])
+            return
+        if self.seeder is not None and not estimate_only:
+            print("Map seed already running, use map seed stop")
+            return
+        if self.seed_mt is None:
+            self.seed_mt = mp_tile.MPTile(service=self.tile_service, tile_store=self.tile_store)
+        seed_mt = self.seed_mt
+        (min_zoom, max_zoom) = (int(zooms[0]), int(zooms[1]))
+        # finding the tiles and which are cached can take a while, so is
+        # done in the seeder's thread. The estimate is shown from idle_task
+        seeder = mp_tileseed.TileSeeder(seed_mt, lambda: mp_tileseed.seed_tiles(seed_mt, area, min_zoom, max_zoom))
+        print("Checking tile cache")
+        self.seed_estimates.append(seeder)
+        if not estimate_only:
+            self.seeder = seeder
+
+    def seed_area_mission(self, area):
+        '''add the loaded mission to a seed area'''
+        wp_module = self.module('wp')
+        if wp_module is None:
+            return
+        for path in wp_module.wploader.polygon_list():
+            area.add_path(path)
+
+    def seed_area_fence(self, area):
+        '''add the loaded fence to a seed area'''
+        fence_module = self.module('fence')
+        if fence_module is None:
+            return
+        if getattr(fence_module, "cmd_addcircle", None) is None:
+            area.add_polygon(fence_module.fenceloader.polygon())
+            return
+
+        def item_latlon(item):
+            if item.get_type() == 'MISSION_ITEM_INT':
+                return (item.x * 1e-7, item.y * 1e-7)
+            return (item.x, item.y)
+
+        for polygon in fence_module.inclusion_polygons() + fence_module.exclusion_polygons():
+            area.add_polygon([item_latlon(p) for p in polygon])
+        for circle in fence_module.inclusion_circles() + fence_module.exclusion_circles():
+            (lat, lon) = item_latlon(circle)
+            area.add_circle(lat, lon, circle.param1)
+
     def cmd_map_circle(self, args):
         usage = '''
 Usage: map circle <lat> <lon> <radius> <colour>
@@ -835,6 +946,9 @@ Usage: map circle <radius> <colour>
         if isinstance(obj, mp_slipmap.SlipMenuEvent):
             self.handle_menu_event(obj)
             return
+        if isinstance(obj, mp_slipmap.SlipTileCacheStatus):
+            print(obj.text)
+            return
         if not isinstance(obj, mp_slipmap.SlipMouseEvent):
             return
         if obj.event.leftIsDown and self.moving_rally is not None:
@@ -934,6 +1048,20 @@ Usage: map circle <radius> <colour>
         # check for any events from the map
         self.map.check_events()
 
+        if self.terrain_contours is not None:
+            self.add_terrain_contours()
+
+        for seeder in self.seed_estimates[:]:
+            if seeder.scanned():
+                print(seeder.estimate())
+                self.seed_estimates.remove(seeder)
+
+        if self.seeder is not None:
+            self.seeder.update()
+            if self.seeder.done():
+                print("Map seed done: %s" % self.seeder.status())
+                self.seeder = None
+
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
         from MAVProxy.modules.mavproxy_map import mp_slipmap
@@ -1423,22 +1551,10 @@ Usage: map circle <radius> <colour>
         Show terrain contours
         """
         from MAVProxy.modules.mavproxy_map import mp_slipmap
-        import numpy as np
-
-        # configure matplotlib for non-gui use
-        import matplotlib
-        matplotlib.use('Agg')
-
-        # disable interactive plotting mode
-        import matplotlib.pyplot as plt
-        plt.ioff()
-
         terrain_module = self.module('terrain')
         if terrain_module is None:
             return
 
-        elevation_model = terrain_module.ElevationModel
-
         # show contours if they have already been calculated
         if len(self.terrain_contour_ids) > 0:
             self.show_terrain_contours()
@@ -1450,79 +1566,50 @@ Usage: map circle <radius> <colour>
 
         (lat, lon) = self.mpstate.click_location
 
-        # retrieve grid options from map settings
-        grid_spacing = self.map_settings.contour_grid_spacing
-        grid_extent = self.map_settings.contour_grid_extent
-        levels = self.map_settings.contour_levels
-
-        # create mesh grid
-        x = np.arange(-0.5 * grid_extent, 0.5 * grid_extent, grid_spacing)
-        y = np.arange(-0.5 * grid_extent, 0.5 * grid_extent, grid_spacing)
-        x_grid, y_grid = np.meshgrid(x, y)
-
-        def terrain_surface(lat, lon, x, y):
-            """
-            Calculate terrain altitudes for the NED offsets (x, y)
-            centred on (lat, lon).
-            """
-            alt = []
-            for east in y:
-                alt_y = []
-                for north in x:
-                    (lat2, lon2) = mp_util.gps_offset(lat, lon, east, north)
-                    alt_y.append(elevation_model.GetElevation(lat2, lon2))
-                alt.append(alt_y)
-            return alt
-
-        def ned_to_latlon(contours, lat, lon):
-            """
-            Convert contour polygons in NED coordinates offset from (lat, lon)
-            to polygons in orthometric coordinates.
-            """
-            contours_latlon = []
-            for polygons in contours:
-                polygons_latlon = []
-                for polygon in polygons:
-                    polygon_latlon = []
-                    for point in polygon:
-                        (north, east) = point
-                        (lat2, lon2) = mp_util.gps_offset(lat, lon, east, north)
-                        polygon_latlon.append([lat2, lon2])
-                    polygons_latlon.append(polygon_latlon)
-                contours_latlon.append(polygons_latlon)
-            return contours_latlon
-
-        # generate surface and contours
-        z_grid = np.array(terrain_surface(lat, lon, x, y))
-        _, (ax1) = plt.subplots(1, 1, figsize=(10, 10))
-        cs = ax1.contour(x_grid, y_grid, z_grid, levels=levels)
-        contours = ned_to_latlon(cs.allsegs, lat, lon)
-
-        # add terrain layer and contour polygons
-        self.map.add_object(mp_slipmap.SlipClearLayer('Terrain'))
+        elevation_model = terrain_module.ElevationModel
+        if self.terrain_contours is None or self.terrain_contours.elevation_model is not elevation_model:
+            from MAVProxy.modules.mavproxy_map import mp_contours
+            self.terrain_contours = mp_contours.TerrainContours(elevation_model)
 
+        # add terrain layer, the contour polygons are added as each
+        # tile is generated
+        self.map.add_object(mp_slipmap.SlipClearLayer('Terrain'))
         self.terrain_contour_ids.clear()
-        num_contours = len(contours)
-        for i in range(num_contours):
-            polygons = contours[i]
-            for j in range(len(polygons)):
-                p = polygons[j]
-                if len(p) > 1:
-                    id = f"terrain {i} {j}"
-                    self.terrain_contour_ids.append(id)
-                    contour_colour = (255, 255, 255)
-                    self.map.add_object(mp_slipmap.SlipPolygon(
-                        id, p,
-                        layer='Terrain', linewidth=1,
-                        colour=contour_colour,
-                        showcircles=False
-                    ))
+        self.terrain_contours_hidden = False
+        self.terrain_contours.start(lat, lon,
+                                    self.map_settings.contour_grid_extent,
+                                    self.map_settings.contour_grid_spacing,
+                                    self.map_settings.contour_levels)
+
+    def add_terrain_contours(self):
+        """
+        Add contour polygons for tiles generated since the last call.
+        """
+        from MAVProxy.modules.mavproxy_map import mp_slipmap
+        for (key, lines) in self.terrain_contours.poll():
+            if key is None:
+                print("No terrain data for contours")
+                continue
+            (spacing, interval, iy, ix) = key
+            for j in range(len(lines)):
+                id = f"terrain {iy} {ix} {j}"
+                self.terrain_contour_ids.append(id)
+                contour_colour = (255, 255, 255)
+                polygon = mp_slipmap.SlipPolygon(
+                    id, lines[j],
+                    layer='Terrain', linewidth=1,
+                    colour=contour_colour,
+                    showcircles=False
+                )
+                polygon.set_hidden(self.terrain_contours_hidden)
+                self.map.add_object(polygon)
 
     def show_terrain_contours(self):
         """
         Show terrain contours.
         """
         # unhide polygons
+        self.terrain_contours_hidden = False
         for id in self.terrain_contour_ids:
             self.map.hide_object(id, hide=False)
 
@@ -1531,6 +1618,7 @@ Usage: map circle <radius> <colour>
         Hide terrain contours.
         """
         # hide polygons
+        self.terrain_contours_hidden = True
         for id in self.terrain_contour_ids:
             self.map.hide_object(id, hide=True)
 
@@ -1538,6 +1626,9 @@ Usage: map circle <radius> <colour>
         """
         Remove terrain contours and the terrain clear layer.
         """
+        # stop generating any more
+        if self.terrain_contours is not None:
+            self.terrain_contours.cancel()
         # remove polygons
         for id in self.terrain_contour_ids:
             self.map.remove_object(id)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+'''
+terrain contours for the map
+
+The area is split into tiles on a fixed lat/lon grid. Each tile is
+sampled with one vectorized elevation lookup and contoured at levels
+which are multiples of a common interval, so the lines of neighbouring
+tiles meet at the shared tile edges. Contoured tiles are cached, and
+new tiles are generated by a worker thread nearest first so the map
+can show them as they arrive.
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+
+# grid cells along each side of a tile
+TILE_CELLS = 64
+
+# meters per degree of latitude
+METERS_PER_DEGREE = math.radians(1) * mp_util.radius_of_earth
+
+
+def contour_interval(zmin, zmax, count):
+    '''return a round interval giving about count levels between zmin and zmax'''
+    span = max(zmax - zmin, 1.0) / max(count, 1)
+    scale = 10 ** math.floor(math.log10(span))
+    for step in [1, 2, 2.5, 5, 10]:
+        if step * scale >= span:
+            return step * scale
+    return 10 * scale
+
+
+def contour_lines(x, y, z, levels):
+    '''return a list of (level, Nx2 array of x/y points) for each contour
+    line of a grid. z has shape (len(y), len(x)) and may contain NaN'''
+    try:
+        import contourpy
+    except ImportError:
+        contourpy = None
+    ret = []
+    if contourpy is not None:
+        gen = contourpy.contour_generator(x, y, np.ma.masked_invalid(z), line_type=contourpy.LineType.Separate)
+        for level in levels:
+            for line in gen.lines(level):
+                ret.append((level, line))
+        return ret
+    # older matplotlib without contourpy
+    from matplotlib.figure import Figure
+    ax = Figure().subplots()
+    cs = ax.contour(x, y, np.ma.masked_invalid(z), levels=levels)
+    for (level, segs) in zip(cs.levels, cs.allsegs):
+        for line in segs:
+            ret.append((level, line))
+    return ret
+
+
+class ContourTiles(object):
+    '''the tiling of the area for a grid spacing in meters'''
+    def __init__(self, spacing):
+        self.spacing = spacing
+        self.tile_lat = TILE_CELLS * spacing / METERS_PER_DEGREE
+
+    def tile_lon(self, iy):
+        '''longitude size of tiles in row iy, the same across each whole
+        degree of latitude'''
+        lat = math.floor(iy * self.tile_lat) + 0.5
+        return self.tile_lat / max(math.cos(math.radians(lat)), 0.01)
+
+    def tiles(self, lat, lon, extent):
+        '''return the (iy, ix) of the tiles covering a square of extent
+        meters centred on lat/lon, nearest first'''
+        (lat1, lon1) = mp_util.gps_offset(lat, lon, -0.5 * extent, -0.5 * extent)
+        (lat2, lon2) = mp_util.gps_offset(lat, lon, 0.5 * extent, 0.5 * extent)
+        ret = []
+        for iy in range(int(math.floor(lat1 / self.tile_lat)), int(math.floor(lat2 / self.tile_lat)) + 1):
+            tile_lon = self.tile_lon(iy)
+            for ix in range(int(math.floor(lon1 / tile_lon)), int(math.floor(lon2 / tile_lon)) + 1):
+                ret.append((iy, ix))
+
+        def distance(tile):
+            (lats, lons) = self.grid(*tile)
+            return mp_util.gps_distance(lat, lon, lats[TILE_CELLS // 2], lons[TILE_CELLS // 2])
+        ret.sort(key=distance)
+        return ret
+
+    def grid(self, iy, ix):
+        '''return the latitudes and longitudes of the samples of a tile,
+        including both edges'''
+        tile_lon = self.tile_lon(iy)
+        steps = np.arange(TILE_CELLS + 1) / float(TILE_CELLS)
+        return ((iy + steps) * self.tile_lat, (ix + steps) * tile_lon)
+
+
+class TerrainContours(object):
+    '''generate contour lines in a worker thread. Call poll() to get
+    (key, lines) for each tile as it is done, where lines is a list of
+    lists of (lat, lon)'''
+    def __init__(self, elevation_model, max_tiles=1000, timeout=30):
+        self.elevation_model = elevation_model
+        self.max_tiles = max_tiles
+        # time to wait for terrain data for a tile
+        self.timeout = timeout
+        # (spacing, interval, iy, ix) -> lines
+        self.cache = OrderedDict()
+        self.results = queue.Queue()
+        # the area being generated and the tiles left to do
+        self.request = None
+        self.jobs = []
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def levels_interval(self, lat, lon, extent, count):
+        '''find the contour interval for count levels over an area from a
+        coarse sample of it'''
+        offsets = np.linspace(-0.5 * extent, 0.5 * extent, 32)
+        (east, north) = np.meshgrid(offsets, offsets)
+        dlat = north / METERS_PER_DEGREE
+        dlon = east / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        alts = self.elevation_model.GetElevationArray(lat + dlat, lon + dlon, timeout=self.timeout)
+        if np.isnan(alts).all():
+            return None
+        return contour_interval(np.nanmin(alts), np.nanmax(alts), count)
+
+    def start(self, lat, lon, extent, spacing, count):
+        '''start generating contours with about count levels for a square
+        area of extent meters, replacing any area being generated'''
+        with self.lock:
+            self.generation += 1
+            self.request = (self.generation, lat, lon, extent, spacing, count)
+            self.jobs = []
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, name='TerrainContours')
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def cancel(self):
+        '''stop generating, dropping any results not yet polled'''
+        with self.lock:
+            self.generation += 1
+            self.request = None
+            self.jobs = []
+
+    def busy(self):
+        return self.request is not None or len(self.jobs) > 0
+
+    def poll(self):
+        '''return the list of (key, lines) of tiles done since the last
+        poll. lines is None if there was no terrain for the area'''
+        ret = []
+        while True:
+            try:
+                (generation, key, lines) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                ret.append((key, lines))
+        return ret
+
+    def plan(self, request):
+        '''work out the tiles for a request, passing on cached tiles'''
+        (generation, lat, lon, extent, spacing, count) = request
+        interval = self.levels_interval(lat, lon, extent, count)
+        if interval is None:
+            self.results.put((generation, None, None))
+            return
+        tiles = ContourTiles(spacing)
+        jobs = []
+        with self.lock:
+            if generation != self.generation:
+                return
+            for (iy, ix) in tiles.tiles(lat, lon, extent):
+                key = (spacing, interval, iy, ix)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.results.put((generation, key, self.cache[key]))
+                else:
+                    jobs.append((key, tiles))
+            self.jobs = jobs
+
+    def contour_tile(self, key, tiles):
+        '''return the lines of a tile, or None if terrain isn't available'''
+        (spacing, interval, iy, ix) = key
+        (lats, lons) = tiles.grid(iy, ix)
+        (lon_grid, lat_grid) = np.meshgrid(lons, lats)
+        alts = self.elevation_model.GetElevationArray(lat_grid, lon_grid, timeout=self.timeout)
+        if np.isnan(alts).all():
+            return None
+        zmin = np.nanmin(alts)
+        zmax = np.nanmax(alts)
+        levels = np.arange(math.ceil(zmin / interval), math.floor(zmax / interval) + 1) * interval
+        lines = []
+        if len(levels) > 0:
+            for (level, line) in contour_lines(lons, lats, alts, levels):
+                if len(line) > 1:
+                    lines.append([(lat, lon) for (lon, lat) in line.tolist()])
+        return lines
+
+    def worker(self):
+        '''thread generating the requested tiles'''
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                with self.lock:
+                    request = self.request
+                    self.request = None
+                if request is not None:
+                    self.plan(request)
+                with self.lock:
+                    if len(self.jobs) == 0:
+                        break
+                    (key, tiles) = self.jobs.pop(0)
+                    generation = self.generation
+                lines = self.contour_tile(key, tiles)
+                if lines is None:
+                    continue
+                with self.lock:
+                    self.cache[key] = lines
+                    while len(self.cache) > self.max_tiles:
+                        self.cache.popitem(last=False)
+                self.results.put((generation, key, lines))
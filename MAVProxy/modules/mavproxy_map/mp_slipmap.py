@@ -35,7 +35,8 @@ class MPSlipMap():
                  elevation=None,
                  download=True,
                  show_flightmode_legend=True,
-                 timelim_pipe=None):
+                 timelim_pipe=None,
+                 tile_store='dir'):
 
         self.lat = lat
         self.lon = lon
@@ -52,6 +53,7 @@ class MPSlipMap():
         self.brightness = brightness
         self.legend = show_flightmode_legend
         self.timelim_pipe = timelim_pipe
+        self.tile_store = tile_store
 
         self.drag_step = 10
 
@@ -83,8 +85,13 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 tile_store=self.tile_store)
         state.layers = {}
+        # bumped whenever something in a layer changes
+        state.layer_version = {}
+        # spatial index of the objects in each layer
+        state.layer_index = {}
         state.info = {}
         state.need_redraw = True
 
@@ -207,6 +214,7 @@ if __name__ == "__main__":
     parser.add_argument("--service", default="MicrosoftSat", help="tile service")
     parser.add_argument("--offline", action='store_true', default=False, help="no download")
     parser.add_argument("--delay", type=float, default=0.3, help="tile download delay")
+    parser.add_argument("--tile-store", default='dir', choices=['dir', 'mbtiles'], help="tile store")
     parser.add_argument("--max-zoom", type=int, default=19, help="maximum tile zoom")
     parser.add_argument("--debug", action='store_true', default=False, help="show debug info")
     parser.add_argument("--boundary", default=None, help="show boundary")
@@ -226,7 +234,8 @@ if __name__ == "__main__":
                    debug=args.debug,
                    max_zoom=args.max_zoom,
                    elevation=args.elevation,
-                   tile_delay=args.delay)
+                   tile_delay=args.delay,
+                   tile_store=args.tile_store)
 
     if args.boundary:
         boundary = mp_util.polygon_load(args.boundary)
@@ -22,6 +22,8 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipHideObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIcon
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipInformation
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipKeyEvent
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipLayerOverlay
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipSpatialIndex
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMenuEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMouseEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObject
@@ -29,6 +31,7 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObjectSelection
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPosition
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipRemoveObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipTileCacheStatus
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollow
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollowObject
@@ -209,6 +212,29 @@ class MPSlipMapFrame(wx.Frame):
             )
         ])
 
+    def layer_changed(self, layer, key=None):
+        '''note that the objects in a layer need drawing again, and
+        update the spatial index for the object key, or for the whole
+        layer if key is None'''
+        state = self.state
+        state.layer_version[layer] = state.layer_version.get(layer, 0) + 1
+        state.need_redraw = True
+        objects = state.layers.get(layer, None)
+        if objects is None:
+            state.layer_index.pop(layer, None)
+            return
+        index = state.layer_index.get(layer, None)
+        if index is None:
+            index = SlipSpatialIndex()
+            state.layer_index[layer] = index
+            key = None
+        if key is None:
+            index.rebuild(objects)
+        elif key in objects:
+            index.add(key, objects[key])
+        else:
+            index.remove(key)
+
     def add_object(self, obj):
         '''add an object to a layer'''
         state = self.state
@@ -216,7 +242,7 @@ class MPSlipMapFrame(wx.Frame):
             # its a new layer
             state.layers[obj.layer] = {}
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        self.layer_changed(obj.layer, obj.key)
         if (not self.legend_checkbox_menuitem_added and
                 isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -227,7 +253,8 @@ class MPSlipMapFrame(wx.Frame):
         '''remove an object by key from all layers'''
         state = self.state
         for layer in state.layers:
-            state.layers[layer].pop(key, None)
+            if state.layers[layer].pop(key, None) is not None:
+                self.layer_changed(layer, key)
         state.need_redraw = True
 
     def on_idle(self, event):
@@ -265,7 +292,7 @@ class MPSlipMapFrame(wx.Frame):
                         object.label = obj.label
                     if obj.colour is not None:
                         object.colour = obj.colour
-                    state.need_redraw = True
+                    self.layer_changed(object.layer, obj.key)
 
             if isinstance(obj, SlipDefaultPopup):
                 state.default_popup = obj
@@ -311,6 +338,7 @@ class MPSlipMapFrame(wx.Frame):
                 # remove all objects from a layer
                 if obj.layer in state.layers:
                     state.layers.pop(obj.layer)
+                    self.layer_changed(obj.layer)
                 state.need_redraw = True
 
             if isinstance(obj, SlipRemoveObject):
@@ -318,13 +346,22 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     if obj.key in state.layers[layer]:
                         state.layers[layer].pop(obj.key)
+                        self.layer_changed(layer, obj.key)
                 state.need_redraw = True
 
+            if isinstance(obj, SlipTileCacheStatus):
+                # report tile cache statistics to the parent
+                obj.text = "\n".join([state.mt.cache_status(), state.mt.download_status()])
+                if obj.reset:
+                    state.mt.reset_cache_stats()
+                state.event_queue.put(obj)
+
             if isinstance(obj, SlipHideObject):
                 # hide an object by key
                 for layer in state.layers:
                     if obj.key in state.layers[layer]:
                         state.layers[layer][obj.key].set_hidden(obj.hide)
+                        self.layer_changed(layer, obj.key)
                 state.need_redraw = True
 
         if state.timelim_pipe is not None:
@@ -337,6 +374,7 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     for key in state.layers[layer].keys():
                         state.layers[layer][key].set_time_range(obj)
+                    self.layer_changed(layer)
                 state.need_redraw = True
 
         if obj is None:
@@ -406,6 +444,14 @@ class MPSlipMapPanel(wx.Panel):
         self.pixmapper = functools.partial(self.pixel_coords)
 
         self.last_view = None
+        # the map tiles with brightness and grid applied, and the view
+        # they were drawn for
+        self.background_view = None
+        # pre-rendered layers for the view in overlay_view
+        self.overlay_view = None
+        self.overlays = {}
+        # layer versions drawn by the last redraw
+        self.drawn_versions = {}
         self.redraw_map()
         state.frame.Fit()
 
@@ -570,16 +616,37 @@ class MPSlipMapPanel(wx.Panel):
         (lat, lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
-        keys = sorted(objects.keys())
-        for k in keys:
+    def view_bounds(self):
+        '''return the (lat, lon, dlat, dlon) bounding box of the view'''
+        state = self.state
+        (lat2, lon2) = self.coordinates(state.width-1, state.height-1)
+        return (lat2, state.lon, state.lat-lat2, mp_util.wrap_180(lon2-state.lon))
+
+    def visible_keys(self, layer, bounds):
+        '''return the sorted keys of the objects in a layer to be drawn
+        within bounds'''
+        state = self.state
+        objects = state.layers[layer]
+        index = state.layer_index.get(layer, None)
+        if index is None:
+            candidates = objects.keys()
+        else:
+            candidates = index.query(bounds)
+        keys = []
+        for k in candidates:
             obj = objects[k]
-            if not self.state.legend and isinstance(obj, SlipFlightModeLegend):
+            if not state.legend and isinstance(obj, SlipFlightModeLegend):
                 continue
             bounds2 = obj.bounds()
             if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
-                obj.draw(img, self.pixmapper, bounds)
+                keys.append(k)
+        return sorted(keys)
+
+    def draw_objects(self, layer, bounds, img):
+        '''draw the objects of a layer on the image'''
+        objects = self.state.layers[layer]
+        for k in self.visible_keys(layer, bounds):
+            objects[k].draw(img, self.pixmapper, bounds)
 
     def redraw_map(self):
         '''redraw the map with current settings'''
@@ -590,34 +657,48 @@ class MPSlipMapPanel(wx.Panel):
         if view_same and not state.need_redraw:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-
         # find display bounding box
-        (lat2, lon2) = self.coordinates(state.width-1, state.height-1)
-        bounds = (lat2, state.lon, state.lat-lat2, mp_util.wrap_180(lon2-state.lon))
+        bounds = self.view_bounds()
+
+        # the map tiles only need fetching again when the view changes
+        # or while tiles are still arriving
+        background_view = self.current_view() + (state.brightness, state.grid, state.mt.get_service())
+        if background_view != self.background_view or state.mt.tiles_pending() > 0:
+            self.redraw_background(bounds)
+            self.background_view = background_view
 
         # get the image
         img = self.map_img.copy()
 
-        # possibly draw a grid
-        if state.grid:
-            self.grid_spacing = SlipGrid('grid', layer=3, linewidth=1, colour=(255, 255, 0)).draw(img, self.pixmapper, bounds)
-        else:
-            self.grid_spacing = None
+        # layers which haven't changed since the last redraw of this
+        # view are pre-rendered and composited rather than drawn
+        overlay_view = (state.lat, state.lon, state.width, state.height, state.ground_width, state.legend)
+        view_stable = overlay_view == self.overlay_view
+        if not view_stable:
+            self.overlays = {}
+            self.overlay_view = overlay_view
 
         # draw layer objects
         keys = state.layers.keys()
         keys = sorted(list(keys))
         for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+            version = state.layer_version.get(k, 0)
+            overlay = self.overlays.get(k, None)
+            if overlay is not None and overlay.version != version:
+                overlay = None
+            if overlay is None and view_stable and self.drawn_versions.get(k, None) == version:
+                overlay = SlipLayerOverlay.render(state.layers[k],
+                                                  functools.partial(self.draw_objects, k, bounds),
+                                                  img.shape, version)
+                self.overlays[k] = overlay
+            if overlay is not None and overlay.usable():
+                overlay.apply(img)
+            else:
+                self.draw_objects(k, bounds, img)
+            self.drawn_versions[k] = version
+        for k in list(self.overlays.keys()):
+            if k not in state.layers:
+                self.overlays.pop(k)
 
         # draw information objects
         for key in state.info:
@@ -633,6 +714,25 @@ class MPSlipMapPanel(wx.Panel):
         self.last_view = self.current_view()
         state.need_redraw = False
 
+    def redraw_background(self, bounds):
+        '''fetch the map tiles for the view'''
+        state = self.state
+        self.map_img = state.mt.area_to_image(state.lat, state.lon,
+                                              state.width, state.height, state.ground_width)
+        if state.brightness != 0: # valid state.brightness range is [-255, 255]
+            brightness = np.uint8(np.abs(state.brightness))
+            if state.brightness > 0:
+                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
+            else:
+                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
+
+        # possibly draw a grid
+        if state.grid:
+            self.grid_spacing = SlipGrid('grid', layer=3, linewidth=1, colour=(255, 255, 0)).draw(
+                self.map_img, self.pixmapper, bounds)
+        else:
+            self.grid_spacing = None
+
     def on_redraw_timer(self, event):
         '''the redraw timer ensures we show new map tiles as they
         are downloaded'''
@@ -666,8 +766,10 @@ class MPSlipMapPanel(wx.Panel):
         state = self.state
         selected = []
         (px, py) = pos
+        # only objects in the view can be under the mouse
+        bounds = self.view_bounds()
         for layer in state.layers:
-            for key in state.layers[layer]:
+            for key in self.visible_keys(layer, bounds):
                 obj = state.layers[layer][key]
                 distance = obj.clicked(px, py)
                 if distance is not None:
@@ -770,6 +872,7 @@ class MPSlipMapPanel(wx.Panel):
                 if (isinstance(state.layers[layer][key], SlipThumbnail) and
                         not isinstance(state.layers[layer][key], SlipIcon)):
                     state.layers[layer].pop(key)
+                    state.frame.layer_changed(layer, key)
 
     def on_key_down(self, event):
         '''handle keyboard input'''
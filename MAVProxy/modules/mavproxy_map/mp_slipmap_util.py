@@ -29,6 +29,10 @@ def image_shape(img):
 
 class SlipObject:
     '''an object to display on the map'''
+    # objects which draw the same thing each time for a given view can
+    # be pre-rendered into a layer overlay
+    cacheable = True
+
     def __init__(self, key, layer, popup_menu=None):
         self.key = key
         self.layer = str(layer)
@@ -93,6 +97,143 @@ class SlipObject:
         self._timestamp_range = trange
 
 
+class SlipLayerOverlay:
+    '''a layer pre-rendered for one view. It holds the pixels the layer
+    changes and how much of the pixel underneath shows through, so it
+    can be composited over the map without drawing the objects again'''
+    def __init__(self, version, idx=None, colour=None, transmit=None):
+        self.version = version
+        # idx is None if the layer can't be pre-rendered
+        self.idx = idx
+        self.colour = colour
+        self.transmit = transmit
+
+    @staticmethod
+    def render(objects, draw, shape, version):
+        '''pre-render a layer by calling draw(img) on black, white and
+        grey images. The result can't be used if an object draws
+        differently over time, or doesn't blend linearly with the
+        pixels under it'''
+        for obj in objects.values():
+            if not getattr(obj, 'cacheable', True):
+                return SlipLayerOverlay(version)
+        black = np.zeros(shape, np.uint8)
+        white = np.full(shape, 255, np.uint8)
+        grey = np.full(shape, 128, np.uint8)
+        for img in [black, white, grey]:
+            draw(img)
+        colour = black.reshape(-1).astype(np.int16)
+        transmit = white.reshape(-1).astype(np.int16) - colour
+        predicted = colour + (128 * transmit + 127) // 255
+        if transmit.min() < 0 or np.abs(predicted - grey.reshape(-1)).max() > 1:
+            return SlipLayerOverlay(version)
+        overlay = SlipLayerOverlay(version)
+        # opaque pixels are copied, the rest blended
+        overlay.opaque_idx = np.flatnonzero(transmit == 0).astype(np.int32)
+        overlay.opaque_colour = colour[overlay.opaque_idx].astype(np.uint8)
+        idx = np.flatnonzero((transmit != 0) & ((transmit != 255) | (colour != 0))).astype(np.int32)
+        overlay.idx = idx
+        overlay.colour = colour[idx].astype(np.uint16)
+        overlay.transmit = transmit[idx].astype(np.uint16)
+        return overlay
+
+    def usable(self):
+        return self.idx is not None
+
+    def apply(self, img):
+        '''composite onto a contiguous image'''
+        flat = img.reshape(-1)
+        flat[self.opaque_idx] = self.opaque_colour
+        if len(self.idx) > 0:
+            under = flat[self.idx].astype(np.uint16)
+            flat[self.idx] = np.minimum(self.colour + (under * self.transmit + 127) // 255, 255)
+
+
+class SlipSpatialIndex:
+    '''a grid over lat/lon holding the keys of the objects in a layer
+    whose bounds touch each cell, so the objects in a view can be found
+    without checking the bounds of every object in the layer'''
+    def __init__(self, cell_size=0.05, max_cells=64):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(360.0 / cell_size))
+        # objects covering more cells than this are always returned
+        self.max_cells = max_cells
+        # (row, column) -> set of keys
+        self.cells = {}
+        # key -> list of cells, or None if not in the grid
+        self.object_cells = {}
+        self.unindexed = set()
+
+    def cell_range(self, bounds):
+        '''return (row1, row2, column, ncolumns) of the cells covering
+        (lat, lon, dlat, dlon) bounds'''
+        (lat, lon, dlat, dlon) = bounds
+        eps = 1.0e-9
+        row1 = int(math.floor((lat - eps) / self.cell_size))
+        row2 = int(math.floor((lat + dlat + eps) / self.cell_size))
+        lon = mp_util.wrap_180(lon) + 180.0
+        column = int(math.floor((lon - eps) / self.cell_size))
+        ncolumns = int(math.floor((lon + dlon + eps) / self.cell_size)) - column + 1
+        return (row1, row2, column, ncolumns)
+
+    def add(self, key, obj):
+        '''add an object, or update it if its bounds have changed'''
+        self.remove(key)
+        bounds = obj.bounds()
+        if bounds is not None:
+            (row1, row2, column, ncolumns) = self.cell_range(bounds)
+            if (row2 - row1 + 1) * ncolumns > self.max_cells:
+                bounds = None
+        if bounds is None:
+            self.object_cells[key] = None
+            self.unindexed.add(key)
+            return
+        cells = [(r, c % self.columns) for r in range(row1, row2+1) for c in range(column, column+ncolumns)]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(key)
+        self.object_cells[key] = cells
+
+    def remove(self, key):
+        if key not in self.object_cells:
+            return
+        cells = self.object_cells.pop(key)
+        if cells is None:
+            self.unindexed.discard(key)
+            return
+        for cell in cells:
+            keys = self.cells[cell]
+            keys.discard(key)
+            if len(keys) == 0:
+                self.cells.pop(cell)
+
+    def rebuild(self, objects):
+        '''index a dictionary of objects from scratch'''
+        self.cells = {}
+        self.object_cells = {}
+        self.unindexed = set()
+        for (key, obj) in objects.items():
+            self.add(key, obj)
+
+    def query(self, bounds):
+        '''return the set of keys of objects which may overlap bounds'''
+        if bounds[3] >= 180:
+            return set(self.object_cells.keys())
+        (row1, row2, column, ncolumns) = self.cell_range(bounds)
+        ret = set(self.unindexed)
+        if (row2 - row1 + 1) * ncolumns > len(self.cells):
+            # cheaper to look at the occupied cells
+            for ((r, c), keys) in self.cells.items():
+                if row1 <= r <= row2 and (c - column) % self.columns < ncolumns:
+                    ret.update(keys)
+            return ret
+        for r in range(row1, row2+1):
+            for c in range(column, column+ncolumns):
+                keys = self.cells.get((r, c % self.columns), None)
+                if keys is not None:
+                    ret.update(keys)
+        return ret
+
+
 class SlipLabel(SlipObject):
     '''a text label to display on the map'''
     def __init__(self, key, point, label, layer, colour, size=0.5):
@@ -644,6 +785,8 @@ class SlipClickLocation(SlipObject):
         self.key = "click"
         self.timeout = timeout
         self.start = time.time()
+        # disappears after the timeout
+        self.cacheable = (timeout == -1)
 
     def draw(self, img, pixmapper, bounds):
         '''X marks the spot'''
@@ -713,6 +856,14 @@ class SlipHideObject:
         self.hide = hide
 
 
+class SlipTileCacheStatus:
+    '''request the tile cache statistics. The map sends this back as an
+    event with text filled in'''
+    def __init__(self, reset=False):
+        self.reset = reset
+        self.text = None
+
+
 class SlipInformation:
     '''an object to display in the information box'''
     def __init__(self, key):
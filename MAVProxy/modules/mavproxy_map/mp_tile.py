@@ -20,12 +20,15 @@ AP_FLAKE8_CLEAN
 
 import collections
 import hashlib
+import heapq
+import http.client
 import sys
 import threading
 import os
-import pathlib
 import string
 import time
+import urllib.parse
+import urllib.request
 import cv2
 import numpy as np
 
@@ -43,6 +46,7 @@ else:
     url_error = (RemoteDisconnected, actual_url_error)
 
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tilestore
 
 
 class TileException(Exception):
@@ -115,6 +119,9 @@ class TileInfo:
         self.zoom = zoom
         self.service = service
         (self.offsetx, self.offsety) = offset
+        # view generation and queue entry of a pending download
+        self.view_gen = 0
+        self.queue_seq = 0
         self.refresh_time()
 
     def key(self):
@@ -178,11 +185,130 @@ class TileInfoScaled(TileInfo):
         (self.dstx, self.dsty) = dst
 
 
+class TileDownloadStats:
+    '''throughput and latency counters for tile downloads'''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = None
+        self.requests = 0
+        self.downloaded = 0
+        self.not_modified = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add(self, result, nbytes, latency):
+        '''record a completed request; result is one of downloaded,
+        not_modified or failed'''
+        if self.start_time is None:
+            self.start_time = time.time() - latency
+        self.requests += 1
+        setattr(self, result, getattr(self, result) + 1)
+        self.bytes += nbytes
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def status(self, pending=0):
+        '''return a one line status string'''
+        elapsed = 0
+        if self.start_time is not None:
+            elapsed = max(time.time() - self.start_time, 0.001)
+        rate = 0
+        kbps = 0
+        if elapsed > 0:
+            rate = self.downloaded / elapsed
+            kbps = self.bytes / (1024.0 * elapsed)
+        avg_ms = 0
+        if self.requests > 0:
+            avg_ms = 1000.0 * self.latency_total / self.requests
+        return ("tiles: %u pending %u downloaded %u not modified %u failed %u cancelled, "
+                "%.1f tiles/s %.1f kB/s, latency avg %.0fms max %.0fms" % (
+                    pending, self.downloaded, self.not_modified, self.failed, self.cancelled,
+                    rate, kbps, avg_ms, 1000.0 * self.latency_max))
+
+
+class TileCache:
+    '''LRU cache of tile images, limited by the total bytes of the
+    images held'''
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        # download threads also add entries
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''return a cached image, or None'''
+        with self._lock:
+            img = self._entries.get(key, None)
+            if img is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def peek(self, key):
+        '''return a cached image without counting it as a use'''
+        return self._entries.get(key, None)
+
+    def put(self, key, img):
+        '''add an image, evicting the least recently used to fit'''
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._entries[key] = img
+            self.bytes += img.nbytes
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                (k, old) = self._entries.popitem(last=False)
+                self.bytes -= old.nbytes
+                self.evictions += 1
+
+    def put_if_missing(self, key, img):
+        '''add an image if there is no entry for key'''
+        if key not in self._entries:
+            self.put(key, img)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def status(self):
+        '''return a one line status string'''
+        lookups = self.hits + self.misses
+        hit_rate = 0
+        if lookups > 0:
+            hit_rate = 100.0 * self.hits / lookups
+        return "%s: %u tiles %.1f/%.1f MB, %u hits %u misses (%.1f%%), %u evictions" % (
+            self.name, len(self._entries), self.bytes / 1.0e6, self.max_bytes / 1.0e6,
+            self.hits, self.misses, hit_rate, self.evictions)
+
+
 class MPTile:
-    '''map tile object'''
+    '''map tile object
+
+    cache_size and scaled_cache_size are the memory allowed for
+    decoded and scaled tiles, in units of full size tiles'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
                  service="MicrosoftSat", tile_delay=0.3, debug=False,
-                 max_zoom=19, refresh_age=30*24*60*60):
+                 max_zoom=19, refresh_age=30*24*60*60, download_threads=4,
+                 tile_store='dir', scaled_cache_size=500):
 
         if cache_path is None:
             try:
@@ -198,6 +324,7 @@ class MPTile:
             mp_util.mkdir_p(cache_path)
 
         self.cache_path = cache_path
+        self.store = mp_tilestore.open_store(tile_store, cache_path)
         self.max_zoom = max_zoom
         self.min_zoom = 4
         self.download = download
@@ -210,12 +337,31 @@ class MPTile:
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
+        # _download_pending is a dictionary of TileInfo objects,
+        # including tiles being downloaded
         self._download_pending = {}
-        self._download_thread = None
+        # heap of (-view_gen, distance, -request_time, queue_seq, key)
+        self._download_heap = []
+        self._download_active = set()
+        self._download_lock = threading.Lock()
+        self._download_seq = 0
+        self._download_workers = 0
+        self.download_threads = download_threads
+        self.http_timeout = 10
+        # tile_delay is the minimum time between requests to one host
+        self._host_next_request = {}
+        self._proxies = urllib.request.getproxies()
+        # each new view bumps the generation, pending tiles not
+        # requested by the latest view are dropped
+        self._view_gen = 0
+        self._view_centre = None
+        self.download_stats = TileDownloadStats()
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
-        self._tile_cache = collections.OrderedDict()
+        tile_bytes = TILES_WIDTH * TILES_HEIGHT * 3
+        self._tile_cache = TileCache('decoded', cache_size * tile_bytes)
+        # tiles resized for display, keyed by (tile key, width, height)
+        self._scaled_cache = TileCache('scaled', scaled_cache_size * tile_bytes)
 
     def set_service(self, service):
         '''set tile service'''
@@ -258,101 +404,222 @@ class MPTile:
         tile = self.coord_to_tile(lat, lon, zoom)
         return self.tile_to_path(tile)
 
+    def read_tile(self, tile):
+        '''read a tile from the tile store, returning (image, mtime)
+        or (None, None) if it is not stored'''
+        (x, y) = tile.tile
+        stored = self.store.get(self.service, tile.zoom, x, y)
+        if stored is None:
+            return (None, None)
+        (data, mtime) = stored
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return (img, mtime)
+
     def tiles_pending(self):
         '''return number of tiles pending download'''
         return len(self._download_pending)
 
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
+    def set_view(self, lat, lon):
+        '''note a new view centred on lat/lon. Downloads are ordered by
+        distance from the centre, and pending tiles which are not
+        requested again for this view are cancelled'''
+        with self._download_lock:
+            self._view_gen += 1
+            self._view_centre = (lat, lon)
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+    def queue_download(self, tile):
+        '''queue a tile for download'''
+        key = tile.key()
+        with self._download_lock:
+            pending = self._download_pending.get(key, None)
+            if pending is None:
+                pending = tile
+                self._download_pending[key] = tile
+            elif pending.view_gen == self._view_gen and pending.queue_seq != 0:
+                # already queued for this view
+                pending.refresh_time()
+                return
+            pending.refresh_time()
+            pending.view_gen = self._view_gen
+            distance = 0
+            if self._view_centre is not None:
+                distance = pending.distance(self._view_centre[0], self._view_centre[1])
+            self._download_seq += 1
+            pending.queue_seq = self._download_seq
+            heapq.heappush(self._download_heap, (-pending.view_gen, distance, -pending.request_time,
+                                                 pending.queue_seq, key))
+        self.start_download_thread()
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+    def cancel_downloads(self):
+        '''drop all queued tiles which are not already downloading'''
+        with self._download_lock:
+            self.download_stats.cancelled += len(self._download_pending) - len(self._download_active)
+            self._download_heap = []
+            self._download_pending = {k: v for (k, v) in self._download_pending.items() if k in self._download_active}
+
+    def next_download(self):
+        '''return the next tile to download, or None if there are no
+        more, in which case the calling worker must exit'''
+        with self._download_lock:
+            while len(self._download_heap) > 0:
+                (ngen, distance, nrtime, seq, key) = heapq.heappop(self._download_heap)
+                tile = self._download_pending.get(key, None)
+                if tile is None or tile.queue_seq != seq or key in self._download_active:
+                    # stale entry
+                    continue
+                if tile.view_gen < self._view_gen:
+                    # scrolled out of view
+                    self._download_pending.pop(key)
+                    self.download_stats.cancelled += 1
+                    continue
+                self._download_active.add(key)
+                return tile
+            self._download_workers -= 1
+            return None
 
+    def host_wait(self, host):
+        '''time to wait before the next request to a host'''
+        with self._download_lock:
+            now = time.time()
+            t = max(now, self._host_next_request.get(host, 0))
+            self._host_next_request[host] = t + self.tile_delay
+        return t - now
+
+    def http_get(self, url, headers, conns, redirects=3):
+        '''fetch a URL, re-using a keep-alive connection per host from
+        conns. Returns (status, headers, body)'''
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme in self._proxies or parts.scheme not in ['http', 'https']:
+            # let urllib handle proxies
             try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                req.add_header('User-Agent', 'MAVProxy')
-
-                # try to re-use our cached data:
-                try:
-                    mtime = os.path.getmtime(path)
-                    req.add_header('If-Modified-Since', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime)))
-                except Exception:
-                    pass
-
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                try:
-                    if e.getcode() == 304:
-                        # cache hit; touch the file to reset its refresh time
-                        pathlib.Path(path).touch()
-                        self._download_pending.pop(key)
-                        continue
-                except Exception:
-                    pass
-
-                # print('Error loading %s' % url)
-                if key not in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if key not in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
-            else:
-                img = resp.read()
-
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if key not in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
+                resp = url_open(url_request(url, headers=headers), timeout=self.http_timeout)
+                return (resp.status, resp.headers, resp.read())
+            except urllib.error.HTTPError as e:
+                return (e.code, e.headers, b'')
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        hostkey = (parts.scheme, parts.netloc)
+        for attempt in range(2):
+            conn = conns.get(hostkey, None)
+            fresh = conn is None
+            if fresh:
+                if parts.scheme == 'https':
+                    conn = http.client.HTTPSConnection(parts.netloc, timeout=self.http_timeout)
+                else:
+                    conn = http.client.HTTPConnection(parts.netloc, timeout=self.http_timeout)
+                conns[hostkey] = conn
+            try:
+                conn.request('GET', selector, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                conns.pop(hostkey, None)
+                if fresh:
+                    raise
+                # the server closed an idle keep-alive connection
                 continue
+            if resp.will_close:
+                conn.close()
+                conns.pop(hostkey, None)
+            location = resp.getheader('Location')
+            if resp.status in [301, 302, 303, 307, 308] and location is not None and redirects > 0:
+                return self.http_get(urllib.parse.urljoin(url, location), headers, conns, redirects-1)
+            return (resp.status, resp.headers, body)
+
+    def download_tile(self, tile_info, conns):
+        '''download one tile to the cache'''
+        url = tile_info.url(self.service)
+        (x, y) = tile_info.tile
+        key = tile_info.key()
+
+        headers = {'User-Agent': 'MAVProxy'}
+        # try to re-use our cached data:
+        mtime = self.store.mtime(self.service, tile_info.zoom, x, y)
+        if mtime is not None:
+            headers['If-Modified-Since'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime))
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+
+        wait = self.host_wait(urllib.parse.urlsplit(url).netloc)
+        if wait > 0:
+            time.sleep(wait)
+        if self.debug:
+            print("Downloading %s [%u left]" % (url, self.tiles_pending()))
+        t0 = time.time()
+        try:
+            (status, resp_headers, img) = self.http_get(url, headers, conns)
+        except (url_error, http.client.HTTPException, OSError, ValueError) as e:
+            status = None
+            resp_headers = None
+            img = b''
+            if self.debug:
+                print("Failed %s: %s" % (url, str(e)))
+        latency = time.time() - t0
+
+        if status == 304:
+            # cache hit; reset its refresh time
+            self.store.touch(self.service, tile_info.zoom, x, y)
+            self.download_stats.add('not_modified', 0, latency)
+            return
 
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp', 'wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
+        if status != 200 or resp_headers.get('Content-Type', '').find('image') == -1:
+            # print('Error loading %s' % url)
+            self._tile_cache.put_if_missing(key, self._unavailable)
+            self.download_stats.add('failed', len(img), latency)
+            if self.debug and status is not None:
+                print("Failed %s: status %u type %s" % (url, status, resp_headers.get('Content-Type', '')))
+            return
 
-    def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
+        self.download_stats.add('downloaded', len(img), latency)
+
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+                self._tile_cache.put_if_missing(key, self._unavailable)
             return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+
+        self.store.put(self.service, tile_info.zoom, x, y, img)
+
+    def downloader(self):
+        '''a download worker thread'''
+        # keep-alive connections of this worker, by (scheme, host)
+        conns = {}
+        try:
+            while True:
+                tile_info = self.next_download()
+                if tile_info is None:
+                    break
+                key = tile_info.key()
+                try:
+                    self.download_tile(tile_info, conns)
+                except Exception as e:
+                    if self.debug:
+                        print("Download error %s" % str(e))
+                finally:
+                    with self._download_lock:
+                        self._download_active.discard(key)
+                        self._download_pending.pop(key, None)
+        finally:
+            for conn in conns.values():
+                conn.close()
+
+    def start_download_thread(self):
+        '''start download workers, up to download_threads'''
+        with self._download_lock:
+            wanted = min(self.download_threads, len(self._download_pending) - len(self._download_active))
+            while self._download_workers < wanted:
+                self._download_workers += 1
+                t = threading.Thread(target=self.downloader, name='tile_download')
+                t.daemon = True
+                t.start()
+
+    def download_status(self):
+        '''return a one line download status string'''
+        return self.download_stats.status(self.tiles_pending())
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -377,22 +644,16 @@ class MPTile:
 
             # see if its in the tile cache
             key = tile_info.key()
-            if key in self._tile_cache:
-                img = self._tile_cache[key]
-                if np.array_equal(img, np.array(self._unavailable)):
-                    continue
-            else:
-                path = self.tile_to_path(tile_info)
-                if not os.path.exists(path):
-                    continue
-                img = cv2.imread(path)
+            img = self._tile_cache.get(key)
+            if img is self._unavailable:
+                continue
+            if img is None:
+                (img, mtime) = self.read_tile(tile_info)
                 if img is None:
                     continue
                 # cv2.rectangle(img, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
                 # add it to the tile cache
-                self._tile_cache[key] = img
-                while len(self._tile_cache) > self.cache_size:
-                    self._tile_cache.popitem(0)
+                self._tile_cache.put(key, img)
 
             # copy out the quadrant we want
             availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -415,33 +676,23 @@ class MPTile:
 
         # see if its in the tile cache
         key = tile.key()
-        if key in self._tile_cache:
-            img = self._tile_cache[key]
-            if np.array_equal(img, self._unavailable):
+        img = self._tile_cache.get(key)
+        if img is not None:
+            if img is self._unavailable:
                 img = self.load_tile_lowres(tile)
                 if img is None:
                     img = self._unavailable
             return img
 
-        path = self.tile_to_path(tile)
-        if not os.path.exists(path):
-            ret = None
-        else:
-            ret = cv2.imread(path)
+        (ret, mtime) = self.read_tile(tile)
         if ret is not None:
             # cv2.rectangle(ret, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
             # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                    self._download_pending[key].refresh_time()
-                except Exception:
-                    self._download_pending[key] = tile
-                self.start_download_thread()
+            if mtime + self.refresh_age < time.time():
+                self.queue_download(tile)
 
             # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
+            self._tile_cache.put(key, ret)
             return ret
 
         if not self.download:
@@ -450,11 +701,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -465,10 +712,25 @@ class MPTile:
         '''return a scaled tile'''
         width = int(TILES_WIDTH / tile.scale)
         height = int(TILES_HEIGHT / tile.scale)
+        key = (tile.key(), width, height)
+        scaled_tile = self._scaled_cache.get(key)
+        if scaled_tile is not None:
+            return scaled_tile
         full_tile = self.load_tile(tile)
         scaled_tile = cv2.resize(full_tile, (height, width))
+        # only keep it if it is the real tile, not a placeholder
+        if full_tile is not self._unavailable and full_tile is self._tile_cache.peek(tile.key()):
+            self._scaled_cache.put(key, scaled_tile)
         return scaled_tile
 
+    def cache_status(self):
+        '''return the tile cache statistics as a string'''
+        return "\n".join([self._tile_cache.status(), self._scaled_cache.status()])
+
+    def reset_cache_stats(self):
+        self._tile_cache.reset_stats()
+        self._scaled_cache.reset_stats()
+
     def coord_from_area(self, x, y, lat, lon, width, ground_width):
         '''return (lat,lon) for a pixel in an area image
         x is pixel coord to the right from top,left
@@ -586,10 +848,11 @@ class MPTile:
 
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
-        # close to the middle of the image first
+        # downloads are ordered by distance from the middle, so the
+        # middle of the image fills in first
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self.set_view(midlat, midlon)
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
         for t in tlist:
@@ -648,6 +911,9 @@ if __name__ == "__main__":
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--threads", type='int', default=4, help="number of download threads")
+    parser.add_option("--tile-store", default='dir', help="tile store, dir or mbtiles")
+    parser.add_option("--url", default=None, help="custom tile URL template, using ${X} ${Y} and ${ZOOM}")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
@@ -665,11 +931,17 @@ if __name__ == "__main__":
                            mp_util.gps_distance(lat, lon, lat-bounds[2], lon))
         print(lat, lon, ground_width)
 
+    if opts.url is not None:
+        TILE_SERVICES['Custom'] = opts.url
+        opts.service = 'Custom'
+
     mt = MPTile(
         debug=opts.debug,
         service=opts.service,
         tile_delay=opts.delay,
         max_zoom=opts.max_zoom,
+        download_threads=opts.threads,
+        tile_store=opts.tile_store,
     )
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
@@ -684,4 +956,5 @@ if __name__ == "__main__":
         while mt.tiles_pending() > 0:
             time.sleep(2)
             print("Waiting on %u tiles" % mt.tiles_pending())
+    print(mt.download_status())
     print('Done')
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+'''
+pre-seed the map tile cache for offline use
+
+The area to seed is a bounding box, or the paths of a mission and the
+polygons and circles of a fence with a buffer distance around them.
+Every tile within the area is downloaded for a range of zoom levels.
+Tiles which are already in the cache and not due for a refresh are
+skipped, so an interrupted seed can be resumed by running it again.
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+import threading
+import time
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tile
+
+# used for the size estimate until some tiles of the service are cached
+DEFAULT_TILE_BYTES = 20000
+
+EARTH_CIRCUMFERENCE = 2 * math.pi * mp_util.radius_of_earth
+
+
+class SeedArea(object):
+    '''an area to seed, made of paths, polygons and circles with a
+    buffer distance in meters around them'''
+    def __init__(self, buffer=0):
+        self.buffer = buffer
+        # lists of (lat, lon)
+        self.paths = []
+        self.polygons = []
+        # (lat, lon, radius)
+        self.circles = []
+
+    def add_bbox(self, lat1, lon1, lat2, lon2):
+        '''add a box given two opposite corners'''
+        self.polygons.append([(lat1, lon1), (lat1, lon2), (lat2, lon2), (lat2, lon1)])
+
+    def add_path(self, points):
+        if len(points) > 0:
+            self.paths.append(list(points))
+
+    def add_polygon(self, points):
+        if len(points) > 2:
+            self.polygons.append(list(points))
+        else:
+            self.add_path(points)
+
+    def add_circle(self, lat, lon, radius):
+        self.circles.append((lat, lon, radius))
+
+    def empty(self):
+        return len(self.paths) == 0 and len(self.polygons) == 0 and len(self.circles) == 0
+
+    def points(self):
+        '''all points of the area, with circles as their centre'''
+        ret = [(lat, lon) for (lat, lon, radius) in self.circles]
+        for p in self.paths + self.polygons:
+            ret.extend(p)
+        return ret
+
+    def bounds(self):
+        '''return (lat_min, lon_min, lat_max, lon_max) of the area
+        including the buffer'''
+        points = self.points()
+        (lat_min, lon_min, width, height) = mp_util.polygon_bounds(points)
+        lat_max = lat_min + width
+        lon_max = lon_min + height
+        margin = self.buffer
+        for (lat, lon, radius) in self.circles:
+            margin = max(margin, self.buffer + radius)
+        dlat = math.degrees(margin / mp_util.radius_of_earth)
+        coslat = max(math.cos(math.radians(max(abs(lat_min), abs(lat_max)) + dlat)), 0.01)
+        dlon = dlat / coslat
+        return (max(lat_min - dlat, -85), lon_min - dlon, min(lat_max + dlat, 85), lon_max + dlon)
+
+    def distance(self, lat, lon):
+        '''return the distance in meters of each of the lat/lon arrays
+        from the area, zero if inside a polygon or circle'''
+        (lat_min, lon_min, lat_max, lon_max) = self.bounds()
+        lat0 = 0.5 * (lat_min + lat_max)
+        lon0 = 0.5 * (lon_min + lon_max)
+        scale = math.radians(1) * mp_util.radius_of_earth
+        coslat = math.cos(math.radians(lat0))
+
+        def project(plat, plon):
+            '''local flat projection in meters'''
+            dlon = (np.asarray(plon) - lon0 + 180.0) % 360.0 - 180.0
+            return (dlon * coslat * scale, (np.asarray(plat) - lat0) * scale)
+
+        (px, py) = project(lat, lon)
+        ret = np.full(px.shape, np.inf)
+        shapes = [(p, False) for p in self.paths] + [(p, True) for p in self.polygons]
+        for (path, closed) in shapes:
+            (x, y) = project([p[0] for p in path], [p[1] for p in path])
+            if closed:
+                x = np.append(x, x[0])
+                y = np.append(y, y[0])
+                inside = np.zeros(px.shape, dtype=bool)
+            if len(x) == 1:
+                ret = np.minimum(ret, np.hypot(px - x[0], py - y[0]))
+                continue
+            for i in range(len(x) - 1):
+                (ax, ay, bx, by) = (x[i], y[i], x[i+1], y[i+1])
+                (dx, dy) = (bx - ax, by - ay)
+                len2 = dx*dx + dy*dy
+                if len2 > 0:
+                    t = np.clip(((px - ax) * dx + (py - ay) * dy) / len2, 0, 1)
+                else:
+                    t = 0
+                ret = np.minimum(ret, np.hypot(px - (ax + t*dx), py - (ay + t*dy)))
+                if closed and ay != by:
+                    # ray casting inside test
+                    crosses = (ay > py) != (by > py)
+                    xcross = ax + (py - ay) * dx / (by - ay)
+                    inside ^= crosses & (px < xcross)
+            if closed:
+                ret[inside] = 0
+        for (clat, clon, radius) in self.circles:
+            (x, y) = project(clat, clon)
+            ret = np.minimum(ret, np.maximum(np.hypot(px - x, py - y) - radius, 0))
+        return ret
+
+
+def area_tiles(mt, area, zoom):
+    '''return the list of TileInfo needed to cover an area at a zoom level'''
+    (lat_min, lon_min, lat_max, lon_max) = area.bounds()
+    top_left = mt.coord_to_tile(lat_max, lon_min, zoom)
+    bottom_right = mt.coord_to_tile(lat_min, lon_max, zoom)
+    world_tiles = 1 << zoom
+    # allow for an area crossing the date line
+    x1 = top_left.x
+    x2 = bottom_right.x
+    if x2 < x1:
+        x2 += world_tiles
+    xs = np.arange(x1, x2 + 1)
+    ys = np.arange(top_left.y, bottom_right.y + 1)
+    (gx, gy) = np.meshgrid(xs, ys)
+    gx = gx.ravel()
+    gy = gy.ravel()
+    # tile centres
+    lon = (gx + 0.5) / world_tiles * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (gy + 0.5) / world_tiles))))
+    half_diagonal = 0.5 * math.sqrt(2) * EARTH_CIRCUMFERENCE * np.cos(np.radians(lat)) / world_tiles
+    keep = area.distance(lat, lon) <= area.buffer + half_diagonal
+    return [mp_tile.TileInfo((int(x) % world_tiles, int(y)), zoom, mt.service)
+            for (x, y) in zip(gx[keep], gy[keep])]
+
+
+class TileSeeder(object):
+    '''download a list of tiles into the cache of an MPTile, queueing
+    them a batch at a time. tiles is a list of TileInfo or a function
+    returning one. Finding which tiles are already cached is done in a
+    thread, so call update() regularly until scanned() for the
+    estimate, then until done()'''
+    def __init__(self, mt, tiles, max_queued=200):
+        self.mt = mt
+        self.max_queued = max_queued
+        self.total = 0
+        self.checked = 0
+        self.tiles = []
+        self.cached = []
+        self.size_estimate = DEFAULT_TILE_BYTES
+        self.next = 0
+        self.start_time = None
+        self.stats_start = None
+        self.stopped = False
+        self.scan_done = threading.Event()
+        self.scan_thread = threading.Thread(target=self.scan, args=(tiles,), name='map seed scan')
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+
+    def scan(self, tiles):
+        '''sort tiles into those cached and those to download'''
+        if callable(tiles):
+            tiles = tiles()
+        self.total = len(tiles)
+        now = time.time()
+        mt = self.mt
+        fetch = []
+        cached = []
+        for tile in tiles:
+            if self.stopped:
+                fetch = []
+                break
+            (x, y) = tile.tile
+            mtime = mt.store.mtime(mt.service, tile.zoom, x, y)
+            if mtime is not None and mtime + mt.refresh_age > now:
+                cached.append(tile)
+            else:
+                fetch.append(tile)
+            self.checked += 1
+        self.cached = cached
+        self.size_estimate = self.tile_bytes()
+        self.tiles = fetch
+        self.scan_done.set()
+
+    def scanned(self):
+        '''return True once the cached tiles are known'''
+        return self.scan_done.is_set()
+
+    def tile_bytes(self):
+        '''estimated size of a tile, from a sample of cached tiles'''
+        sizes = []
+        for tile in self.cached[:20]:
+            (x, y) = tile.tile
+            stored = self.mt.store.get(self.mt.service, tile.zoom, x, y)
+            if stored is not None:
+                sizes.append(len(stored[0]))
+        if len(sizes) == 0:
+            return DEFAULT_TILE_BYTES
+        return sum(sizes) / len(sizes)
+
+    def estimate(self):
+        '''return a string estimating the size and time of the seed'''
+        count = len(self.tiles)
+        size_mb = count * self.size_estimate / (1024.0 * 1024.0)
+        # assume 0.2s per request per thread, limited by the per
+        # host request spacing
+        rate = self.mt.download_threads / 0.2
+        if self.mt.tile_delay > 0:
+            rate = min(rate, 1.0 / self.mt.tile_delay)
+        return "%u tiles to download (%u of %u cached), about %.1f MB, ETA %s" % (
+            count, len(self.cached), self.total, size_mb, format_duration(count / rate))
+
+    def completed(self):
+        '''number of tiles finished, successfully or not'''
+        if self.stats_start is None:
+            return 0
+        stats = self.mt.download_stats
+        return (stats.downloaded + stats.not_modified + stats.failed + stats.cancelled) - self.stats_start
+
+    def update(self):
+        '''queue more tiles as the download pool drains'''
+        if not self.scanned():
+            return
+        if self.start_time is None:
+            self.start_time = time.time()
+            stats = self.mt.download_stats
+            self.stats_start = stats.downloaded + stats.not_modified + stats.failed + stats.cancelled
+        while self.next < len(self.tiles) and self.mt.tiles_pending() < self.max_queued:
+            self.mt.queue_download(self.tiles[self.next])
+            self.next += 1
+
+    def done(self):
+        return self.scanned() and self.next >= len(self.tiles) and self.mt.tiles_pending() == 0
+
+    def stop(self):
+        '''stop scanning and queueing, and drop tiles not yet being
+        downloaded'''
+        self.stopped = True
+        self.next = len(self.tiles)
+        self.mt.cancel_downloads()
+
+    def status(self):
+        '''return a one line progress string'''
+        if not self.scanned():
+            return "checking tile cache, %u/%u tiles checked" % (self.checked, self.total)
+        done = self.completed()
+        count = len(self.tiles)
+        eta = ''
+        if self.start_time is not None and done > 0 and done < count:
+            rate = done / max(time.time() - self.start_time, 0.001)
+            eta = ' ETA %s' % format_duration((count - done) / rate)
+        return "seeded %u/%u tiles, %u failed%s" % (done, count, self.mt.download_stats.failed, eta)
+
+
+def format_duration(seconds):
+    '''format a duration as a short string'''
+    seconds = int(seconds)
+    if seconds < 120:
+        return "%us" % seconds
+    if seconds < 7200:
+        return "%umin" % (seconds // 60)
+    return "%.1fh" % (seconds / 3600.0)
+
+
+def seed_tiles(mt, area, min_zoom, max_zoom):
+    '''return the list of tiles for an area over a range of zoom levels'''
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        tiles.extend(area_tiles(mt, area, zoom))
+    return tiles
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("mp_tileseed.py [options]")
+    parser.add_argument("--bbox", type=float, nargs=4, default=None, metavar=('LAT1', 'LON1', 'LAT2', 'LON2'),
+                        help="area to seed")
+    parser.add_argument("--mission", default=[], action='append', help="mission file to seed around")
+    parser.add_argument("--fence", default=[], action='append', help="polygon fence file to seed around")
+    parser.add_argument("--buffer", type=float, default=500, help="distance in meters to seed around missions and fences")
+    parser.add_argument("--min-zoom", type=int, default=10, help="minimum zoom level")
+    parser.add_argument("--max-zoom", type=int, default=18, help="maximum zoom level")
+    parser.add_argument("--service", default="MicrosoftSat", help="tile service")
+    parser.add_argument("--tile-store", default='dir', help="tile store, dir or mbtiles")
+    parser.add_argument("--cache-path", default=None, help="tile cache directory")
+    parser.add_argument("--threads", type=int, default=4, help="number of download threads")
+    parser.add_argument("--delay", type=float, default=0.1, help="minimum time between requests to a server")
+    parser.add_argument("--estimate", action='store_true', default=False, help="only show the estimate")
+    args = parser.parse_args()
+
+    area = SeedArea(buffer=args.buffer)
+    if args.bbox is not None:
+        area.add_bbox(*args.bbox)
+    for filename in args.mission:
+        from pymavlink import mavwp
+        wploader = mavwp.MAVWPLoader()
+        wploader.load(filename)
+        for path in wploader.polygon_list():
+            area.add_path(path)
+    for filename in args.fence:
+        area.add_polygon(mp_util.polygon_load(filename))
+    if area.empty():
+        print("Need --bbox, --mission or --fence")
+        raise SystemExit(1)
+
+    mt = mp_tile.MPTile(cache_path=args.cache_path, service=args.service, tile_delay=args.delay,
+                        max_zoom=args.max_zoom, download_threads=args.threads, tile_store=args.tile_store)
+    seeder = TileSeeder(mt, seed_tiles(mt, area, args.min_zoom, args.max_zoom))
+    seeder.scan_done.wait()
+    print(seeder.estimate())
+    if args.estimate:
+        raise SystemExit(0)
+    last_print = 0
+    try:
+        while not seeder.done():
+            seeder.update()
+            time.sleep(0.1)
+            if time.time() - last_print > 5:
+                last_print = time.time()
+                print(seeder.status())
+    except KeyboardInterrupt:
+        seeder.stop()
+    print(seeder.status())
+    print(mt.download_status())
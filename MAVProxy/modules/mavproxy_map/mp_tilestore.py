@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+'''
+map tile storage backends
+
+The directory store is the original ~/.tilecache layout with one file
+per tile under SERVICE/ZOOM/Y/X.img. The MBTiles store keeps each
+service in a single SQLite file, SERVICE.mbtiles, holding the image
+blobs and the time each tile was last refreshed. It is much quicker to
+copy a large cache to another machine as a few files, and a read is a
+single indexed query instead of a stat and open per tile.
+
+Run this file to convert a cache between the two layouts, for example
+  mp_tilestore.py --import ~/.tilecache
+converts the directory tree to MBTiles files in the same cache.
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import sqlite3
+import threading
+import time
+
+from MAVProxy.modules.lib import mp_util
+
+
+class TileStore(object):
+    '''base class for tile storage backends. Tiles are identified by
+    service name, zoom and x/y in the slippy map (XYZ) scheme'''
+
+    def get(self, service, zoom, x, y):
+        '''return (data, mtime) for a tile, or None if not stored'''
+        raise NotImplementedError()
+
+    def mtime(self, service, zoom, x, y):
+        '''return the time a tile was stored or refreshed, or None'''
+        raise NotImplementedError()
+
+    def put(self, service, zoom, x, y, data, mtime=None):
+        '''store a tile, with mtime defaulting to now'''
+        raise NotImplementedError()
+
+    def put_many(self, service, tiles):
+        '''store a list of (zoom, x, y, data, mtime) tiles'''
+        for (zoom, x, y, data, mtime) in tiles:
+            self.put(service, zoom, x, y, data, mtime)
+
+    def touch(self, service, zoom, x, y):
+        '''mark a tile as refreshed'''
+        raise NotImplementedError()
+
+    def services(self):
+        '''return list of services with stored tiles'''
+        raise NotImplementedError()
+
+    def tiles(self, service):
+        '''iterate over the (zoom, x, y) of stored tiles for a service'''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class DirectoryTileStore(TileStore):
+    '''one file per tile under cache_path/SERVICE/ZOOM/Y/X.img'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def path(self, service, zoom, x, y):
+        '''return full path to a tile'''
+        return os.path.join(self.cache_path, service, '%u' % zoom, '%u' % y, '%u.img' % x)
+
+    def get(self, service, zoom, x, y):
+        path = self.path(service, zoom, x, y)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                return (f.read(), mtime)
+        except OSError:
+            return None
+
+    def mtime(self, service, zoom, x, y):
+        try:
+            return os.path.getmtime(self.path(service, zoom, x, y))
+        except OSError:
+            return None
+
+    def put(self, service, zoom, x, y, data, mtime=None):
+        path = self.path(service, zoom, x, y)
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp', 'wb')
+        h.write(data)
+        h.close()
+        if mtime is not None:
+            os.utime(path+'.tmp', (mtime, mtime))
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+
+    def touch(self, service, zoom, x, y):
+        try:
+            os.utime(self.path(service, zoom, x, y))
+        except OSError:
+            pass
+
+    def services(self):
+        ret = []
+        try:
+            names = sorted(os.listdir(self.cache_path))
+        except OSError:
+            return ret
+        for name in names:
+            d = os.path.join(self.cache_path, name)
+            if os.path.isdir(d) and any(z.isdigit() for z in os.listdir(d)):
+                ret.append(name)
+        return ret
+
+    def tiles(self, service):
+        sdir = os.path.join(self.cache_path, service)
+        for zname in os.listdir(sdir):
+            if not zname.isdigit():
+                continue
+            zdir = os.path.join(sdir, zname)
+            for yname in os.listdir(zdir):
+                if not yname.isdigit():
+                    continue
+                for fname in os.listdir(os.path.join(zdir, yname)):
+                    (xname, ext) = os.path.splitext(fname)
+                    if ext == '.img' and xname.isdigit():
+                        yield (int(zname), int(xname), int(yname))
+
+
+class MBTilesStore(TileStore):
+    '''one MBTiles SQLite file per service, cache_path/SERVICE.mbtiles.
+    Rows use the MBTiles (TMS) row numbering so the files can be
+    opened by other tools. The extra updated column holds the refresh
+    time of each tile'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        # connections are shared by the download threads
+        self.lock = threading.Lock()
+        self.dbs = {}
+
+    def filename(self, service):
+        return os.path.join(self.cache_path, service + '.mbtiles')
+
+    def db(self, service, create=True):
+        '''return the connection for a service, or None'''
+        db = self.dbs.get(service, None)
+        if db is not None:
+            return db
+        filename = self.filename(service)
+        if not create and not os.path.exists(filename):
+            return None
+        mp_util.mkdir_p(self.cache_path)
+        db = sqlite3.connect(filename, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)')
+        db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                   'tile_row INTEGER, tile_data BLOB, updated REAL)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        db.execute("INSERT OR IGNORE INTO metadata VALUES ('name', ?)", (service,))
+        db.execute("INSERT OR IGNORE INTO metadata VALUES ('type', 'baselayer')")
+        db.execute("INSERT OR IGNORE INTO metadata VALUES ('version', '1')")
+        db.commit()
+        self.dbs[service] = db
+        return db
+
+    @staticmethod
+    def tms_row(zoom, y):
+        '''convert between XYZ y and MBTiles row, the same both ways'''
+        return (1 << zoom) - 1 - y
+
+    @staticmethod
+    def image_format(data):
+        if data[:4] == b'\x89PNG':
+            return 'png'
+        return 'jpg'
+
+    def get(self, service, zoom, x, y):
+        with self.lock:
+            db = self.db(service, create=False)
+            if db is None:
+                return None
+            row = db.execute('SELECT tile_data, updated FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (zoom, x, self.tms_row(zoom, y))).fetchone()
+        if row is None:
+            return None
+        return (bytes(row[0]), row[1])
+
+    def mtime(self, service, zoom, x, y):
+        with self.lock:
+            db = self.db(service, create=False)
+            if db is None:
+                return None
+            row = db.execute('SELECT updated FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (zoom, x, self.tms_row(zoom, y))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, service, zoom, x, y, data, mtime=None):
+        self.put_many(service, [(zoom, x, y, data, mtime)])
+
+    def put_many(self, service, tiles):
+        if len(tiles) == 0:
+            return
+        now = time.time()
+        rows = []
+        for (zoom, x, y, data, mtime) in tiles:
+            if mtime is None:
+                mtime = now
+            rows.append((zoom, x, self.tms_row(zoom, y), sqlite3.Binary(data), mtime))
+        with self.lock:
+            db = self.db(service)
+            db.execute("INSERT OR IGNORE INTO metadata VALUES ('format', ?)", (self.image_format(tiles[0][3]),))
+            db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)', rows)
+            db.commit()
+
+    def touch(self, service, zoom, x, y):
+        with self.lock:
+            db = self.db(service, create=False)
+            if db is None:
+                return
+            db.execute('UPDATE tiles SET updated=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                       (time.time(), zoom, x, self.tms_row(zoom, y)))
+            db.commit()
+
+    def services(self):
+        try:
+            names = sorted(os.listdir(self.cache_path))
+        except OSError:
+            return []
+        return [n[:-8] for n in names if n.endswith('.mbtiles')]
+
+    def tiles(self, service):
+        with self.lock:
+            rows = self.db(service).execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        for (zoom, x, row) in rows:
+            yield (zoom, x, self.tms_row(zoom, row))
+
+    def close(self):
+        with self.lock:
+            for db in self.dbs.values():
+                db.close()
+            self.dbs = {}
+
+
+TILE_STORES = {
+    'dir': DirectoryTileStore,
+    'mbtiles': MBTilesStore,
+}
+
+
+def open_store(kind, cache_path):
+    '''open a tile store of the given kind'''
+    if kind not in TILE_STORES:
+        raise ValueError('unknown tile store %s, should be one of %s' % (kind, ', '.join(TILE_STORES.keys())))
+    return TILE_STORES[kind](cache_path)
+
+
+def copy_tiles(src, dst, services=None, batch_size=500, progress=None):
+    '''copy tiles from one store to another, keeping the refresh times.
+    Returns the number of tiles copied'''
+    if services is None:
+        services = src.services()
+    count = 0
+    for service in services:
+        batch = []
+        for (zoom, x, y) in src.tiles(service):
+            tile = src.get(service, zoom, x, y)
+            if tile is None:
+                continue
+            batch.append((zoom, x, y, tile[0], tile[1]))
+            if len(batch) >= batch_size:
+                dst.put_many(service, batch)
+                count += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(service, count)
+        dst.put_many(service, batch)
+        count += len(batch)
+        if progress is not None:
+            progress(service, count)
+    return count
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("mp_tilestore.py [options] CACHE_PATH")
+    parser.add_argument("cache_path", help="tile cache directory")
+    parser.add_argument("--import", dest='import_tiles', action='store_true', default=False,
+                        help="import a directory tile cache into MBTiles files")
+    parser.add_argument("--export", action='store_true', default=False,
+                        help="export MBTiles files to a directory tile cache")
+    parser.add_argument("--dest", default=None, help="destination cache directory, default is CACHE_PATH")
+    parser.add_argument("--service", default=[], action='append', help="service to copy, default is all")
+    args = parser.parse_args()
+
+    if args.import_tiles == args.export:
+        print("Need one of --import or --export")
+        raise SystemExit(1)
+    dest = args.dest
+    if dest is None:
+        dest = args.cache_path
+    if args.import_tiles:
+        src = DirectoryTileStore(args.cache_path)
+        dst = MBTilesStore(dest)
+    else:
+        src = MBTilesStore(args.cache_path)
+        dst = DirectoryTileStore(dest)
+
+    def show_progress(service, count):
+        print("%s: %u tiles" % (service, count))
+
+    services = args.service
+    if len(services) == 0:
+        services = None
+    count = copy_tiles(src, dst, services=services, progress=show_progress)
+    dst.close()
+    print("Copied %u tiles" % count)
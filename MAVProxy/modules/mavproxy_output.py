@@ -15,6 +15,7 @@ from MAVProxy.modules.lib import mp_util
 class OutputModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(OutputModule, self).__init__(mpstate, "output", "output control", public=True)
+        self.set_idle_rate(2)
         self.add_command('output', self.cmd_output, "output control",
                          ["<list|add|remove|sysid>"])
 
@@ -63,6 +64,7 @@ class OutputModule(mp_module.MPModule):
             print("Failed to connect to %s" % device)
             return
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.reactor.mark_dirty()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -86,6 +88,7 @@ class OutputModule(mp_module.MPModule):
         if sysid in self.mpstate.sysid_outputs:
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.reactor.mark_dirty()
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -100,6 +103,7 @@ class OutputModule(mp_module.MPModule):
                     pass
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
+                self.mpstate.reactor.mark_dirty()
                 return
 
     def idle_task(self):
@@ -15,6 +15,7 @@ from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import param_cache
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuItem
@@ -35,6 +36,15 @@ except ImportError:
     import Queue
     from Queue import Empty
 
+# number of parameters fetched to check the parameter cache
+CACHE_SAMPLES = 16
+# time to wait for AUTOPILOT_VERSION before using a cache not tied to a board
+CACHE_IDENTIFY_TIME = 1.5
+# time to wait for the sampled parameters, which are requested twice
+CACHE_CHECK_TIME = 2.0
+# volatile parameters requested per second after using the cache
+CACHE_REFRESH_RATE = 20
+
 
 class ParamState:
     '''this class is separated to make it possible to use the parameter
@@ -62,6 +72,18 @@ class ParamState:
         self.param_help.vehicle_name = vehicle_name
         self.default_params = None
         self.watch_patterns = set()
+        # names of parameters by index, for the parameter cache
+        self.param_names = {}
+        self.cache = None
+        self.cache_state = None
+        self.cache_time = 0
+        self.cache_sample = set()
+        self.cache_tries = 0
+        # indexes still to request, and not yet received, when fetching
+        # volatile parameters in the background after using the cache
+        self.cache_refresh = []
+        self.cache_refresh_pending = set()
+        self.autopilot_identity = None
 
         # dictionary of ParamSet objects we are processing:
         self.parameters_to_set = {}
@@ -204,6 +226,168 @@ class ParamState:
             return False
         return self.mpstate.settings.param_ftp
 
+    def use_cache(self):
+        '''return true if we should use the parameter cache'''
+        return self.mpstate.settings.param_cache
+
+    def cache_start(self, master):
+        '''start checking the parameter cache. We first ask for
+        AUTOPILOT_VERSION to find which cache file to use'''
+        self.cache_state = 'identify'
+        self.cache_time = time.time()
+        master.mav.command_long_send(
+            self.sysid[0],
+            self.sysid[1],
+            mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+            0,
+            mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION,
+            0, 0, 0, 0, 0, 0)
+
+    def cache_request_sample(self, master):
+        '''request the parameters not yet received in the cache check sample'''
+        for idx in sorted(self.cache_sample):
+            master.param_fetch_one(idx)
+        self.cache_time = time.time()
+        self.cache_tries += 1
+
+    def cache_check(self, master):
+        '''progress the parameter cache check, returning True while it is
+        still running'''
+        now = time.time()
+        if self.cache_state == 'identify':
+            if self.autopilot_identity is None and now - self.cache_time < CACHE_IDENTIFY_TIME:
+                return True
+            self.cache = param_cache.ParamCache(self.sysid, self.autopilot_identity)
+            if not self.cache.load():
+                self.cache_state = 'done'
+                return False
+            self.cache_state = 'verify'
+            self.cache_sample = set(self.cache.sample(CACHE_SAMPLES))
+            self.cache_tries = 0
+            self.cache_request_sample(master)
+            return True
+        if self.cache_state == 'verify':
+            if now - self.cache_time < CACHE_CHECK_TIME:
+                return True
+            if self.cache_tries < 2:
+                self.cache_request_sample(master)
+                return True
+            self.cache_fail(master, "no reply")
+            return True
+        return False
+
+    def cache_verify(self, master, m, param_id, value):
+        '''check a parameter requested for the cache check'''
+        self.cache_sample.discard(m.param_index)
+        if m.param_count != self.cache.count():
+            self.cache_fail(master, "parameter count changed")
+        elif not self.cache.check(m.param_index, param_id, value, m.param_count):
+            self.cache_fail(master, "%s changed" % param_id)
+        elif len(self.cache_sample) == 0:
+            self.cache_accept(master)
+
+    def cache_fail(self, master, reason):
+        '''the parameter cache can't be used, fetch all parameters'''
+        print("Parameter cache out of date (%s)" % reason)
+        self.cache_sample = set()
+        self.fetch_set = None
+        self.mav_param_set = set()
+        self.fetch_all(master)
+
+    def cache_accept(self, master):
+        '''use the parameters in the cache'''
+        self.cache_state = 'done'
+        cache = self.cache
+        self.param_types = dict(cache.types)
+        self.fetch_one = dict()
+        self.fetch_set = None
+        self.mav_param.clear()
+        for (name, v) in zip(cache.names, cache.values):
+            self.mav_param[name] = v
+        self.param_names = dict(enumerate(cache.names))
+        self.mav_param_count = cache.count()
+        self.mav_param_set = set(range(cache.count()))
+        print("Loaded %u parameters from cache" % cache.count())
+        # only a sample was checked. With ftp the whole set is one small
+        # transfer which is compared against the cache, otherwise just
+        # the parameters the vehicle changes itself are fetched. The
+        # parameter file is saved once that is done
+        if self.use_ftp():
+            self.ftp_start(callback=self.cache_ftp_callback)
+        if not self.ftp_started:
+            self.cache_refresh_volatile()
+
+    def cache_refresh_volatile(self):
+        '''fetch the volatile parameters in the background'''
+        self.cache_refresh = self.cache.volatile()
+        self.cache_refresh_pending = set(self.cache_refresh)
+        self.cache_tries = 0
+        self.cache_time = time.time()
+        if len(self.cache_refresh_pending) == 0:
+            self.cache_refresh_done()
+
+    def cache_ftp_callback(self, fh):
+        '''ftp fetch of parameters after using the cache. Report what
+        differs from the cache, then use the fetched parameters'''
+        pdata = None
+        if fh is not None:
+            pdata = param_ftp.ftp_param_decode(fh.read())
+            fh.seek(0)
+        if pdata is None or len(pdata.params) == 0:
+            self.ftp_callback(fh)
+            self.cache_refresh_volatile()
+            return
+        names = [str(name.decode('utf-8')) for (name, v, ptype) in pdata.params]
+        changed = self.cache.changed(names, [v for (name, v, ptype) in pdata.params])
+        if changed is None:
+            print("Parameter list changed on vehicle")
+        else:
+            changed = [n for n in changed if not param_cache.is_volatile(n)]
+            if len(changed) > 0:
+                print("Cached parameters changed on vehicle: %s" % ' '.join(changed))
+        self.ftp_callback(fh)
+
+    def cache_refresh_task(self, master):
+        '''request some more parameters for the background refresh'''
+        now = time.time()
+        if len(self.cache_refresh) == 0:
+            if now - self.cache_time < CACHE_CHECK_TIME:
+                return
+            if self.cache_tries >= 2:
+                print("Parameter refresh incomplete, %u not received" % len(self.cache_refresh_pending))
+                self.cache_refresh_done()
+                return
+            # ask again for any which were lost
+            self.cache_refresh = sorted(self.cache_refresh_pending)
+            self.cache_tries += 1
+        for idx in self.cache_refresh[:CACHE_REFRESH_RATE]:
+            master.param_fetch_one(idx)
+        self.cache_refresh = self.cache_refresh[CACHE_REFRESH_RATE:]
+        self.cache_time = now
+
+    def cache_refresh_received(self, m):
+        '''note a parameter received for the background refresh'''
+        self.cache_refresh_pending.discard(m.param_index)
+        if len(self.cache_refresh_pending) == 0:
+            self.cache_refresh_done()
+
+    def cache_refresh_done(self):
+        '''finish the background refresh'''
+        self.cache_refresh = []
+        self.cache_refresh_pending = set()
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+
+    def cache_store(self, names, values):
+        '''save a full set of parameters in the cache'''
+        if not self.use_cache():
+            return
+        if self.cache is None or self.cache.identity != self.autopilot_identity:
+            self.cache = param_cache.ParamCache(self.sysid, self.autopilot_identity)
+        self.cache_state = 'done'
+        self.cache.set_all(names, values, self.param_types)
+        self.cache.save()
+
     def handle_px4_param_value(self, m):
         '''special handling for the px4 style of PARAM_VALUE'''
         if m.param_type == mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
@@ -253,6 +437,14 @@ class ParamState:
             # xml fixed.
             if self.fetch_set is not None:
                 self.fetch_set.discard(m.param_index)
+            if self.cache_state == 'verify' and m.param_index in self.cache_sample:
+                self.cache_verify(master, m, str(param_id), value)
+            elif m.param_index in self.cache_refresh_pending:
+                self.cache_refresh_received(m)
+            if self.cache is not None and self.cache_state == 'done' and self.cache.count() == m.param_count:
+                self.cache.update(str(param_id), value)
+            if m.param_index != -1 and m.param_index != 65535:
+                self.param_names[m.param_index] = str(param_id)
             if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
@@ -272,6 +464,9 @@ class ParamState:
                 if self.logdir is not None:
                     self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
                 self.fetch_set = None
+                names = [self.param_names.get(i, None) for i in range(m.param_count)]
+                if None not in names:
+                    self.cache_store(names, [self.mav_param[n] for n in names])
             if self.fetch_set is not None and len(self.fetch_set) == 0:
                 self.fetch_check(master, force=True)
 
@@ -289,11 +484,22 @@ class ParamState:
                 # remember autopilot types so we can handle PX4 parameters
                 self.autopilot_type_by_sysid[m.get_srcSystem()] = m.autopilot
 
+        elif m.get_type() == 'AUTOPILOT_VERSION':
+            self.autopilot_identity = param_cache.autopilot_identity(m)
+
     def fetch_check(self, master, force=False):
         '''check for missing parameters periodically'''
         if self.param_period.trigger() or force:
             if master is None:
                 return
+            if self.cache is not None and self.cache.dirty and len(self.mav_param_set) == self.mav_param_count:
+                self.cache.save()
+            if self.cache_state is None and len(self.mav_param_set) == 0 and not self.ftp_started and self.use_cache():
+                self.cache_start(master)
+            if self.cache_check(master):
+                return
+            if len(self.cache_refresh_pending) > 0:
+                self.cache_refresh_task(master)
             if len(self.mav_param_set) == 0 and not self.ftp_started:
                 if not self.use_ftp():
                     master.param_fetch_all()
@@ -320,7 +526,7 @@ class ParamState:
     def status(self, master, mpstate):
         return (len(self.mav_param_set), self.mav_param_count)
 
-    def ftp_start(self):
+    def ftp_start(self, callback=None):
         '''start a ftp download of parameters'''
         ftp = self.mpstate.module('ftp')
         if ftp is None:
@@ -329,10 +535,12 @@ class ParamState:
             return
         self.ftp_started = True
         self.ftp_count = None
+        if callback is None:
+            callback = self.ftp_callback
         ftp.cmd_get([
             "@PARAM/param.pck?withdefaults=1",
         ],
-            callback=self.ftp_callback,
+            callback=callback,
             callback_progress=self.ftp_callback_progress,
         )
 
@@ -358,7 +566,7 @@ class ParamState:
             mav.srcComponent = mavutil.mavlink.MAV_COMP_ID_MISSIONPLANNER
             try:
                 buf = p.pack(mav)
-                self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + buf))
+                self.mpstate.logqueue.put_timestamped(usec, buf)
                 # also give to param editor so it can update for changes
                 if editor:
                     editor.mavlink_packet(p)
@@ -407,19 +615,23 @@ class ParamState:
         self.mav_param_count = total_params
 
         idx = 0
+        names = []
         for (name, v, ptype) in pdata.params:
             # we need to set it to REAL32 to ensure we use write value for param_set
             name = str(name.decode('utf-8'))
             self.param_types[name] = mavutil.mavlink.MAV_PARAM_TYPE_REAL32
             self.mav_param_set.add(idx)
             self.mav_param[name] = v
+            names.append(name)
             idx += 1
+        self.param_names = dict(enumerate(names))
 
         self.ftp_failed = False
         print("Received %u parameters (ftp)" % total_params)
         if self.logdir is not None:
             self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
         self.log_params(pdata.params)
+        self.cache_store(names, [v for (name, v, ptype) in pdata.params])
 
         if with_defaults:
             self.default_params = mavparm.MAVParmDict()
@@ -433,6 +645,11 @@ class ParamState:
 
     def fetch_all(self, master):
         '''force refetch of parameters'''
+        # an explicit fetch never uses the cache
+        self.cache_state = 'done'
+        self.cache_sample = set()
+        self.cache_refresh = []
+        self.cache_refresh_pending = set()
         if not self.use_ftp():
             master.param_fetch_all()
             self.mav_param_set = set()
@@ -821,6 +1038,10 @@ class ParamState:
             self.param_show(pattern, verbose)
         elif args[0] == "status":
             print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+            if self.cache is not None and self.cache.count() > 0:
+                print("Parameter cache %s (%u params)" % (self.cache.filename(), self.cache.count()))
+            if len(self.cache_refresh_pending) > 0:
+                print("Fetching volatile parameters, %u to go" % len(self.cache_refresh_pending))
         else:
             print(usage)
 
@@ -21,6 +21,7 @@ if mp_util.has_wxpython:
 class RCModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(RCModule, self).__init__(mpstate, "rc", "rc command handling", public=True)
+        self.subscribe_mavlink(['RC_CHANNELS', 'SERVO_OUTPUT_RAW'])
         self.count = 18
         self.override = [0] * self.count
         self.last_override = [0] * self.count
@@ -17,6 +17,7 @@ class SigningModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(SigningModule, self).__init__(mpstate, "signing", "signing control", public=True)
+        self.set_idle_rate(1)
         self.add_command('signing', self.cmd_signing, "signing control",
                          ["<setup|remove|disable|key>"])
         self.allow = None
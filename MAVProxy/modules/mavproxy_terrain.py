@@ -4,7 +4,10 @@
 
 import time
 
+import numpy
+
 from MAVProxy.modules.lib import mp_elevation
+from MAVProxy.modules.lib import mp_terraingrid
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
@@ -12,41 +15,70 @@ from MAVProxy.modules.lib import mp_settings
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=True)
+        self.subscribe_mavlink(['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'GLOBAL_POSITION_INT'])
+        self.set_idle_rate(10)
 
         self.current_request = None
         self.sent_mask = 0
+        # time each block of the current request was last sent
+        self.sent_time = {}
         self.last_send_time = time.time()
         self.requests_received = 0
         self.blocks_sent = 0
+        self.blocks_lost = 0
         self.check_lat = 0
         self.check_lon = 0
+        # SRTM tile of the vehicle, to load the tiles around it
+        self.vehicle_tile = None
+        # blocks per second, adjusted from the blocks the vehicle
+        # still asks for after they have been sent
+        self.send_rate = 20.0
+        self.send_allowance = 0
+        self.last_allowance_time = time.time()
+        # grid corners waiting to be pre-generated
+        self.pregen_queue = []
+        self.pregen_mission_change = None
         self.add_command('terrain', self.cmd_terrain, "terrain control",
-                         ["<status|check>",
+                         ["<status|check|pregen>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings([('debug', int, 0),
                                                         ('enable', int, 1),
                                                         ('offline', int, 0),
+                                                        ('pregen', int, 0),
+                                                        ('minrate', float, 2),
+                                                        ('maxrate', float, 50),
                                                         mp_settings.MPSetting('source', str, "SRTM3", choice=mp_elevation.TERRAIN_SERVICES.keys())])
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
         self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+        self.grid_cache = mp_terraingrid.TerrainGridCache(self.ElevationModel)
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
-        usage = "usage: terrain <set|status|check>"
+        usage = "usage: terrain <set|status|check|pregen>"
         if len(args) == 0:
             print(usage)
             return
         if args[0] == "status":
-            print("blocks_sent: %u requests_received: %u" % (
+            print("blocks_sent: %u blocks_lost: %u requests_received: %u rate: %.1f/s" % (
                 self.blocks_sent,
-                self.requests_received))
+                self.blocks_lost,
+                self.requests_received,
+                self.send_rate))
+            print("%s pregen_queued: %u" % (self.grid_cache.status(), len(self.pregen_queue)))
+            if self.ElevationModel.database in ['SRTM1', 'SRTM3']:
+                print("tiles loaded: %u loading: %u" % (len(self.ElevationModel.tileDict),
+                                                        self.ElevationModel.pendingTiles()))
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
             # Re-init terrain model
             self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+            self.grid_cache = mp_terraingrid.TerrainGridCache(self.ElevationModel)
+            self.vehicle_tile = None
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
+        elif args[0] == "pregen":
+            self.cmd_terrain_pregen()
         else:
             print(usage)
 
@@ -63,15 +95,43 @@ class TerrainModule(mp_module.MPModule):
         self.check_lon = int(latlon[1]*1e7)
         self.master.mav.terrain_check_send(self.check_lat, self.check_lon)
 
+    def grid_spacing(self):
+        return int(self.get_mav_param('TERRAIN_SPACING', 100))
+
+    def cmd_terrain_pregen(self):
+        '''queue the grids along the loaded mission for generation'''
+        wp_module = self.module('wp')
+        if wp_module is None:
+            print("No mission loaded")
+            return
+        self.pregen_mission_change = wp_module.wploader.last_change
+        spacing = self.grid_spacing()
+        grids = mp_terraingrid.path_grids(wp_module.wploader.polygon_list(), spacing)
+        self.pregen_queue = [(lat, lon, spacing) for (lat, lon) in grids]
+        print("Generating %u terrain grids" % len(self.pregen_queue))
+
+    def pregen_task(self):
+        '''generate a queued grid'''
+        if self.terrain_settings.pregen:
+            wp_module = self.module('wp')
+            if (wp_module is not None and wp_module.wploader.count() > 0 and
+                    wp_module.wploader.last_change != self.pregen_mission_change):
+                self.cmd_terrain_pregen()
+        while len(self.pregen_queue) > 0:
+            (lat, lon, spacing) = self.pregen_queue.pop(0)
+            if not self.grid_cache.complete(lat, lon, spacing):
+                self.grid_cache.get(lat, lon, spacing)
+                return
+
     def mavlink_packet(self, msg):
         '''handle an incoming mavlink packet'''
         mtype = msg.get_type()
         master = self.master
         # add some status fields
         if mtype == 'TERRAIN_REQUEST' and self.terrain_settings.enable:
-            self.current_request = msg
-            self.sent_mask = 0
+            self.handle_terrain_request(msg)
             self.requests_received += 1
+            self.wake_idle()
         elif mtype == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -79,28 +139,58 @@ class TerrainModule(mp_module.MPModule):
                 print(msg)
                 self.check_lat = 0
                 self.check_lon = 0
+        elif mtype == 'GLOBAL_POSITION_INT':
+            if msg.lat == 0 and msg.lon == 0:
+                return
+            tile = (msg.lat // 10000000, msg.lon // 10000000)
+            if tile != self.vehicle_tile:
+                self.vehicle_tile = tile
+                self.ElevationModel.prefetch(msg.lat * 1.0e-7, msg.lon * 1.0e-7)
+
+    def handle_terrain_request(self, msg):
+        '''handle a request for a grid. The vehicle repeats the request
+        with the mask of the blocks it still needs, which shows which
+        sent blocks arrived and which were lost'''
+        prev = self.current_request
+        self.current_request = msg
+        if (prev is None or prev.lat != msg.lat or prev.lon != msg.lon or
+                prev.grid_spacing != msg.grid_spacing):
+            self.sent_mask = 0
+            self.sent_time = {}
+            return
+        now = time.time()
+        # blocks still asked for this long after being sent are lost
+        timeout = 2.0
+        delivered = 0
+        lost = 0
+        for bit in list(self.sent_time.keys()):
+            if msg.mask & (1<<bit) == 0:
+                # clear the sent bit so the block is sent again if the
+                # vehicle asks for it later
+                delivered += 1
+                self.sent_time.pop(bit)
+                self.sent_mask &= ~(1<<bit)
+            elif now - self.sent_time[bit] > timeout:
+                lost += 1
+                self.sent_time.pop(bit)
+                self.sent_mask &= ~(1<<bit)
+        self.blocks_lost += lost
+        if lost > 0:
+            self.send_rate = max(self.send_rate * 0.5, self.terrain_settings.minrate)
+        elif delivered > 0:
+            self.send_rate = min(self.send_rate + 2, self.terrain_settings.maxrate)
 
     def send_terrain_data_bit(self, bit):
         '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
+        heights = self.grid_cache.get(self.current_request.lat,
+                                      self.current_request.lon,
+                                      self.current_request.grid_spacing)
+        block = mp_terraingrid.block_data(heights, bit)
+        if numpy.isnan(block).any():
+            if self.terrain_settings.debug:
+                print("no alt for block %u" % bit)
+            return False
+        data = [int(alt) for alt in block]
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
@@ -109,6 +199,7 @@ class TerrainModule(mp_module.MPModule):
         self.blocks_sent += 1
         self.last_send_time = time.time()
         self.sent_mask |= 1<<bit
+        self.sent_time[bit] = self.last_send_time
         if self.terrain_settings.debug and bit == 55:
             lat = self.current_request.lat * 1.0e-7
             lon = self.current_request.lon * 1.0e-7
@@ -119,26 +210,33 @@ class TerrainModule(mp_module.MPModule):
                                              north=28*self.current_request.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
-
+        return True
 
     def send_terrain_data(self):
-        '''send some terrain data'''
+        '''send some terrain data, returning False if there is nothing
+        which can be sent now'''
         for bit in range(56):
             if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
-                return
-        # no bits to send
-        self.current_request = None
-        self.sent_mask = 0
+                return self.send_terrain_data_bit(bit)
+        # no bits to send, keep the request to match against the
+        # vehicle's next one
+        return False
 
     def idle_task(self):
         '''called when idle'''
-        if self.current_request is None:
-            return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        now = time.time()
+        dt = now - self.last_allowance_time
+        self.last_allowance_time = now
+        if self.current_request is None or self.current_request.mask & ~self.sent_mask == 0:
+            self.pregen_task()
             return
-        self.send_terrain_data()
+        # send at send_rate, with bursts of up to one idle period
+        self.send_allowance = min(self.send_allowance + dt * self.send_rate,
+                                  1 + self.send_rate / self.idle_rate)
+        while self.send_allowance >= 1:
+            if not self.send_terrain_data():
+                break
+            self.send_allowance -= 1
 
 def init(mpstate):
     '''initialise module'''
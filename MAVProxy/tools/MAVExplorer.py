@@ -22,6 +22,7 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import mp_logindex
 from MAVProxy.modules.lib.graph_ui import Graph_UI
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -114,6 +115,8 @@ class MEState(object):
               MPSetting('paramdocs', bool, True, 'show param docs'),
               MPSetting('max_rate', float, 0, 'maximum display rate of graphs in Hz'),
               MPSetting('vehicle_type', str, 'Auto', 'force vehicle type for mode handling'),
+              MPSetting('log_index', bool, True, 'use a sidecar index file for tlogs'),
+              MPSetting('graph_cache', bool, False, 'save graph data columns next to the log'),
               ]
             )
 
@@ -705,6 +708,9 @@ def cmd_dump(args):
         return
     mlog = mestate.mlog
     mlog.rewind()
+    if hasattr(mlog, 'set_time_range'):
+        # only read the messages within the graph limits
+        mlog.set_time_range(xlimits.xlim_low, xlimits.xlim_high)
     types_inst = []
     types_filt_inst_id = []
     types_inst_no_id = []
@@ -1395,6 +1401,7 @@ def cmd_paramchange(args):
         wildcard = '*'
     types = set(['PARM','PARAM_VALUE'])
     vmap = {}
+    mestate.mlog.rewind()
     while True:
         m = mestate.mlog.recv_match(type=types, condition=mestate.settings.condition)
         if m is None:
@@ -1555,9 +1562,8 @@ def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False,
-                                      progress_callback=progress_bar)
+    mlog = mp_logindex.open_log(args, progress_callback=progress_bar,
+                                use_index=mestate.settings.log_index)
     mestate.filename = args
     mestate.mlog = mlog
     # note that this is a shallow copy of the messages.
@@ -1568,6 +1574,8 @@ def loadfile(args):
     mestate.status.msgs = copy.copy(mlog.messages)
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
+    if getattr(mlog, 'index_loaded', False):
+        mestate.console.write("Using index %s\n" % mp_logindex.index_filename(args))
 
     # evaluate graph expressions before finding flightmode list as
     # flightmode_list does a rewind(), and that clears the DFReader
@@ -718,6 +718,42 @@ def mavflightview(filename, options):
     mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, instances, title=filename)
 
 
+def mavflightview_job(job):
+    '''extract the tracks from one log in a worker process'''
+    global colour_source_min, colour_source_max, colour_over_255
+    (filename, options) = job
+    t0 = time.time()
+    # the colour statistics are per log, a worker may process several
+    colour_source_min = 255
+    colour_source_max = 0
+    colour_over_255 = 0
+    mlog = mavutil.mavlink_connection(filename)
+    stuff = mavflightview_mav(mlog, options)
+    return (filename, stuff, (colour_source_min, colour_source_max, colour_over_255), time.time() - t0)
+
+
+def mavflightview_parallel(filenames, options, jobs):
+    '''extract tracks from logs in a pool of worker processes, showing
+    them in the order given'''
+    global colour_source_min, colour_source_max, colour_over_255
+    pool = multiproc.Pool(min(jobs, len(filenames)))
+    try:
+        count = 0
+        for (filename, stuff, colour_stats, dt) in pool.imap(mavflightview_job, [(f, options) for f in filenames]):
+            count += 1
+            print("Processed %s (%u/%u) in %.1fs" % (filename, count, len(filenames), dt))
+            if stuff is None:
+                continue
+            colour_source_min = min(colour_source_min, colour_stats[0])
+            colour_source_max = max(colour_source_max, colour_stats[1])
+            colour_over_255 += colour_stats[2]
+            [path, wp, fen, used_flightmodes, mav_type, instances] = stuff
+            mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, instances, title=filename)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class mavflightview_options(object):
     def __init__(self):
         self.service = "MicrosoftHyb"
@@ -772,6 +808,7 @@ if __name__ == "__main__":
     parser.add_option("--kml", default=None, help="add kml overlay")
     parser.add_option("--hide-waypoints", dest='show_waypoints', action='store_false', help="do not show waypoints", default=True)  # noqa:E501
     parser.add_option("--no-show-lines", action="store_true", default=False)
+    parser.add_option("--jobs", type='int', default=1, help="number of logs to process in parallel")
 
     (opts, args) = parser.parse_args()
 
@@ -794,5 +831,8 @@ if __name__ == "__main__":
 
     random.seed(1)
 
-    for f in args:
-        mavflightview(f, opts)
+    if opts.jobs > 1 and len(args) > 1:
+        mavflightview_parallel(args, opts, opts.jobs)
+    else:
+        for f in args:
+            mavflightview(f, opts)